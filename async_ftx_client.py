@@ -0,0 +1,287 @@
+import asyncio
+import datetime
+import json
+import random
+import time
+from typing import Any, List, Optional, Tuple
+
+import aiohttp
+import pandas as pd
+from ciso8601 import parse_datetime
+from requests import Request
+
+from candle_store import CandleStore
+from ftx_client import FtxClient
+from instrumentation import endpoint_name, metrics
+from order_tracker import OrderTracker
+
+
+class TokenBucket:
+    """Allows bursts of up to `capacity` requests and `rate` requests per second on average."""
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = None
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self._updated is not None:
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class AsyncFtxClient(FtxClient):
+    """
+    asyncio version of FtxClient on a pooled keep-alive aiohttp session. Requests are signed and processed by the
+    FtxClient code, go through a token bucket sized to the exchange rate limit and are retried with jittered
+    exponential backoff on 429, 5xx and connection errors. Simple endpoints are inherited (they return awaitables
+    here), the ones that post-process responses are overridden as coroutines.
+    """
+    _RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, api_key=None, api_secret=None, subaccount_name=None,
+                 candle_store: Optional[CandleStore] = None, endpoint: str = None, rate: float = 150,
+                 burst: int = 30, max_connections: int = 20, max_retries: int = 4, backoff: float = 0.25,
+                 timeout: float = 30, market_ttl: float = 3600, quote_ttl: float = 1,
+                 order_tracker: Optional[OrderTracker] = None) -> None:
+        super().__init__(api_key=api_key, api_secret=api_secret, subaccount_name=subaccount_name,
+                         candle_store=candle_store, market_ttl=market_ttl, quote_ttl=quote_ttl,
+                         order_tracker=order_tracker)
+        if endpoint is not None:
+            self._ENDPOINT = endpoint
+        self._rate_limiter = TokenBucket(rate, burst)
+        self._max_connections = max_connections
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._timeout = timeout
+        self._async_session = None
+        self._markets_lock = None
+
+    async def __aenter__(self) -> "AsyncFtxClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._async_session is None:
+            connector = aiohttp.TCPConnector(limit=self._max_connections, keepalive_timeout=60)
+            self._async_session = aiohttp.ClientSession(connector=connector,
+                                                        timeout=aiohttp.ClientTimeout(total=self._timeout))
+        return self._async_session
+
+    async def _sleep_before_retry(self, attempt: int) -> None:
+        # Full jitter keeps many concurrent retries from hitting the exchange in lockstep
+        await asyncio.sleep(random.uniform(0, self._backoff * 2 ** attempt))
+
+    async def _request(self, method: str, path: str, **kwargs) -> Any:
+        session = self._get_session()
+        for attempt in range(self._max_retries + 1):
+            # Signed again on every attempt, FTX rejects stale timestamps
+            request = Request(method, self._ENDPOINT + path, **kwargs)
+            self._sign_request(request)
+            prepared = request.prepare()
+
+            await self._rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                async with session.request(prepared.method, prepared.url, data=prepared.body,
+                                           headers=dict(prepared.headers)) as response:
+                    # Orders are only retried when the exchange rejected them outright, a 5xx may have been filled
+                    retry = response.status == 429 or (response.status in self._RETRY_STATUSES and method == "GET")
+                    if retry and attempt < self._max_retries:
+                        await self._sleep_before_retry(attempt)
+                        continue
+                    body = await response.read()
+                    if metrics.enabled:
+                        metrics.record(f"api:{endpoint_name(path)}", time.perf_counter() - start)
+                        metrics.count("api_calls")
+                        metrics.count("bytes_downloaded", len(body))
+                    try:
+                        data = json.loads(body)
+                    except ValueError:
+                        response.raise_for_status()
+                        raise
+                    return self._process_data(data)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if method != "GET" or attempt == self._max_retries:
+                    raise
+                await self._sleep_before_retry(attempt)
+
+    async def get_last_funding_rate(self, market: str) -> dict:
+        start_time = int(round((self._now() - datetime.timedelta(hours=1)).timestamp()))
+        return (await self._get(f"funding_rates", {"future": market, "start_time": start_time}))[0]["rate"]
+
+    async def get_position(self, name: str, show_avg_price: bool = False) -> dict:
+        return next(filter(lambda x: x['future'] == name, await self.get_positions(show_avg_price)), None)
+
+    async def get_historical_market_data(self, market: str, interval: str, start_time: str) -> pd.DataFrame:
+        resolution, start_time, fetch_from = self._candle_request(market, interval, start_time)
+        data = await self.get_historical_prices(market, resolution, fetch_from)
+        df = self._candle_response(market, resolution, start_time, fetch_from, data)
+        if df is None:
+            data = await self.get_historical_prices(market, resolution, start_time)
+            df = self._candle_response(market, resolution, start_time, start_time, data)
+        return df
+
+    async def check_open_position(self, market: str) -> dict:
+        if self._tracking_fills():
+            return self._order_tracker.position(market)
+        position = await self.get_position(market)
+        if position is not None:
+            if position["size"] != 0:
+                return position
+        return {}
+
+    async def update_stop_loss(self, market: str, stop_loss: float) -> float:
+        for trigger_order in await self.get_conditional_orders(market):
+            if trigger_order["type"] == "stop":
+                if trigger_order["triggerPrice"] != stop_loss:
+                    response = await self.modify_trigger_order(
+                        order_id=str(trigger_order["id"]),
+                        size=trigger_order["size"],
+                        trigger_price=stop_loss
+                    )
+                    return response["triggerPrice"]
+        return 0
+
+    async def _wait_position_closed(self, market: str) -> bool:
+        # Polls the position until it is flat, gives up after 5 tries
+        idx = 0
+        while await self.check_open_position(market):
+            await asyncio.sleep(2)
+            idx += 1
+            if idx == 5:
+                return False
+        return True
+
+    async def market_close(self, market: str, side: str, size: float) -> Tuple[asyncio.Future, dict]:
+        # Same as FtxClient.market_close, the REST polling runs as a task on the client's loop
+        if self._tracking_fills():
+            closed = asyncio.wrap_future(self._order_tracker.expect_close(market))
+            response = await self.place_order(market, side=side, size=size, type="market", price=0)
+            await self.cancel_orders(market, conditional_orders=True)
+            return closed, response
+
+        response = await self.place_order(market, side=side, size=size, type="market", price=0)
+        await self.cancel_orders(market, conditional_orders=True)
+        return asyncio.ensure_future(self._wait_position_closed(market)), response
+
+    async def market_close_and_cancel_orders(self, market: str, side: str, size: float,
+                                             timeout: float = 10) -> Tuple[bool, dict]:
+        if self._tracking_fills():
+            closed, response = await self.market_close(market, side, size)
+            try:
+                return await asyncio.wait_for(closed, timeout), response
+            except asyncio.TimeoutError:
+                return False, response
+
+        response = await self.place_order(market, side=side, size=size, type="market", price=0)
+        await self.cancel_orders(market, conditional_orders=True)
+        return await self._wait_position_closed(market), response
+
+    async def get_coin_balance(self, coin: str = "USD") -> float:
+        coin_balance = 0
+        for balance in await self.get_balances():
+            if balance["coin"] == coin:
+                coin_balance = float(balance["free"])
+        return coin_balance
+
+    async def get_market_info(self, market: str) -> dict:
+        if self._markets_lock is None:
+            self._markets_lock = asyncio.Lock()
+        # Concurrent callers wait for a single list_markets refresh
+        async with self._markets_lock:
+            if not self._market_info_cached(market):
+                self._store_markets(await self.list_markets())
+        return self._markets[market]
+
+    async def get_leverage(self) -> float:
+        if not self._is_fresh(self._leverage_updated, self._market_ttl):
+            self._leverage = (await self.get_account_info())["leverage"]
+            self._leverage_updated = time.monotonic()
+        return self._leverage
+
+    async def get_quote(self, market: str) -> dict:
+        quote = self._cached_quote(market)
+        if quote is None:
+            quote = self._store_quote(market, await self.get_orderbook(market, depth=1))
+        return quote
+
+    async def get_size_precision(self, market: str) -> int:
+        return self._increment_decimals((await self.get_market_info(market))["sizeIncrement"])
+
+    async def get_price_precision(self, market: str) -> int:
+        return self._increment_decimals((await self.get_market_info(market))["priceIncrement"])
+
+    async def round_size(self, market: str, size: float) -> float:
+        return self._round_to_increment(size, (await self.get_market_info(market))["sizeIncrement"])
+
+    async def round_price(self, market: str, price: float) -> float:
+        return self._round_to_increment(price, (await self.get_market_info(market))["priceIncrement"])
+
+    async def get_latest_price(self, market: str, side: str) -> float:
+        quote = await self.get_quote(market)
+        if side == "sell":
+            return quote["ask"]
+        elif side == "buy":
+            return quote["bid"]
+        return 0
+
+    async def generate_order_size(self, price: float, market: str, percent: int) -> float:
+        usd_balance, leverage, _ = await asyncio.gather(
+            self.get_coin_balance(coin="USD"), self.get_leverage(), self.get_market_info(market))
+        return await self._order_size(usd_balance, leverage, price, market, percent)
+
+    async def _order_size(self, usd_balance: float, leverage: float, price: float, market: str,
+                          percent: int) -> float:
+        return await self.round_size(market, usd_balance * percent / 100 * leverage / float(price))
+
+    async def get_stop_loss_price(self, price: float, percent: float, side: str, market: str):
+        return await self.round_price(market, self._stop_loss_price(price, percent, side))
+
+    async def get_take_profit_price(self, price: float, percent: float, side: str, market: str):
+        return await self.round_price(market, self._take_profit_price(price, percent, side))
+
+    async def generate_order(self, order: dict, account_percent: int = 10, stop_loss_percent: float = 5) \
+            -> Tuple[dict, dict]:
+        # Balance, leverage, metadata and top of book in parallel, the last three usually come from the caches
+        market, side = order["market"], order["side"]
+        usd_balance, leverage, price, _ = await asyncio.gather(
+            self.get_coin_balance(coin="USD"), self.get_leverage(), self.get_latest_price(market, side),
+            self.get_market_info(market))
+        size = await self._order_size(usd_balance, leverage, order["entry"], market, account_percent)
+        stop_loss_price = await self.get_stop_loss_price(price, stop_loss_percent, side, market)
+        return self._build_orders(order, price, size, stop_loss_price)
+
+    async def get_all_trades(self, market: str, start_time: float = None, end_time: float = None) -> List:
+        ids = set()
+        limit = 100
+        results = []
+        while True:
+            response = await self._get(f'markets/{market}/trades', {
+                'end_time': end_time,
+                'start_time': start_time,
+            })
+            deduped_trades = [r for r in response if r['id'] not in ids]
+            results.extend(deduped_trades)
+            ids |= {r['id'] for r in deduped_trades}
+            if len(response) == 0:
+                break
+            end_time = min(parse_datetime(t['time']) for t in response).timestamp()
+            if len(response) < limit:
+                break
+        return results
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+import backtesting as bt
+
+
+def candle_fingerprint(df: pd.DataFrame) -> str:
+    # The backtests only read high, low and close, hashing their raw bytes is a few microseconds for 1000 candles
+    digest = hashlib.blake2b(digest_size=16)
+    for column in ("high", "low", "close"):
+        digest.update(np.ascontiguousarray(df[column].values, dtype=np.float64).tobytes())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+class BacktestCache:
+    """
+    Memoizes backtest_dataframe and optimize_m_l on a fingerprint of the candles plus the parameters. Results are
+    kept in an in-process LRU of max_entries and, if folder_path is given, in one JSON file per result so other
+    processes and later runs can reuse them. The least recently used files are evicted once the folder grows past
+    max_disk_bytes.
+    """
+
+    def __init__(self, folder_path: Optional[str] = None, max_entries: int = 1024,
+                 max_disk_bytes: int = 64 * 1024 ** 2) -> None:
+        self.folder_path = folder_path
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        if folder_path is not None and not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "entries": len(self._memory)}
+
+    def _filepath(self, key: str) -> str:
+        return os.path.join(self.folder_path, f"{key}.json")
+
+    def _load(self, key: str) -> Optional[dict]:
+        if self.folder_path is None:
+            return None
+        filepath = self._filepath(key)
+        try:
+            with open(filepath) as json_file:
+                value = json.load(json_file)
+        except (OSError, ValueError):
+            return None
+        # Touched so eviction sees it as recently used
+        os.utime(filepath)
+        return value
+
+    def _store(self, key: str, value: dict) -> None:
+        if self.folder_path is None:
+            return
+        # Other processes may be storing the same result, each writes its own temporary file
+        fd, tmp_filepath = tempfile.mkstemp(dir=self.folder_path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as json_file:
+                json.dump(value, json_file)
+            os.replace(tmp_filepath, self._filepath(key))
+        except BaseException:
+            os.remove(tmp_filepath)
+            raise
+        self._evict()
+
+    def _evict(self) -> None:
+        files = []
+        for entry in os.scandir(self.folder_path):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in files)
+        for _, size, filepath in sorted(files):
+            if total_size <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                # Already evicted by another process
+                pass
+            total_size -= size
+
+    def get_or_compute(self, key: str, func: Callable[[], dict]) -> dict:
+        if key in self._memory:
+            self.hits += 1
+            self._memory.move_to_end(key)
+            return dict(self._memory[key])
+
+        value = self._load(key)
+        if value is not None:
+            self.hits += 1
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            value = func()
+            self._store(key, value)
+
+        self._memory[key] = value
+        if len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+        # Callers format the result in place, the cached one stays untouched
+        return dict(value)
+
+    @staticmethod
+    def make_key(name: str, df: pd.DataFrame, **params) -> str:
+        params_text = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.blake2b(f"{name}:{candle_fingerprint(df)}:{params_text}".encode(), digest_size=16).hexdigest()
+
+    def backtest_dataframe(self, df: pd.DataFrame, look_back: int = 9, multiplier: int = 2,
+                           stop_loss_percent: float = None, take_profit_percent: float = None, fee: float = 0.,
+                           slippage: float = 0.) -> dict:
+        key = self.make_key("backtest_dataframe", df, look_back=int(look_back), multiplier=float(multiplier),
+                            stop_loss_percent=stop_loss_percent, take_profit_percent=take_profit_percent, fee=fee,
+                            slippage=slippage)
+        return self.get_or_compute(key, lambda: bt.backtest_dataframe(
+            df, look_back=look_back, multiplier=multiplier, stop_loss_percent=stop_loss_percent,
+            take_profit_percent=take_profit_percent, fee=fee, slippage=slippage))
+
+    def optimize_m_l(self, df: pd.DataFrame, optimize_to: str = "TheDfactor", return_optimize_to: bool = False,
+                     multipliers: list = None, lookbacks: list = None, stop_losses: list = None,
+                     take_profits: list = None, fee: float = 0., slippage: float = 0.) -> dict:
+        key = self.make_key("optimize_m_l", df, optimize_to=optimize_to, return_optimize_to=return_optimize_to,
+                            multipliers=multipliers, lookbacks=lookbacks, stop_losses=stop_losses,
+                            take_profits=take_profits, fee=fee, slippage=slippage)
+        return self.get_or_compute(key, lambda: bt.optimize_m_l(
+            df, optimize_to=optimize_to, return_optimize_to=return_optimize_to, multipliers=multipliers,
+            lookbacks=lookbacks, stop_losses=stop_losses, take_profits=take_profits, fee=fee, slippage=slippage))
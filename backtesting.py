@@ -1,103 +1,293 @@
 import itertools
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, List, Tuple
 
 import numpy as np
 import pandas as pd
 
 import supertrend as spt
+from indicator_panel import IndicatorPanel
+from instrumentation import metrics
+
+
+class Positions(NamedTuple):
+    # One entry per signal: candle index, side (1 long, -1 short) and entry price
+    idx: np.ndarray
+    side: np.ndarray
+    price: np.ndarray
+
+
+def get_base_positions(st_signal: np.ndarray, close: np.ndarray) -> Positions:
+    st_signal = np.asarray(st_signal)
+    idx = np.flatnonzero(st_signal)
+    return Positions(idx=idx, side=st_signal[idx].astype(np.int8), price=np.asarray(close, dtype=np.float64)[idx])
+
+
+def get_drawdown(positions: Positions, high: np.ndarray, low: np.ndarray) -> np.ndarray:
+    if positions.idx.size < 2:
+        return np.array([])
+
+    # Extremes from each entry up to (not including) the next one, the segment after the last entry is dropped
+    min_price_in_range = np.minimum.reduceat(np.asarray(low, dtype=np.float64), positions.idx)[:-1]
+    max_price_in_range = np.maximum.reduceat(np.asarray(high, dtype=np.float64), positions.idx)[:-1]
+
+    price, side = positions.price[:-1], positions.side[:-1]
+    return np.where(side == 1, (price - min_price_in_range) / min_price_in_range * 100,
+                    (max_price_in_range - price) / price * 100)
+
+
+EXIT_SIGNAL, EXIT_STOP_LOSS, EXIT_TAKE_PROFIT = 0, 1, 2
+
+
+class Exits(NamedTuple):
+    # One entry per closed position (all but the last): exit candle index, exit price and EXIT_* reason
+    idx: np.ndarray
+    price: np.ndarray
+    reason: np.ndarray
+
+
+def simulate_exits(positions: Positions, high: np.ndarray, low: np.ndarray, stop_loss_percent: float = None,
+                   take_profit_percent: float = None) -> Exits:
+    """
+    Exits of each position with a stop loss and/or take profit stop_loss_percent/take_profit_percent away from its
+    entry, first touch against each candle's high and low from the candle after the entry up to and including the
+    next signal's candle (intrabar, so before that signal's close). If both are touched in the same candle the stop
+    loss is assumed first. Positions that touch neither exit at the next signal's close as before.
+    """
+    idx, side, price = positions.idx, positions.side, positions.price
+    if idx.size < 2:
+        return Exits(idx=np.array([], dtype=np.int64), price=np.array([]), reason=np.array([], dtype=np.int8))
+
+    exit_idx, exit_price = idx[1:].copy(), price[1:].copy()
+    reason = np.full(idx.size - 1, EXIT_SIGNAL, dtype=np.int8)
+
+    # Candles after each entry up to the next entry, one contiguous segment per position
+    candles = np.arange(idx[0] + 1, idx[-1] + 1)
+    segment = np.searchsorted(idx, candles, side="left") - 1
+    starts = idx[:-1] - idx[0]
+    high = np.asarray(high, dtype=np.float64)[candles]
+    low = np.asarray(low, dtype=np.float64)[candles]
+    is_long = side[segment] == 1
+    never = idx[-1] + 1
+
+    first_touch = {}
+    for exit_reason, percent, direction in ((EXIT_STOP_LOSS, stop_loss_percent, -1),
+                                            (EXIT_TAKE_PROFIT, take_profit_percent, 1)):
+        if percent is None:
+            continue
+        # Long stop losses sit below the entry and take profits above, shorts the other way round
+        level = price[:-1] * (1 + direction * side[:-1] * percent / 100)
+        candle_level = level[segment]
+        below = low <= candle_level
+        above = high >= candle_level
+        touched = np.where(is_long, below, above) if direction == -1 else np.where(is_long, above, below)
+        first_touch[exit_reason] = (np.minimum.reduceat(np.where(touched, candles, never), starts), level)
+
+    # Take profit first so a stop loss in the same candle overrides it
+    for exit_reason in (EXIT_TAKE_PROFIT, EXIT_STOP_LOSS):
+        if exit_reason not in first_touch:
+            continue
+        touch, level = first_touch[exit_reason]
+        hit = touch <= exit_idx
+        exit_idx[hit], exit_price[hit], reason[hit] = touch[hit], level[hit], exit_reason
+
+    return Exits(idx=exit_idx, price=exit_price, reason=reason)
+
+
+def exits_drawdown(positions: Positions, exits: Exits, high: np.ndarray, low: np.ndarray) -> np.ndarray:
+    # As get_drawdown, but a position stopped out or taken profit on only counts the candles before its exit and the
+    # exit price itself
+    if positions.idx.size < 2:
+        return np.array([])
+
+    idx = positions.idx
+    candles = np.arange(idx[0], idx[-1])
+    held = candles < exits.idx[np.searchsorted(idx, candles, side="right") - 1]
+    starts = idx[:-1] - idx[0]
+    min_price_in_range = np.minimum.reduceat(np.where(held, np.asarray(low, dtype=np.float64)[candles], np.inf),
+                                             starts)
+    max_price_in_range = np.maximum.reduceat(np.where(held, np.asarray(high, dtype=np.float64)[candles], -np.inf),
+                                             starts)
+    early = exits.reason != EXIT_SIGNAL
+    min_price_in_range[early] = np.minimum(min_price_in_range[early], exits.price[early])
+    max_price_in_range[early] = np.maximum(max_price_in_range[early], exits.price[early])
+
+    price, side = positions.price[:-1], positions.side[:-1]
+    return np.where(side == 1, (price - min_price_in_range) / min_price_in_range * 100,
+                    (max_price_in_range - price) / price * 100)
+
+
+def exits_profits(positions: Positions, exits: Exits, fee: float = 0., slippage: float = 0., strategy: str = None,
+                  sma: np.ndarray = None, ema: np.ndarray = None) -> np.ndarray:
+    # As profits_calculator with the simulated exits, fills move slippage (a fraction) against the position and
+    # fee (a fraction of the notional) is paid on entry and exit
+    if positions.idx.size < 2:
+        return np.array([])
+
+    side = positions.side[:-1]
+    entry = positions.price[:-1] * (1 + side * slippage)
+    exit_ = exits.price * (1 - side * slippage)
+    percent_change = np.where(side == 1, (exit_ - entry) / entry * 100, (entry - exit_) / exit_ * 100)
+    percent_change -= 2 * fee * 100
+    return percent_change[strategy_mask(positions, strategy, sma=sma, ema=ema)[:-1]]
+
+
+@metrics.timed("backtest_grid")
+def backtest_grid(df: pd.DataFrame, multipliers: list, lookbacks: list, stop_losses: list = None,
+                  take_profits: list = None, fee: float = 0., slippage: float = 0.) -> pd.DataFrame:
+    # stop_losses/take_profits sweep the exit percentages too (None in a list means no stop), adding StopLoss and
+    # TakeProfit columns
+    close, high, low = df.close.values, df.high.values, df.low.values
+    st_grid = spt.supertrend_grid(high, low, close, look_backs=lookbacks, multipliers=multipliers)
+    exit_grid = list(itertools.product(stop_losses or [None], take_profits or [None]))
+
+    results = []
+    for st, (multiplier, lookback) in zip(st_grid, itertools.product(multipliers, lookbacks)):
+        positions = get_supertrend_positions(st, close)
+        if positions.idx.size < 2:
+            # Not a single closed trade with these parameters
+            continue
+        for stop_loss, take_profit in exit_grid:
+            result = _positions_analysis(positions, high=high, low=low, stop_loss_percent=stop_loss,
+                                         take_profit_percent=take_profit, fee=fee, slippage=slippage)
+            result["Multiplier"] = multiplier
+            result["Lookback"] = lookback
+            if stop_losses is not None:
+                result["StopLoss"] = stop_loss
+            if take_profits is not None:
+                result["TakeProfit"] = take_profit
+            results.append(result)
+
+    return pd.DataFrame(results)
+
+
+def optimize_m_l(df: pd.DataFrame, optimize_to: str = "TheDfactor", return_optimize_to: bool = False,
+                 multipliers: list = None, lookbacks: list = None, stop_losses: list = None,
+                 take_profits: list = None, fee: float = 0., slippage: float = 0.) -> dict:
+    if multipliers is None:
+        multipliers = [3, 4]
+    if lookbacks is None:
+        lookbacks = [10, 11]
+
+    analysis_df = backtest_grid(df, multipliers=multipliers, lookbacks=lookbacks, stop_losses=stop_losses,
+                                take_profits=take_profits, fee=fee, slippage=slippage)
+    if analysis_df.empty:
+        raise ValueError("No multiplier/lookback combination produced any trades")
 
+    analysis_df = analysis_df.sort_values(optimize_to, ascending=False)
+    analysis_df = analysis_df.reset_index(drop=True)
+    opt_multiplier, opt_lookback = analysis_df["Multiplier"][0].item(), analysis_df["Lookback"][0].item()
+    optimized = {"Multiplier": opt_multiplier, "Lookback": opt_lookback}
+    for column in ("StopLoss", "TakeProfit"):
+        if column in analysis_df:
+            value = analysis_df[column][0]
+            optimized[column] = None if pd.isna(value) else float(value)
+
+    if return_optimize_to:
+        optimized[optimize_to] = analysis_df[optimize_to][0]
+    return optimized
+
+
+def walk_forward_folds(n_candles: int, train_size: int, test_size: int, step: int = None) \
+        -> List[Tuple[int, int, int]]:
+    # (train start, test start, test end) candle indices, each test window directly follows its training window
+    if step is None:
+        step = test_size
+    return [(start, start + train_size, start + train_size + test_size)
+            for start in range(0, n_candles - train_size - test_size + 1, step)]
+
+
+def _walk_forward_chunk(high: np.ndarray, low: np.ndarray, close: np.ndarray, folds: list, multipliers: list,
+                        lookbacks: list, optimize_to: str) -> List[dict]:
+    # Supertrend is causal, so one grid over the history up to the last fold serves every window: the ATR and band
+    # state of a window is the one carried over from the candles before it instead of being restarted per fold
+    end = max(test_end for _, _, test_end in folds)
+    st_grid = spt.supertrend_grid(high[:end], low[:end], close[:end], look_backs=lookbacks, multipliers=multipliers)
+    params = list(itertools.product(multipliers, lookbacks))
+
+    results = []
+    for train_start, test_start, test_end in folds:
+        best, best_value = None, np.nan
+        for p, (multiplier, lookback) in enumerate(params):
+            positions = get_supertrend_positions(st_grid[p, train_start:test_start], close[train_start:test_start])
+            if positions.idx.size < 2:
+                continue
+            value = _positions_analysis(positions, high=high[train_start:test_start],
+                                        low=low[train_start:test_start])[optimize_to]
+            # Same pick as optimize_m_l, highest value first and NaN last
+            if best is None or value > best_value or (np.isnan(best_value) and not np.isnan(value)):
+                best, best_value = p, value
+
+        result = {"TrainStart": train_start, "TestStart": test_start, "TestEnd": test_end}
+        if best is None:
+            results.append(result)
+            continue
+
+        result.update({"Multiplier": params[best][0], "Lookback": params[best][1], f"Train{optimize_to}": best_value})
+        positions = get_supertrend_positions(st_grid[best, test_start:test_end], close[test_start:test_end])
+        result["Trades"] = max(positions.idx.size - 1, 0)
+        if positions.idx.size >= 2:
+            result.update(_positions_analysis(positions, high=high[test_start:test_end], low=low[test_start:test_end]))
+        results.append(result)
+    return results
+
+
+@metrics.timed("walk_forward")
+def walk_forward(df: pd.DataFrame, train_size: int, test_size: int, step: int = None, multipliers: list = None,
+                 lookbacks: list = None, optimize_to: str = "TheDfactor", workers: int = 1) -> pd.DataFrame:
+    """
+    Slides a training window and a test window of train_size/test_size candles over df, picks the best multiplier
+    and lookback on each training window like optimize_m_l and reports the out-of-sample profits_analysis of that
+    pick on the following test window, one row per fold. With workers > 1 the folds are split into contiguous
+    chunks that run in parallel processes.
+    """
+    if multipliers is None:
+        multipliers = [3, 4]
+    if lookbacks is None:
+        lookbacks = [10, 11]
+
+    folds = walk_forward_folds(len(df), train_size, test_size, step=step)
+    if not folds:
+        raise ValueError(f"{len(df)} candles are not enough for a {train_size} + {test_size} candle fold")
+
+    close, high, low = df.close.values, df.high.values, df.low.values
+    if workers > 1:
+        chunks = [chunk.tolist() for chunk in np.array_split(np.array(folds), min(workers, len(folds)))]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_walk_forward_chunk, high, low, close, chunk, multipliers, lookbacks, optimize_to)
+                       for chunk in chunks]
+            results = [result for future in futures for result in future.result()]
+    else:
+        results = _walk_forward_chunk(high, low, close, folds, multipliers, lookbacks, optimize_to)
 
-def get_base_positions(st_signal: np.ndarray, close: np.ndarray) -> list:
-    positions = []
-
-    for idx, signal in enumerate(st_signal):
-        if signal == 1:
-            positions.append({"side": "long", "price": close[idx], "idx": idx})
-        elif signal == -1:
-            positions.append({"side": "short", "price": close[idx], "idx": idx})
-
-    return positions
-
-
-def get_drawdown(positions: list, high: np.ndarray, low: np.ndarray) -> np.ndarray:
-    drawdown = []
-    for idx in range(len(positions) - 1):
-        if positions[idx]["side"] == "long":
-            min_price_in_range = np.min(low[positions[idx]["idx"]:positions[idx+1]["idx"]])
-            drawdown.append((positions[idx]["price"] - min_price_in_range) / min_price_in_range * 100)
-        if positions[idx]["side"] == "short":
-            max_price_in_range = np.max(high[positions[idx]["idx"]:positions[idx+1]["idx"]])
-            drawdown.append((max_price_in_range - positions[idx]["price"]) / positions[idx]["price"] * 100)
-    return np.array(drawdown)
-
-
-def optimize_m_l(df: pd.DataFrame, optimize_to: str = "TheDfactor", return_optimize_to: bool = False) -> dict:
-    analysis_df = pd.DataFrame(
-        columns=["M_L", "AvgReturns", "StdDev", "RetDevRatio", "MinReturns", "MaxReturns",
-                 "AvgNegReturns", "AvgPosReturns", "PosNegRetRatio", "MedReturns", "MedNegReturns",
-                 "MedPosReturns", "MedPosNegRetRatio", "TheDfactor"])
-
-    multipliers = [3, 4]
-    lookbacks = [10, 11]
+    results = pd.DataFrame(results)
+    results.insert(0, "Fold", np.arange(len(results)))
+    for column in ("TrainStart", "TestStart", "TestEnd"):
+        # Candle indices to timestamps, TestEnd is the last candle of the test window
+        offset = 1 if column == "TestEnd" else 0
+        results[column] = df.index[results[column].values - offset]
+    return results
 
-    for multiplier, lookback in itertools.product(multipliers, lookbacks):
-        profits = backtest_dataframe(df, look_back=lookback, multiplier=multiplier)
-        profits["M_L"] = f"{multiplier}_{lookback}"
-        analysis_df = analysis_df.append(profits, ignore_index=True)
 
-    analysis_df = analysis_df.sort_values(optimize_to, ascending=False)
-    analysis_df = analysis_df.reset_index(drop=True)
-    opt_multiplier, opt_lookback = [int(val) for val in analysis_df["M_L"][0].split("_")]
+def strategy_mask(positions: Positions, strategy: str = None, sma: np.ndarray = None,
+                  ema: np.ndarray = None) -> np.ndarray:
+    # Longs are only taken above and shorts only below the strategy's moving average (given per candle)
+    if not strategy:
+        return np.ones(positions.idx.size, dtype=bool)
 
-    if not return_optimize_to:
-        return {"Multiplier": opt_multiplier, "Lookback": opt_lookback}
-    else:
-        optimized_to_value = backtest_dataframe(df, look_back=opt_lookback, multiplier=opt_multiplier)[optimize_to]
-        return {"Multiplier": opt_multiplier, "Lookback": opt_lookback, f"{optimize_to}": optimized_to_value}
-
-
-def short_strategy(pos: dict, strategy: str) -> bool:
-    if strategy:
-        if strategy == "sma":
-            if pos["price"] < pos["sma"]:
-                return True
-            else:
-                return False
-        elif strategy == "ema":
-            if pos["price"] < pos["ema"]:
-                return True
-            else:
-                return False
-    else:
-        return True
-
-
-def long_strategy(pos: dict, strategy: str) -> bool:
-    if strategy:
-        if "sma" in strategy:
-            if pos["price"] > pos["sma"]:
-                return True
-            else:
-                return False
-        if "ema" in strategy:
-            if pos["price"] > pos["ema"]:
-                return True
-            else:
-                return False
-    else:
-        return True
+    moving_average = {"sma": sma, "ema": ema}[strategy]
+    moving_average = np.asarray(moving_average, dtype=np.float64)[positions.idx]
+    return np.where(positions.side == 1, positions.price > moving_average, positions.price < moving_average)
 
 
-def profits_calculator(positions: list, strategy: str = None) -> np.ndarray:
-    profits = []
+def profits_calculator(positions: Positions, strategy: str = None, sma: np.ndarray = None,
+                       ema: np.ndarray = None) -> np.ndarray:
+    if positions.idx.size < 2:
+        return np.array([])
 
-    for idx in range(len(positions) - 1):
-        if positions[idx]["side"] == "short" and short_strategy(positions[idx], strategy):
-            percent_change = (positions[idx]["price"] - positions[idx + 1]["price"]) / positions[idx + 1]["price"] * 100
-            profits.append(percent_change)
-        elif positions[idx]["side"] == "long" and long_strategy(positions[idx], strategy):
-            percent_change = (positions[idx + 1]["price"] - positions[idx]["price"]) / positions[idx]["price"] * 100
-            profits.append(percent_change)
-    return np.array(profits)
+    entry, exit_ = positions.price[:-1], positions.price[1:]
+    percent_change = np.where(positions.side[:-1] == 1, (exit_ - entry) / entry * 100, (entry - exit_) / exit_ * 100)
+    return percent_change[strategy_mask(positions, strategy, sma=sma, ema=ema)[:-1]]
 
 
 def profits_analysis(profits: np.ndarray, drawdown: np.ndarray) -> dict:
@@ -154,17 +344,42 @@ def profits_analysis(profits: np.ndarray, drawdown: np.ndarray) -> dict:
     return result
 
 
-def backtest_dataframe(df: pd.DataFrame, look_back: int = 9, multiplier: int = 2) -> dict:
-    st, _, _ = spt.supertrend_analysis(df.high, df.low, df.close, look_back=look_back, multiplier=multiplier)
-    _, _, st_signal = spt.get_supertrend_signals(df.close, st)
+def get_supertrend_positions(st: np.ndarray, close: np.ndarray) -> Positions:
+    # st is the full-length kernel output, aligned with close as in the live scan (IndicatorPanel st_signal), so a
+    # signal only depends on the candles up to and including its own
+    _, _, st_signal = spt.supertrend_signals(close, st)
+    return get_base_positions(st_signal, close)
 
-    positions = get_base_positions(st_signal, df.close)
-    drawdown = get_drawdown(positions, high=df.high, low=df.low)
-    profits = profits_calculator(positions)
 
+def _positions_analysis(positions: Positions, high: np.ndarray, low: np.ndarray, stop_loss_percent: float = None,
+                        take_profit_percent: float = None, fee: float = 0., slippage: float = 0.) -> dict:
+    if stop_loss_percent is None and take_profit_percent is None and not fee and not slippage:
+        drawdown = get_drawdown(positions, high=high, low=low)
+        profits = profits_calculator(positions)
+    else:
+        exits = simulate_exits(positions, high=high, low=low, stop_loss_percent=stop_loss_percent,
+                               take_profit_percent=take_profit_percent)
+        drawdown = exits_drawdown(positions, exits, high=high, low=low)
+        profits = exits_profits(positions, exits, fee=fee, slippage=slippage)
     return profits_analysis(profits, drawdown)
 
 
+@metrics.timed("backtest_panel")
+def backtest_panel(panel: IndicatorPanel, stop_loss_percent: float = None, take_profit_percent: float = None,
+                   fee: float = 0., slippage: float = 0.) -> dict:
+    # Backtest on the panel's views, with the panel's look back and multiplier
+    positions = get_supertrend_positions(panel["st"], panel["close"])
+    return _positions_analysis(positions, high=panel["high"], low=panel["low"], stop_loss_percent=stop_loss_percent,
+                               take_profit_percent=take_profit_percent, fee=fee, slippage=slippage)
+
+
+def backtest_dataframe(df: pd.DataFrame, look_back: int = 9, multiplier: int = 2, stop_loss_percent: float = None,
+                       take_profit_percent: float = None, fee: float = 0., slippage: float = 0.) -> dict:
+    return backtest_panel(IndicatorPanel(df, look_back=look_back, multiplier=multiplier),
+                          stop_loss_percent=stop_loss_percent, take_profit_percent=take_profit_percent, fee=fee,
+                          slippage=slippage)
+
+
 def get_backtest_ranking(new_value: float, filename: str, sort_by_column: str = "TheDfactor") -> str:
     if not filename.endswith(".csv"):
         filename += ".csv"
@@ -0,0 +1,403 @@
+import argparse
+import gzip
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import backtesting as bt
+import supertrend as spt
+from candle_store import candles_to_dataframe
+from ftx_client import FtxClient, str_to_datetime
+from mock_exchange import ohlcv_to_candles
+from portfolio import simulate_portfolio
+
+
+def synthetic_ohlcv(n_candles: int, seed: int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n_candles)))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.005, n_candles)))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.005, n_candles)))
+    volume = rng.lognormal(10, 1, n_candles)
+    return {"open": open_, "high": high, "low": low, "close": close, "volume": volume}
+
+
+# Per candle log return drift and volatility of every market regime
+REGIMES = {
+    "bull": (0.002, 0.008),
+    "bear": (-0.002, 0.010),
+    "range": (0., 0.004),
+    "volatile": (0., 0.025),
+}
+
+FIXTURE_FOLDER = "benchmark_fixtures"
+MARKETS_FIXTURE = "markets.json.gz"
+
+
+def regime_switching_ohlcv(n_candles: int, seed: int = 0, mean_regime_length: int = 200) -> dict:
+    # Random walk that switches between the REGIMES after geometrically distributed stretches of candles, so
+    # the supertrend sees trends, chop and volatility bursts like on a real market
+    rng = np.random.default_rng(seed)
+    lengths = []
+    while sum(lengths) < n_candles:
+        lengths.extend(rng.geometric(1 / mean_regime_length, size=n_candles // mean_regime_length + 1))
+    regimes = np.repeat(rng.integers(len(REGIMES), size=len(lengths)), lengths)[:n_candles]
+    drift, volatility = np.array(list(REGIMES.values())).T[:, regimes]
+
+    close = 100 * np.exp(np.cumsum(rng.normal(drift, volatility)))
+    open_ = np.concatenate(([close[0]], close[:-1])) * (1 + rng.normal(0, volatility / 10))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, volatility / 2)))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, volatility / 2)))
+    volume = rng.lognormal(10, 1, n_candles) * volatility / volatility.min()
+    return {"open": open_, "high": high, "low": low, "close": close, "volume": volume}
+
+
+def fixture_path(market: str, resolution: int, folder_path: str = FIXTURE_FOLDER) -> str:
+    return os.path.join(folder_path, f"{market}_{resolution}.json.gz")
+
+
+def markets_fixture_path(folder_path: str = FIXTURE_FOLDER) -> str:
+    return os.path.join(folder_path, MARKETS_FIXTURE)
+
+
+def _write_fixture(filepath: str, fixture: dict) -> str:
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    with gzip.open(filepath, "wt") as fixture_file:
+        json.dump(dict(fixture, recorded=time.time()), fixture_file)
+    return filepath
+
+
+def record_candle_fixture(ftx: FtxClient, market: str, resolution: int, start_time: int,
+                          folder_path: str = FIXTURE_FOLDER) -> str:
+    # The raw candles response of the exchange, so the fixture replays the real JSON parsing offline
+    data = ftx.get_historical_prices(market, resolution, start_time)
+    return _write_fixture(fixture_path(market, resolution, folder_path),
+                          {"market": market, "resolution": resolution, "result": data})
+
+
+def record_markets_fixture(ftx: FtxClient, markets: list, folder_path: str = FIXTURE_FOLDER) -> str:
+    # The /markets entries of the recorded markets, their price and size increments decide the order rounding
+    data = [market for market in ftx.list_markets() if market["name"] in markets]
+    return _write_fixture(markets_fixture_path(folder_path), {"result": data})
+
+
+def load_candle_fixtures(folder_path: str = FIXTURE_FOLDER) -> Dict[str, List[dict]]:
+    fixtures = {}
+    if os.path.isdir(folder_path):
+        for filename in sorted(os.listdir(folder_path)):
+            if filename.endswith(".json.gz") and filename != MARKETS_FIXTURE:
+                with gzip.open(os.path.join(folder_path, filename), "rt") as fixture_file:
+                    fixture = json.load(fixture_file)
+                fixtures[f"{fixture['market']}_{fixture['resolution']}"] = fixture["result"]
+    return fixtures
+
+
+def load_markets_fixture(folder_path: str = FIXTURE_FOLDER) -> List[dict]:
+    filepath = markets_fixture_path(folder_path)
+    if not os.path.exists(filepath):
+        return []
+    with gzip.open(filepath, "rt") as fixture_file:
+        return json.load(fixture_file)["result"]
+
+
+def time_function(func: Callable, *args, repeat: int = 3, **kwargs) -> float:
+    # Best of `repeat` runs, after one warm-up call (which also triggers JIT compilation)
+    func(*args, **kwargs)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_supertrend_kernel(sizes: list, look_back: int = 10, multiplier: float = 3):
+    loop = spt._supertrend_loop
+    ewm = spt.ewm_mean
+    compiled = hasattr(loop, "py_func")
+
+    def pure_python_kernel(high, low, close):
+        # Same kernel with the numba dispatchers swapped for their Python functions
+        spt._supertrend_loop, spt.ewm_mean = loop.py_func, ewm.py_func
+        try:
+            return spt.supertrend_kernel(high, low, close, look_back, multiplier)
+        finally:
+            spt._supertrend_loop, spt.ewm_mean = loop, ewm
+
+    print(f"supertrend_kernel (look_back={look_back}, multiplier={multiplier}, numba={compiled})")
+    for size in sizes:
+        data = synthetic_ohlcv(size)
+        fast = time_function(spt.supertrend_kernel, data["high"], data["low"], data["close"], look_back, multiplier)
+        text = f"{size:>10,d} candles: {fast * 1e3:10.2f} ms ({size / fast:,.0f} bars/s)"
+        if compiled:
+            slow = time_function(pure_python_kernel, data["high"], data["low"], data["close"], repeat=1)
+            text += f" | pure Python {slow * 1e3:10.2f} ms, speedup {slow / fast:.0f}x"
+        print(text)
+
+
+def bench_backtest_positions(sizes: list, look_back: int = 10, multiplier: float = 3):
+    print("get_base_positions + get_drawdown + profits_calculator")
+    for size in sizes:
+        data = synthetic_ohlcv(size)
+        st, _, _ = spt.supertrend_kernel(data["high"], data["low"], data["close"], look_back, multiplier)
+        _, _, st_signal = spt.supertrend_signals(data["close"], st)
+
+        def backtest_positions():
+            positions = bt.get_base_positions(st_signal, data["close"])
+            return bt.get_drawdown(positions, data["high"], data["low"]), bt.profits_calculator(positions)
+
+        elapsed = time_function(backtest_positions)
+        print(f"{size:>10,d} candles: {elapsed * 1e6:10.1f} us ({np.count_nonzero(st_signal):,d} positions)")
+
+
+def bench_optimize_grid(n_candles: int = 600, multipliers: list = None, lookbacks: list = None):
+    if multipliers is None:
+        multipliers = list(np.arange(1, 6.5, 0.5))
+    if lookbacks is None:
+        lookbacks = list(range(5, 31))
+    df = pd.DataFrame(synthetic_ohlcv(n_candles))
+
+    n_params = len(multipliers) * len(lookbacks)
+    grid = time_function(spt.supertrend_grid, df.high.values, df.low.values, df.close.values, lookbacks, multipliers)
+    optimize = time_function(bt.optimize_m_l, df, multipliers=multipliers, lookbacks=lookbacks, repeat=1)
+    print(f"optimize_m_l ({n_params} parameter combinations, {n_candles} candles)")
+    print(f"supertrend_grid: {grid * 1e3:10.2f} ms | optimize_m_l: {optimize * 1e3:10.2f} ms "
+          f"({optimize / n_params * 1e3:.2f} ms per combination)")
+
+
+def bench_portfolio(n_markets: int = 100, n_candles: int = 10_000):
+    index = pd.date_range("2020-01-01", periods=n_candles, freq="4h", tz="UTC")
+    candles = {f"MOCK{idx}-PERP": pd.DataFrame(synthetic_ohlcv(n_candles, seed=idx), index=index)
+               for idx in range(n_markets)}
+    market_params = {market: {"Multiplier": 3, "Lookback": 10} for market in candles}
+
+    elapsed = time_function(simulate_portfolio, candles, market_params, repeat=1)
+    n_trades = len(simulate_portfolio(candles, market_params).trades)
+    print(f"simulate_portfolio ({n_markets} markets x {n_candles:,d} candles)")
+    print(f"{elapsed:10.2f} s ({n_markets * n_candles / elapsed:,.0f} bars/s, {n_trades:,d} trades)")
+
+
+def _legacy_candles_to_dataframe(data: list) -> pd.DataFrame:
+    # Row by row construction get_historical_market_data used before the bulk parser, for comparison only
+    from dateutil import parser
+
+    df = pd.DataFrame(columns=['time', 'open', 'high', 'low', 'close', 'volume'])
+    for idx, item in enumerate(data):
+        df.loc[idx] = [parser.parse(item["startTime"]), item["open"], item["high"], item["low"], item["close"],
+                       item["volume"]]
+    return df.set_index("time")
+
+
+def bench_candle_parsing(sizes: list, legacy_max_size: int = 1_500):
+    print("candle response -> DataFrame (FtxClient._parse_candles + candles_to_dataframe)")
+    for size in sizes:
+        data = ohlcv_to_candles(synthetic_ohlcv(size), resolution=60, start_time=1.6e9)
+        parse = time_function(lambda: candles_to_dataframe(FtxClient._parse_candles(data)))
+        text = f"{size:>10,d} candles: {parse * 1e3:10.2f} ms ({size / parse:,.0f} candles/s)"
+        if size <= legacy_max_size:
+            legacy = time_function(_legacy_candles_to_dataframe, data, repeat=1)
+            text += f" | row by row {legacy * 1e3:10.2f} ms, speedup {legacy / parse:.0f}x"
+        print(text)
+
+
+def _legacy_supertrend_signals(prices: np.ndarray, st: np.ndarray) -> np.ndarray:
+    # Per bar loop get_supertrend_signals used before it was vectorized, for comparison only
+    st_signal = []
+    signal = 0
+    for i in range(len(st)):
+        if st[i - 1] > prices[i - 1] and st[i] < prices[i]:
+            st_signal.append(1 if signal != 1 else 0)
+            signal = 1
+        elif st[i - 1] < prices[i - 1] and st[i] > prices[i]:
+            st_signal.append(-1 if signal != -1 else 0)
+            signal = -1
+        else:
+            st_signal.append(0)
+    return np.array(st_signal)
+
+
+def bench_supertrend_signals(sizes: list, look_back: int = 10, multiplier: float = 3):
+    print("supertrend_signals")
+    for size in sizes:
+        data = synthetic_ohlcv(size)
+        st, _, _ = spt.supertrend_kernel(data["high"], data["low"], data["close"], look_back, multiplier)
+        fast = time_function(spt.supertrend_signals, data["close"], st)
+        slow = time_function(_legacy_supertrend_signals, data["close"], st, repeat=1)
+        print(f"{size:>10,d} candles: {fast * 1e3:10.2f} ms ({size / fast:,.0f} bars/s) | "
+              f"per bar loop {slow * 1e3:10.2f} ms, speedup {slow / fast:.0f}x")
+
+
+class BenchmarkResult(NamedTuple):
+    seconds: float
+    bars_per_s: float
+    peak_mb: float
+
+
+def peak_memory(func: Callable, *args, **kwargs) -> float:
+    # Peak of the Python and numpy allocations of one call in MB, in a separate run since tracing slows it down
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def measure(func: Callable, n_bars: int, min_time: float = 0.25) -> BenchmarkResult:
+    # Best of as many runs as fit in about min_time, fast functions are too noisy to compare after just a few
+    repeat = int(np.clip(min_time / time_function(func, repeat=1), 3, 200))
+    seconds = time_function(func, repeat=repeat)
+    return BenchmarkResult(seconds, n_bars / seconds, peak_memory(func))
+
+
+def hot_path_suite(data: dict, look_back: int = 10, multiplier: float = 3, parse_max_size: int = 500_000) \
+        -> Dict[str, BenchmarkResult]:
+    # The functions every scan and backtest runs through, all on the same candles
+    df = pd.DataFrame(data)
+    n_bars = len(df)
+    st, _, _ = spt.supertrend_kernel(df.high.values, df.low.values, df.close.values, look_back, multiplier)
+    _, _, st_signal = spt.supertrend_signals(df.close.values, st)
+
+    def backtest_positions():
+        positions = bt.get_base_positions(st_signal, df.close.values)
+        return bt.get_drawdown(positions, df.high.values, df.low.values), bt.profits_calculator(positions)
+
+    results = {
+        "supertrend_analysis": measure(lambda: spt.supertrend_analysis(df.high, df.low, df.close, look_back,
+                                                                       multiplier), n_bars),
+        "get_supertrend_signals": measure(lambda: spt.get_supertrend_signals(df.close.values, st), n_bars),
+        "backtest_positions": measure(backtest_positions, n_bars),
+        "optimize_m_l": measure(lambda: bt.optimize_m_l(df), n_bars),
+    }
+    if n_bars <= parse_max_size:
+        # A million candle dicts alone take gigabytes, a single response never gets close to that
+        candles = ohlcv_to_candles(data, resolution=14400, start_time=1.6e9)
+        results["candle_parsing"] = measure(lambda: candles_to_dataframe(FtxClient._parse_candles(candles)), n_bars)
+    return results
+
+
+def run_suite(sizes: list, seed: int = 0, fixture_folder: str = FIXTURE_FOLDER) -> Dict[str, BenchmarkResult]:
+    results = {}
+    for size in sizes:
+        for name, result in hot_path_suite(regime_switching_ohlcv(size, seed=seed)).items():
+            results[f"{name}[regime/{size}]"] = result
+
+    fixtures = load_candle_fixtures(fixture_folder)
+    if not fixtures:
+        print(f"No candle fixtures in {fixture_folder}, record one with --record-fixture MARKET")
+    for fixture_name, candles in fixtures.items():
+        df = candles_to_dataframe(FtxClient._parse_candles(candles))
+        data = {column: df[column].values for column in ("open", "high", "low", "close", "volume")}
+        for name, result in hot_path_suite(data, parse_max_size=0).items():
+            results[f"{name}[{fixture_name}]"] = result
+        # Parsing the recorded response itself, not one rebuilt from its candles
+        results[f"candle_parsing[{fixture_name}]"] = measure(
+            lambda: candles_to_dataframe(FtxClient._parse_candles(candles)), len(candles))
+    return results
+
+
+def print_results(results: Dict[str, BenchmarkResult]) -> None:
+    for name, result in results.items():
+        print(f"{name:<45} {result.seconds * 1e3:12.2f} ms {result.bars_per_s:16,.0f} bars/s "
+              f"{result.peak_mb:10.1f} MB peak")
+
+
+def environment() -> dict:
+    # Numbers from another machine or library version are not comparable
+    return {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "numba": getattr(spt._supertrend_loop, "py_func", None) is not None, "machine": platform.machine(),
+            "processor": platform.processor(), "cpus": os.cpu_count()}
+
+
+def save_baseline(results: Dict[str, BenchmarkResult], filepath: str) -> None:
+    baseline = {"created": time.time(), "environment": environment(),
+                "results": {name: result._asdict() for name, result in results.items()}}
+    with open(filepath, "w") as json_file:
+        json.dump(baseline, json_file, indent=2)
+
+
+def compare_to_baseline(results: Dict[str, BenchmarkResult], filepath: str, tolerance: float = 0.2,
+                        min_memory_mb: float = 1.) -> List[Tuple[str, str]]:
+    # Regressions are throughput down or peak memory up by more than tolerance, small allocations are noise
+    with open(filepath) as json_file:
+        baseline = json.load(json_file)
+    if baseline["environment"] != environment():
+        print(f"Baseline was recorded on {baseline['environment']}, numbers may not be comparable")
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            continue
+        base = BenchmarkResult(**baseline["results"][name])
+        speed = result.bars_per_s / base.bars_per_s
+        flags = []
+        if speed < 1 - tolerance:
+            flags.append(f"throughput {speed - 1:+.0%}")
+        if result.peak_mb > max(base.peak_mb * (1 + tolerance), base.peak_mb + min_memory_mb):
+            flags.append(f"peak memory {base.peak_mb:.1f} -> {result.peak_mb:.1f} MB")
+        print(f"{name:<45} {speed - 1:+8.0%} bars/s {result.peak_mb - base.peak_mb:+10.1f} MB "
+              f"{'REGRESSION: ' + ', '.join(flags) if flags else 'ok'}")
+        regressions.extend((name, flag) for flag in flags)
+
+    missing = set(baseline["results"]) - set(results)
+    if missing:
+        print(f"Not run, but in the baseline: {sorted(missing)}")
+    return regressions
+
+
+def main_suite(args: argparse.Namespace) -> Optional[int]:
+    if args.record_fixture:
+        # Candles are public, no API key needed
+        ftx = FtxClient(api_key="", api_secret="")
+        start_time = int(str_to_datetime(f"{args.fixture_days} days ago").timestamp())
+        for market in args.record_fixture:
+            filepath = record_candle_fixture(ftx, market, args.fixture_resolution, start_time, args.fixture_folder)
+            print(f"Recorded {filepath}")
+        print(f"Recorded {record_markets_fixture(ftx, args.record_fixture, args.fixture_folder)}")
+        return None
+
+    results = run_suite(args.sizes, seed=args.seed, fixture_folder=args.fixture_folder)
+    print_results(results)
+    if args.save_baseline:
+        save_baseline(results, args.save_baseline)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.baseline:
+        regressions = compare_to_baseline(results, args.baseline, tolerance=args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions against {args.baseline}")
+            return 1
+    return None
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark the supertrend hot paths on synthetic candles")
+    arg_parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 100_000, 1_000_000])
+    arg_parser.add_argument("--suite", action="store_true",
+                            help="Track bars/s and peak memory of the hot paths instead of the speedup comparisons")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--save-baseline", metavar="FILE", help="Save the suite results as a baseline JSON")
+    arg_parser.add_argument("--baseline", metavar="FILE", help="Compare the suite results to a baseline JSON")
+    arg_parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed fraction of slowdown/growth")
+    arg_parser.add_argument("--record-fixture", metavar="MARKET", nargs="+",
+                            help="Record the candles of markets from FTX as offline fixtures (needs network)")
+    arg_parser.add_argument("--fixture-resolution", type=int, default=14400)
+    arg_parser.add_argument("--fixture-days", type=int, default=100)
+    arg_parser.add_argument("--fixture-folder", default=FIXTURE_FOLDER)
+    args = arg_parser.parse_args()
+
+    if args.suite or args.save_baseline or args.baseline or args.record_fixture:
+        sys.exit(main_suite(args))
+
+    bench_supertrend_kernel(args.sizes)
+    bench_supertrend_signals(args.sizes)
+    bench_backtest_positions(args.sizes)
+    bench_optimize_grid()
+    bench_candle_parsing([1_500, 50_000, 500_000])
+    bench_portfolio()
@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+from candle_store import CANDLE_COLUMNS
+from ftx_client import FtxClient, candle_resolution, str_to_datetime
+
+logger = logging.getLogger(__name__)
+
+PANEL_COLUMNS = CANDLE_COLUMNS[1:]
+
+
+class CandlePanel:
+    """
+    Candles of many markets on one time axis, stored in a folder as a memory-mapped (markets x bars x OHLCV)
+    array (candles.npy), the bar open times in epoch seconds (times.npy) and the market names and first/last
+    bar of every market (meta.json). Gaps inside a market's range are filled with its previous close and zero
+    volume, bars outside of it are NaN. frame() returns a DataFrame over a slice of the map without copying,
+    so backtest_dataframe/optimize_m_l run directly on it and every process opening the folder shares the
+    same pages.
+    """
+
+    def __init__(self, folder_path: str, mode: str = "r") -> None:
+        self.folder_path = folder_path
+        with open(os.path.join(folder_path, "meta.json")) as json_file:
+            meta = json.load(json_file)
+        self.markets = meta["markets"]
+        self.resolution = meta["resolution"]
+        self._first = np.array(meta["first"], dtype=np.int64)
+        self._last = np.array(meta["last"], dtype=np.int64)
+        self._market_idx = {market: idx for idx, market in enumerate(self.markets)}
+        self.times = np.load(os.path.join(folder_path, "times.npy"))
+        self.candles = np.load(os.path.join(folder_path, "candles.npy"), mmap_mode=mode)
+        self._index = None
+
+    @classmethod
+    def create(cls, folder_path: str, markets: list, start_time: float, end_time: float, resolution: int,
+               dtype: str = "float64") -> "CandlePanel":
+        # An empty panel of NaN bars from start_time to end_time, filled market by market with write()
+        os.makedirs(folder_path, exist_ok=True)
+        start_time = int(start_time // resolution * resolution)
+        times = np.arange(start_time, int(end_time) + 1, resolution, dtype=np.int64)
+
+        np.save(os.path.join(folder_path, "times.npy"), times)
+        candles = open_memmap(os.path.join(folder_path, "candles.npy"), mode="w+", dtype=np.dtype(dtype),
+                              shape=(len(markets), len(times), len(PANEL_COLUMNS)))
+        candles[:] = np.nan
+        del candles
+        meta = {"markets": list(markets), "resolution": resolution, "first": [0] * len(markets),
+                "last": [-1] * len(markets)}
+        with open(os.path.join(folder_path, "meta.json"), "w") as json_file:
+            json.dump(meta, json_file)
+        return cls(folder_path, mode="r+")
+
+    def write(self, market: str, df: pd.DataFrame) -> int:
+        # Place a market's candles on the time axis, returns the number of bars written
+        idx = self._market_idx[market]
+        times = df.index.values.astype("datetime64[s]").astype(np.int64)
+        bars = (times - self.times[0]) // self.resolution
+        on_axis = (bars >= 0) & (bars < len(self.times))
+        if not on_axis.any():
+            return 0
+        bars = bars[on_axis]
+        first, last = int(bars[0]), int(bars[-1])
+
+        block = np.full((last - first + 1, len(PANEL_COLUMNS)), np.nan)
+        block[bars - first] = df[PANEL_COLUMNS].values[on_axis]
+        missing = np.isnan(block[:, PANEL_COLUMNS.index("close")])
+        if missing.any():
+            previous = np.maximum.accumulate(np.where(~missing, np.arange(len(block)), 0))
+            close = block[previous, PANEL_COLUMNS.index("close")]
+            block[missing, :4] = close[missing, np.newaxis]
+            block[missing, 4] = 0
+
+        self.candles[idx, first:last + 1] = block
+        self._first[idx], self._last[idx] = first, last
+        return len(bars)
+
+    def flush(self) -> None:
+        self.candles.flush()
+        meta = {"markets": self.markets, "resolution": self.resolution, "first": self._first.tolist(),
+                "last": self._last.tolist()}
+        with open(os.path.join(self.folder_path, "meta.json.tmp"), "w") as json_file:
+            json.dump(meta, json_file)
+        os.replace(os.path.join(self.folder_path, "meta.json.tmp"), os.path.join(self.folder_path, "meta.json"))
+
+    def __contains__(self, market: str) -> bool:
+        return market in self._market_idx and self._last[self._market_idx[market]] >= 0
+
+    def __len__(self) -> int:
+        return len(self.markets)
+
+    @property
+    def index(self) -> pd.DatetimeIndex:
+        if self._index is None:
+            self._index = pd.to_datetime(self.times, unit="s", utc=True).rename("time")
+        return self._index
+
+    def frame(self, market: str, start: Optional[int] = None, end: Optional[int] = None) -> pd.DataFrame:
+        idx = self._market_idx[market]
+        lo, hi = slice(start, end).indices(self._last[idx] - self._first[idx] + 1)[:2]
+        bars = slice(self._first[idx] + lo, self._first[idx] + max(lo, hi))
+        return pd.DataFrame(self.candles[idx, bars], index=self.index[bars], columns=PANEL_COLUMNS, copy=False)
+
+
+def build_candle_panel(ftx: FtxClient, folder_path: str, markets: list, interval: str, start_time: str,
+                       dtype: str = "float64") -> CandlePanel:
+    # One market in memory at a time, with a candle store a rebuild only downloads the newest candles
+    resolution = candle_resolution(interval)
+    start = str_to_datetime(start_time).timestamp()
+    panel = CandlePanel.create(folder_path, markets, start, time.time() - resolution, resolution, dtype=dtype)
+    for count, market in enumerate(markets):
+        try:
+            df = ftx.get_historical_market_data(market, interval=interval, start_time=start_time)
+        except Exception as exc:
+            logger.error(f"{market}: {exc}")
+            continue
+        bars = panel.write(market, df)
+        logger.info(f"({count + 1}/{len(markets)}) {market}: {bars} bars")
+    panel.flush()
+    return panel
@@ -0,0 +1,100 @@
+import os
+import tempfile
+from typing import BinaryIO, Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+CANDLE_COLUMNS = ["time", "open", "high", "low", "close", "volume"]
+
+
+def candles_to_dataframe(candles: np.ndarray) -> pd.DataFrame:
+    # candles is a (n, 6) float64 block in CANDLE_COLUMNS order, time in epoch seconds
+    index = pd.to_datetime(candles[:, 0], unit="s", utc=True).rename("time")
+    return pd.DataFrame(np.array(candles[:, 1:], dtype=np.float64), index=index, columns=CANDLE_COLUMNS[1:])
+
+
+class CandleStore:
+    """
+    On-disk cache of candles, one memory-mappable .npy file per (market, resolution).
+    Each file holds a (n, 6) float64 array in CANDLE_COLUMNS order sorted by time, so only candles newer than
+    the last stored one have to be requested from the exchange. For markets listed after the requested start
+    time a .first file next to it holds the time of the exchange's first candle.
+    """
+
+    def __init__(self, folder_path: str) -> None:
+        self.folder_path = folder_path
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+
+    def _filepath(self, market: str, resolution: int) -> str:
+        return os.path.join(self.folder_path, f"{market.replace('/', '_')}_{resolution}.npy")
+
+    def _first_filepath(self, market: str, resolution: int) -> str:
+        return os.path.join(self.folder_path, f"{market.replace('/', '_')}_{resolution}.first")
+
+    def load(self, market: str, resolution: int) -> Optional[np.ndarray]:
+        filepath = self._filepath(market, resolution)
+        if not os.path.exists(filepath):
+            return None
+        return np.load(filepath, mmap_mode="r")
+
+    def _write_atomic(self, filepath: str, write: Callable[[BinaryIO], None]) -> None:
+        # Write to a uniquely named temporary file first so readers never see a half written file and
+        # concurrent writes of the same market don't write into each other's file
+        fd, tmp_filepath = tempfile.mkstemp(dir=self.folder_path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                write(tmp_file)
+            os.replace(tmp_filepath, filepath)
+        except BaseException:
+            os.remove(tmp_filepath)
+            raise
+
+    def save(self, market: str, resolution: int, candles: np.ndarray) -> None:
+        self._write_atomic(self._filepath(market, resolution),
+                           lambda npy_file: np.save(npy_file, np.ascontiguousarray(candles, dtype=np.float64)))
+
+    def first_time(self, market: str, resolution: int) -> Optional[float]:
+        # Time of the exchange's first candle, if the market was found to be listed after a requested start time
+        filepath = self._first_filepath(market, resolution)
+        if not os.path.exists(filepath):
+            return None
+        with open(filepath) as first_file:
+            return float(first_file.read())
+
+    def set_first_time(self, market: str, resolution: int, first_time: float) -> None:
+        self._write_atomic(self._first_filepath(market, resolution),
+                           lambda first_file: first_file.write(repr(float(first_time)).encode()))
+
+    def last_time(self, market: str, resolution: int) -> Optional[float]:
+        candles = self.load(market, resolution)
+        if candles is None or len(candles) == 0:
+            return None
+        return float(candles[-1, 0])
+
+    def covers(self, market: str, resolution: int, start_time: float) -> bool:
+        # A market listed after start_time is covered from its first candle on, there is nothing older to fetch
+        candles = self.load(market, resolution)
+        if candles is None or len(candles) == 0:
+            return False
+        return candles[0, 0] < start_time + resolution or candles[0, 0] == self.first_time(market, resolution)
+
+    def joins(self, market: str, resolution: int, candles: np.ndarray) -> bool:
+        # Whether candles continue the stored ones without a gap
+        stored = self.load(market, resolution)
+        return stored is None or len(stored) == 0 or len(candles) == 0 or \
+            candles[0, 0] <= stored[-1, 0] + resolution
+
+    def merge(self, market: str, resolution: int, candles: np.ndarray) -> np.ndarray:
+        stored = self.load(market, resolution)
+        if len(candles) == 0:
+            return stored if stored is not None else candles
+
+        if stored is not None and len(stored) > 0 and candles[0, 0] <= stored[-1, 0] + resolution:
+            # New candles replace stored ones from their first timestamp on (the last stored candle may have
+            # been incomplete), anything older is kept. A non-contiguous update replaces the file instead, callers
+            # refetch the whole range rather than merge a delta that doesn't join (see FtxClient._candle_response).
+            candles = np.concatenate((stored[stored[:, 0] < candles[0, 0]], candles))
+        self.save(market, resolution, candles)
+        return candles
@@ -0,0 +1,240 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import aiohttp
+import pandas as pd
+from ciso8601 import parse_datetime
+
+from supertrend import SupertrendState
+
+logger = logging.getLogger(__name__)
+
+BarCallback = Callable[[str, dict], None]
+
+
+class BarAggregator:
+    """
+    Builds OHLCV bars of resolution seconds from the trades of many markets and hands every closed bar to
+    on_bar_close(market, bar). A bar is closed by the first trade of a later bar or by close_due() once its end
+    has passed, bars without trades are emitted flat at the previous close with zero volume, so every market gets
+    exactly one bar per period. Bars that started before `partial_before` (the stream (re)connected while they
+    were open) are flagged partial since trades of them may be missing. It is infinite while the stream is down,
+    the bars closed on time meanwhile are flagged partial too.
+    """
+
+    def __init__(self, resolution: int, on_bar_close: BarCallback) -> None:
+        self.resolution = resolution
+        self.on_bar_close = on_bar_close
+        self.partial_before = 0.
+        self.late_trades = 0
+        self._bars = {}
+        self._last_close = {}
+        self._next_start = {}
+
+    def add_trade(self, market: str, price: float, size: float, timestamp: float) -> None:
+        start = timestamp // self.resolution * self.resolution
+        next_start = self._next_start.setdefault(market, start)
+        if start < next_start:
+            # The bar of this trade was already emitted
+            self.late_trades += 1
+            return
+        self._emit_until(market, start)
+
+        bar = self._bars.get(market)
+        if bar is None:
+            self._bars[market] = [start, price, price, price, price, size]
+        else:
+            bar[2] = max(bar[2], price)
+            bar[3] = min(bar[3], price)
+            bar[4] = price
+            bar[5] += size
+
+    def close_due(self, now: float) -> None:
+        boundary = now // self.resolution * self.resolution
+        for market in list(self._next_start):
+            self._emit_until(market, boundary)
+
+    def _emit_until(self, market: str, boundary: float) -> None:
+        next_start = self._next_start[market]
+        while next_start < boundary:
+            bar = self._bars.get(market)
+            if bar is not None and bar[0] == next_start:
+                del self._bars[market]
+                start, open_, high, low, close, volume = bar
+            elif market in self._last_close:
+                start, open_, high, low, close, volume = (next_start,) + (self._last_close[market],) * 4 + (0.,)
+            else:
+                # No trade yet, nothing to carry forward
+                next_start = boundary
+                break
+            self._last_close[market] = close
+            next_start += self.resolution
+            self._next_start[market] = next_start
+            self.on_bar_close(market, {"time": start, "open": open_, "high": high, "low": low, "close": close,
+                                       "volume": volume, "partial": start < self.partial_before})
+        self._next_start[market] = next_start
+
+
+class CandleStream:
+    """
+    Streams the trades (or ticker) channel of the FTX websocket for the given markets into a BarAggregator and
+    closes all bars on a timer at every bar boundary plus `grace` seconds, so on_bar_close fires right after the
+    candle close even for markets without trades. Runs its own event loop in a daemon thread, pings every
+    ping_interval seconds and reconnects with exponential backoff.
+    """
+
+    def __init__(self, markets: List[str], resolution: int, on_bar_close: BarCallback,
+                 endpoint: str = "wss://ftx.com/ws/", channel: str = "trades", grace: float = 0.25,
+                 ping_interval: float = 15, max_reconnect_delay: float = 30) -> None:
+        if channel not in ("trades", "ticker"):
+            raise ValueError(f"Use the trades or ticker channel, not {channel}")
+        self.markets = markets
+        self.endpoint = endpoint
+        self.channel = channel
+        self.grace = grace
+        self.ping_interval = ping_interval
+        self.max_reconnect_delay = max_reconnect_delay
+        self.aggregator = BarAggregator(resolution, on_bar_close)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(target=lambda: asyncio.run(self.run()), name="candle-stream", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.ping_interval + 1)
+            self._thread = None
+
+    async def run(self) -> None:
+        timer = asyncio.ensure_future(self._close_bars_on_time())
+        try:
+            await self._listen()
+        finally:
+            timer.cancel()
+
+    async def _close_bars_on_time(self) -> None:
+        resolution = self.aggregator.resolution
+        while not self._stopped.is_set():
+            now = time.time()
+            await asyncio.sleep((now // resolution + 1) * resolution + self.grace - now)
+            self.aggregator.close_due(time.time() - self.grace)
+
+    async def _listen(self) -> None:
+        delay = 1
+        while not self._stopped.is_set():
+            try:
+                async with aiohttp.ClientSession() as session, session.ws_connect(self.endpoint) as ws:
+                    for market in self.markets:
+                        await ws.send_json({"op": "subscribe", "channel": self.channel, "market": market})
+                    # Trades of the bars open right now may have been missed while disconnected
+                    self.aggregator.partial_before = time.time()
+                    await self._receive(ws)
+                    delay = 1
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as exc:
+                logger.warning(f"Candle stream error: {exc}")
+            except Exception as exc:
+                # A failing callback must not end the stream
+                logger.error(f"Candle stream message handling failed: {exc}")
+            # Until resubscribed every bar misses trades, the timer mustn't close them as complete
+            self.aggregator.partial_before = math.inf
+
+            if not self._stopped.is_set():
+                logger.info(f"Candle stream disconnected, reconnecting in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def _receive(self, ws: aiohttp.ClientWebSocketResponse) -> None:
+        while not self._stopped.is_set():
+            try:
+                msg = await ws.receive(timeout=self.ping_interval)
+            except asyncio.TimeoutError:
+                await ws.send_json({"op": "ping"})
+                continue
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                return
+
+            message = json.loads(msg.data)
+            if message["type"] == "update":
+                self._on_update(message["market"], message["data"])
+            elif message["type"] == "error":
+                logger.error(f"Candle stream error message: {message}")
+
+    def _on_update(self, market: str, data) -> None:
+        if self.channel == "trades":
+            for trade in data:
+                self.aggregator.add_trade(market, trade["price"], trade["size"],
+                                          parse_datetime(trade["time"]).timestamp())
+        elif data.get("last") is not None:
+            self.aggregator.add_trade(market, data["last"], 0., data["time"])
+
+
+class StreamingSignals:
+    """
+    Applies every closed bar to the market's SupertrendState and calls on_signal(market, result) when it flips
+    the supertrend. Bars already in the state's history are skipped. A partial bar is replaced by the exchange's
+    candles from backfill(market), which should return recent history as a DataFrame, when one is given.
+    on_bar_close is called on the stream's event loop, so a bar needing the blocking backfill is applied in a
+    worker thread instead. Later bars of that market queue up behind it in the same worker until it is done, every
+    market's bars are applied in order.
+    """
+
+    def __init__(self, states: Dict[str, SupertrendState], on_signal: Callable[[str, dict], None],
+                 backfill: Optional[Callable[[str], pd.DataFrame]] = None) -> None:
+        self.states = states
+        self.on_signal = on_signal
+        self.backfill = backfill
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="backfill")
+        self._lock = threading.Lock()
+        # Last bar of each market handed to the worker and not applied yet
+        self._pending = {}
+
+    def on_bar_close(self, market: str, bar: dict) -> None:
+        if market not in self.states:
+            return
+        with self._lock:
+            queued = self.backfill is not None and (bar["partial"] or market in self._pending)
+            if queued:
+                future = self._pending[market] = self._executor.submit(self._apply, market, bar)
+        if not queued:
+            self._apply(market, bar)
+            return
+        future.add_done_callback(lambda done: self._applied(market, done))
+
+    def stop(self) -> None:
+        # Waits for the bars still queued
+        self._executor.shutdown(wait=True)
+
+    def _applied(self, market: str, future: concurrent.futures.Future) -> None:
+        with self._lock:
+            if self._pending.get(market) is future:
+                del self._pending[market]
+        if future.exception() is not None:
+            logger.error(f"{market}: applying a bar failed: {future.exception()}")
+
+    def _apply(self, market: str, bar: dict) -> None:
+        state = self.states[market]
+        bar_time = pd.Timestamp(bar["time"], unit="s", tz="UTC")
+        if state.last_time is not None and bar_time <= pd.Timestamp(state.last_time):
+            return
+
+        results = []
+        if bar["partial"] and self.backfill is not None:
+            df = self.backfill(market)
+            results = state.update_from_dataframe(df[df.index <= bar_time])
+        if state.last_time is None or pd.Timestamp(state.last_time) < bar_time:
+            # Not partial, or the exchange doesn't have the candle yet
+            results.append(state.update(bar["high"], bar["low"], bar["close"], time=bar_time))
+
+        for result in results:
+            if result["st_signal"] != 0:
+                self.on_signal(market, result)
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import matplotlib.dates as mdates
+import matplotlib.pyplot as plt
+import pandas as pd
+
+from instrumentation import metrics
+
+CHART_COLUMNS = ["close", "ema200", "st", "short_trig", "long_trig", "vol_ema200"]
+
+
+def chart_path(folder_path: str, market: str, df: pd.DataFrame, params: dict, fmt: str = "jpg") -> str:
+    # A chart only changes with a new candle or new parameters, so both are part of its file name
+    params_hash = hashlib.md5(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:8]
+    filename = f"{market.replace('/', '_')}_{df.index[-1]:%Y%m%d%H%M}_{params_hash}.{fmt}"
+    return os.path.join(folder_path, filename)
+
+
+class ChartRenderer:
+    """
+    Draws the supertrend chart of a market onto a single figure that is cleared and reused for every chart, and
+    saves it under its chart_path. Charts that already exist on disk are not drawn again.
+    """
+
+    def __init__(self, folder_path: str, dpi: int = 300, fmt: str = "jpg") -> None:
+        self.folder_path = folder_path
+        self.dpi = dpi
+        self.fmt = fmt
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        self.fig, (self.ax, self.ax1) = plt.subplots(nrows=2, sharex="all", gridspec_kw={'height_ratios': [3, 1]})
+        plt.close(self.fig)
+
+    @metrics.timed("render_chart")
+    def render(self, market: str, df: pd.DataFrame, params: dict) -> str:
+        figure_path = chart_path(self.folder_path, market, df, params, self.fmt)
+        if os.path.exists(figure_path):
+            return figure_path
+
+        ax, ax1 = self.ax, self.ax1
+        ax.cla()
+        ax1.cla()
+
+        ax.plot(df.index, df.close, ".-", color="tab:blue")
+        ax.plot(df.index, df.ema200, color="tab:orange")
+        ax.plot(df.index, df.st, color="tab:gray")
+
+        ax.plot(df.index, df.short_trig, marker='^', color='tab:red', markersize=8, linewidth=0, label='Short')
+        ax.plot(df.index, df.long_trig, marker='v', color='tab:green', markersize=8, linewidth=0, label='Long')
+
+        ax1.plot(df.index, df.vol_ema200, color="tab:orange")
+
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%b-%d %H:%m'))
+        self.fig.autofmt_xdate()
+
+        params_text = " ".join(f"{key}={val:.2f}" if isinstance(val, float) else f"{key}={val}"
+                               for key, val in params.items())
+        ax.set_title(f"{market} ({params_text})")
+        ax.legend()
+
+        # Written to a uniquely named temporary file first, other processes may be serving or rendering the same
+        # chart in this folder
+        fd, tmp_filepath = tempfile.mkstemp(dir=self.folder_path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as figure_file:
+                self.fig.savefig(figure_file, dpi=self.dpi, format=self.fmt)
+            os.replace(tmp_filepath, figure_path)
+        except BaseException:
+            os.remove(tmp_filepath)
+            raise
+        return figure_path
+
+
+_renderer = None
+
+
+def prune_charts(folder_path: str, max_age: float, fmt: str = "jpg") -> None:
+    if not os.path.exists(folder_path):
+        return
+    now = time.time()
+    for filename in os.listdir(folder_path):
+        filepath = os.path.join(folder_path, filename)
+        if filename.endswith(f".{fmt}") and now - os.path.getmtime(filepath) > max_age:
+            os.remove(filepath)
+
+
+def _init_worker(folder_path: str, dpi: int, fmt: str) -> None:
+    global _renderer
+    _renderer = ChartRenderer(folder_path, dpi=dpi, fmt=fmt)
+
+
+def _render(market: str, df: pd.DataFrame, params: dict) -> str:
+    return _renderer.render(market, df, params)
+
+
+class RenderQueue:
+    """
+    Renders charts in a background process with its own persistent ChartRenderer. Submitting a chart that is
+    already rendered or queued returns the existing result instead of drawing it again.
+    """
+
+    def __init__(self, folder_path: str, dpi: int = 300, fmt: str = "jpg") -> None:
+        self.folder_path = folder_path
+        self.fmt = fmt
+        self._pool = ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(folder_path, dpi, fmt))
+        self._pending = {}
+
+    def submit(self, market: str, df: pd.DataFrame, params: dict) -> Future:
+        figure_path = chart_path(self.folder_path, market, df, params, self.fmt)
+        if figure_path in self._pending:
+            return self._pending[figure_path]
+
+        if os.path.exists(figure_path):
+            future = Future()
+            future.set_result(figure_path)
+        else:
+            future = self._pool.submit(_render, market, df[CHART_COLUMNS], params)
+        self._pending[figure_path] = future
+        return future
+
+    def prune(self, max_age: float) -> None:
+        # Charts of older candles are never requested again
+        self._pending = {path: future for path, future in self._pending.items() if not future.done()}
+        prune_charts(self.folder_path, max_age, self.fmt)
+
+    def close(self) -> None:
+        self._pool.shutdown()
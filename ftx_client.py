@@ -1,18 +1,32 @@
 import datetime
+import decimal
 import hmac
+import itertools
+import operator
+import threading
 import time
 import urllib.parse
-from typing import Optional, Dict, Any, List, Tuple
+import concurrent.futures
+from concurrent.futures import Future
+from typing import Optional, Dict, Any, List, Tuple, TYPE_CHECKING
 
+import numpy as np
 import pandas as pd
 from ciso8601 import parse_datetime
-from dateutil import parser
 from dateutil.relativedelta import relativedelta
 from requests import Request, Session, Response
 
+from candle_store import CANDLE_COLUMNS, CandleStore, candles_to_dataframe
+from instrumentation import endpoint_name, metrics
 
-def str_to_datetime(str_days_ago: str) -> datetime.datetime:
-    now = datetime.datetime.now()
+if TYPE_CHECKING:
+    # Only for annotations, order_tracker needs aiohttp which the REST client doesn't
+    from order_tracker import OrderTracker
+
+
+def str_to_datetime(str_days_ago: str, now: Optional[datetime.datetime] = None) -> datetime.datetime:
+    if now is None:
+        now = datetime.datetime.now()
     split_string = str_days_ago.split()
     if len(split_string) == 1 and split_string[0].lower() == 'today':
         return now
@@ -20,10 +34,10 @@ def str_to_datetime(str_days_ago: str) -> datetime.datetime:
         date = now - relativedelta(days=1)
         return date
     elif split_string[1].lower() in ['moinute', 'minutes', 'mins']:
-        date = datetime.datetime.now() - relativedelta(minutes=int(split_string[0]))
+        date = now - relativedelta(minutes=int(split_string[0]))
         return date
     elif split_string[1].lower() in ['hour', 'hours', 'hr', 'hrs', 'h']:
-        date = datetime.datetime.now() - relativedelta(hours=int(split_string[0]))
+        date = now - relativedelta(hours=int(split_string[0]))
         return date
     elif split_string[1].lower() in ['day', 'days', 'd']:
         date = now - relativedelta(days=int(split_string[0]))
@@ -55,14 +69,41 @@ def interval_to_seconds_converter(interval: str) -> int:
         raise ValueError("Invalid interval format: Use 's', 'm', 'h' or 'd'")
 
 
+CANDLE_RESOLUTIONS = {"15s": 15, "1m": 60, "5m": 300, "15m": 900, "1h": 3600, "4h": 14400, "1d": 86400}
+
+
+def candle_resolution(interval: str) -> int:
+    if interval in CANDLE_RESOLUTIONS:
+        return CANDLE_RESOLUTIONS[interval]
+    raise ValueError(f"Use a valid time interval: {CANDLE_RESOLUTIONS.keys()}")
+
+
 class FtxClient:
     _ENDPOINT = 'https://ftx.com/api/'
 
-    def __init__(self, api_key=None, api_secret=None, subaccount_name=None) -> None:
+    def __init__(self, api_key=None, api_secret=None, subaccount_name=None,
+                 candle_store: Optional[CandleStore] = None, market_ttl: float = 3600, quote_ttl: float = 1,
+                 order_tracker: Optional["OrderTracker"] = None) -> None:
         self._session = Session()
         self._api_key = api_key
         self._api_secret = api_secret
         self._subaccount_name = subaccount_name
+        self._candle_store = candle_store
+        # With an order tracker positions come from its fills feed instead of polling get_positions
+        self._order_tracker = order_tracker
+        # Market metadata (increments, leverage) rarely changes and is refreshed every market_ttl seconds, the top
+        # of the book is reused for quote_ttl seconds
+        self._market_ttl = market_ttl
+        self._quote_ttl = quote_ttl
+        self._markets = {}
+        self._markets_updated = None
+        self._leverage = None
+        self._leverage_updated = None
+        self._quotes = {}
+
+    def _now(self) -> datetime.datetime:
+        # Relative start times like "100 days ago" count back from here
+        return datetime.datetime.now()
 
     def _get(self, path: str, params: Optional[Dict[str, Any]] = None) -> Any:
         return self._request('GET', path, params=params)
@@ -76,7 +117,13 @@ class FtxClient:
     def _request(self, method: str, path: str, **kwargs) -> Any:
         request = Request(method, self._ENDPOINT + path, **kwargs)
         self._sign_request(request)
-        response = self._session.send(request.prepare())
+        if not metrics.enabled:
+            return self._process_response(self._session.send(request.prepare()))
+
+        with metrics.timer(f"api:{endpoint_name(path)}"):
+            response = self._session.send(request.prepare())
+        metrics.count("api_calls")
+        metrics.count("bytes_downloaded", len(response.content))
         return self._process_response(response)
 
     def _sign_request(self, request: Request) -> None:
@@ -100,9 +147,13 @@ class FtxClient:
             response.raise_for_status()
             raise
         else:
-            if not data['success']:
-                raise Exception(data['error'])
-            return data['result']
+            return FtxClient._process_data(data)
+
+    @staticmethod
+    def _process_data(data: dict) -> Any:
+        if not data['success']:
+            raise Exception(data['error'])
+        return data['result']
 
     def list_futures(self) -> List[dict]:
         return self._get('futures')
@@ -120,7 +171,7 @@ class FtxClient:
         return self._get(f'account')
 
     def get_last_funding_rate(self, market: str) -> dict:
-        start_time = int(round((datetime.datetime.now() - datetime.timedelta(hours=1)).timestamp()))
+        start_time = int(round((self._now() - datetime.timedelta(hours=1)).timestamp()))
         return self._get(f"funding_rates", {"future": market, "start_time": start_time})[0]["rate"]
 
     def get_historical_prices(self, market: str, resolution: int, start_time: int) -> dict:
@@ -244,28 +295,62 @@ class FtxClient:
 
     # Additional functions
 
-    def get_historical_market_data(self, market: str, interval: str, start_time: str) -> pd.DataFrame:
-        interval_to_seconds = {"15s": 15, "1m": 60, "5m": 300, "15m": 900, "1h": 3600, "4h": 14400, "1d": 86400}
-
-        if interval in interval_to_seconds:
-            resolution = interval_to_seconds[interval]
-        else:
-            raise ValueError(f"Use a valid time interval: {interval_to_seconds.keys()}")
-
-        start_time = int(datetime.datetime.timestamp(str_to_datetime(start_time)))
-
-        data = self.get_historical_prices(market, resolution, start_time)
-
-        df = pd.DataFrame(columns=['time', 'open', 'high', 'low', 'close', 'volume'])
-
-        for idx, item in enumerate(data):
-            df.loc[idx] = [parser.parse(item["startTime"]), item["open"], item["high"], item["low"], item["close"],
-                           item["volume"]]
+    @staticmethod
+    def _parse_candles(data: List[dict]) -> np.ndarray:
+        # One (n, 6) float64 block in CANDLE_COLUMNS order, filled straight from the JSON list without
+        # intermediate rows, time as epoch seconds
+        if data and "time" not in data[0]:
+            data = [dict(item, time=parse_datetime(item["startTime"]).timestamp() * 1000) for item in data]
+        values = itertools.chain.from_iterable(map(operator.itemgetter(*CANDLE_COLUMNS), data))
+        candles = np.fromiter(values, dtype=np.float64, count=len(data) * len(CANDLE_COLUMNS))
+        candles = candles.reshape(-1, len(CANDLE_COLUMNS))
+        candles[:, 0] /= 1000
+        return candles
+
+    def _candle_request(self, market: str, interval: str, start_time: str) -> Tuple[int, int, int]:
+        resolution = candle_resolution(interval)
+
+        start_time = int(datetime.datetime.timestamp(str_to_datetime(start_time, now=self._now())))
+
+        # Only request candles from the last stored one on, unless the store doesn't reach back far enough
+        fetch_from = start_time
+        if self._candle_store is not None and self._candle_store.covers(market, resolution, start_time):
+            fetch_from = int(self._candle_store.last_time(market, resolution))
+        return resolution, start_time, fetch_from
+
+    def _candle_response(self, market: str, resolution: int, start_time: int, fetch_from: int, data: List[dict]) \
+            -> Optional[pd.DataFrame]:
+        # None if the candles from the last stored one on don't join the stored ones, the whole range has to be
+        # requested again instead of storing them with a gap in between
+        candles = self._parse_candles(data)
+        metrics.count("candles_downloaded", len(candles), market=market)
+        if self._candle_store is not None:
+            if fetch_from != start_time and not self._candle_store.joins(market, resolution, candles):
+                metrics.count("candle_refetches", market=market)
+                return None
+            if fetch_from == start_time and len(candles) > 0 and candles[0, 0] >= start_time + resolution:
+                # The market was listed after start_time, the store covers it from the first candle on
+                self._candle_store.set_first_time(market, resolution, candles[0, 0])
+            candles = self._candle_store.merge(market, resolution, candles)
+            candles = candles[candles[:, 0] >= start_time]
+        return candles_to_dataframe(candles)
 
-        df = df.set_index("time")
+    def get_historical_market_data(self, market: str, interval: str, start_time: str) -> pd.DataFrame:
+        resolution, start_time, fetch_from = self._candle_request(market, interval, start_time)
+        data = self.get_historical_prices(market, resolution, fetch_from)
+        df = self._candle_response(market, resolution, start_time, fetch_from, data)
+        if df is None:
+            data = self.get_historical_prices(market, resolution, start_time)
+            df = self._candle_response(market, resolution, start_time, start_time, data)
         return df
 
+    def _tracking_fills(self) -> bool:
+        return self._order_tracker is not None and self._order_tracker.synced
+
     def check_open_position(self, market: str) -> dict:
+        # The tracker's positions are stale while its feed is down or not resynced yet, REST is used instead
+        if self._tracking_fills():
+            return self._order_tracker.position(market)
         position = self.get_position(market)
         if position is not None:
             if position["size"] != 0:
@@ -291,18 +376,54 @@ class FtxClient:
                     return response["triggerPrice"]
         return 0
 
-    def market_close_and_cancel_orders(self, market: str, side: str, size: float) -> Tuple[bool, dict]:
-        response = self.place_order(market, side=side, size=size, type="market", price=0)
-        self.cancel_orders(market, conditional_orders=True)
-
-        # Wait until position is closed
+    def _wait_position_closed(self, market: str) -> bool:
+        # Polls the position until it is flat, gives up after 5 tries
         idx = 0
         while self.check_open_position(market):
             time.sleep(2)
             idx += 1
             if idx == 5:
+                return False
+        return True
+
+    def _poll_position_closed(self, market: str) -> Future:
+        closed = Future()
+
+        def poll() -> None:
+            try:
+                closed.set_result(self._wait_position_closed(market))
+            except Exception as exc:
+                closed.set_exception(exc)
+
+        threading.Thread(target=poll, name=f"close-{market}", daemon=True).start()
+        return closed
+
+    def market_close(self, market: str, side: str, size: float) -> Tuple[Future, dict]:
+        # Returns right away with a future of whether the position is flat: resolved by the order tracker's fills,
+        # or by polling the REST position without a synced tracker
+        if self._tracking_fills():
+            # Registered before placing the closing order, so its fill can't arrive first
+            closed = self._order_tracker.expect_close(market)
+            response = self.place_order(market, side=side, size=size, type="market", price=0)
+            self.cancel_orders(market, conditional_orders=True)
+            return closed, response
+
+        response = self.place_order(market, side=side, size=size, type="market", price=0)
+        self.cancel_orders(market, conditional_orders=True)
+        return self._poll_position_closed(market), response
+
+    def market_close_and_cancel_orders(self, market: str, side: str, size: float,
+                                       timeout: float = 10) -> Tuple[bool, dict]:
+        if self._tracking_fills():
+            closed, response = self.market_close(market, side, size)
+            try:
+                return closed.result(timeout=timeout), response
+            except concurrent.futures.TimeoutError:
                 return False, response
-        return True, response
+
+        response = self.place_order(market, side=side, size=size, type="market", price=0)
+        self.cancel_orders(market, conditional_orders=True)
+        return self._wait_position_closed(market), response
 
     def get_coin_balance(self, coin: str = "USD") -> float:
         coin_balance = 0
@@ -311,43 +432,100 @@ class FtxClient:
                 coin_balance = float(balance["free"])
         return coin_balance
 
-    def get_size_precision(self, market: str) -> float:
-        order_book = self.get_orderbook(market, depth=1)
-        return len(str(order_book["asks"][0][1]).split(".")[1])
+    @staticmethod
+    def _is_fresh(updated: Optional[float], ttl: float) -> bool:
+        return updated is not None and time.monotonic() - updated < ttl
+
+    def _store_markets(self, markets: List[dict]) -> None:
+        self._markets = {market["name"]: market for market in markets}
+        self._markets_updated = time.monotonic()
+
+    def _market_info_cached(self, market: str) -> bool:
+        return self._is_fresh(self._markets_updated, self._market_ttl) and market in self._markets
+
+    def get_market_info(self, market: str) -> dict:
+        # All markets come with one list_markets request, a market listed after the last refresh triggers another
+        if not self._market_info_cached(market):
+            self._store_markets(self.list_markets())
+        return self._markets[market]
+
+    def get_leverage(self) -> float:
+        if not self._is_fresh(self._leverage_updated, self._market_ttl):
+            self._leverage = self.get_account_info()["leverage"]
+            self._leverage_updated = time.monotonic()
+        return self._leverage
+
+    def _cached_quote(self, market: str) -> Optional[dict]:
+        updated, quote = self._quotes.get(market, (None, None))
+        return quote if self._is_fresh(updated, self._quote_ttl) else None
+
+    def _store_quote(self, market: str, order_book: dict) -> dict:
+        quote = {"bid": float(order_book["bids"][0][0]), "ask": float(order_book["asks"][0][0])}
+        self._quotes[market] = (time.monotonic(), quote)
+        return quote
+
+    def get_quote(self, market: str) -> dict:
+        quote = self._cached_quote(market)
+        if quote is None:
+            quote = self._store_quote(market, self.get_orderbook(market, depth=1))
+        return quote
+
+    @staticmethod
+    def _increment_decimals(increment: float) -> int:
+        # Decimals of an increment like 0.0025, 1e-05, 0.5 or 1.0, from its shortest repr instead of str splitting
+        return max(0, -decimal.Decimal(repr(float(increment))).normalize().as_tuple().exponent)
+
+    @staticmethod
+    def _round_to_increment(value: float, increment: float) -> float:
+        # Orders have to be a multiple of the increment, which isn't always a power of ten
+        return round(round(value / increment) * increment, FtxClient._increment_decimals(increment))
+
+    def get_size_precision(self, market: str) -> int:
+        return self._increment_decimals(self.get_market_info(market)["sizeIncrement"])
+
+    def get_price_precision(self, market: str) -> int:
+        return self._increment_decimals(self.get_market_info(market)["priceIncrement"])
+
+    def round_size(self, market: str, size: float) -> float:
+        return self._round_to_increment(size, self.get_market_info(market)["sizeIncrement"])
 
-    def get_price_precision(self, market: str) -> float:
-        order_book = self.get_orderbook(market, depth=1)
-        return len(str(order_book["asks"][0][0]).split(".")[1])
+    def round_price(self, market: str, price: float) -> float:
+        return self._round_to_increment(price, self.get_market_info(market)["priceIncrement"])
 
     def get_latest_price(self, market: str, side: str) -> float:
-        order_book = self.get_orderbook(market, depth=1)
+        quote = self.get_quote(market)
         if side == "sell":
-            return float(order_book["asks"][0][0])
+            return quote["ask"]
         elif side == "buy":
-            return float(order_book["bids"][0][0])
+            return quote["bid"]
         return 0
 
-    def generate_order_size(self, price: float, market: str, percent: int) -> float:
-        usd_balance = self.get_coin_balance(coin="USD")
-        leverage = self.get_account_info()["leverage"]
+    def _order_size(self, usd_balance: float, leverage: float, price: float, market: str, percent: int) -> float:
         usable_usd_balance = usd_balance * percent / 100 * leverage
-        size_precision = self.get_size_precision(market)
-        size = round(usable_usd_balance / float(price), size_precision)
-        return size
+        return self.round_size(market, usable_usd_balance / float(price))
 
-    def get_stop_loss_price(self, price: float, percent: float, side: str, market: str):
+    def generate_order_size(self, price: float, market: str, percent: int) -> float:
+        return self._order_size(self.get_coin_balance(coin="USD"), self.get_leverage(), price, market, percent)
+
+    @staticmethod
+    def _stop_loss_price(price: float, percent: float, side: str) -> float:
         if side == "sell":
-            sl_price = price + price * percent / 100
+            return price + price * percent / 100
         elif side == "buy":
-            sl_price = price - price * percent / 100
-        return round(sl_price, self.get_price_precision(market))
+            return price - price * percent / 100
 
-    def get_take_profit_price(self, price: float, percent: float, side: str, market: str):
+    @staticmethod
+    def _take_profit_price(price: float, percent: float, side: str) -> float:
         if side == "sell":
-            tp_price = price - price * percent / 100
+            return price - price * percent / 100
         elif side == "buy":
-            tp_price = price + price * percent / 100
-        return round(tp_price, self.get_price_precision(market))
+            return price + price * percent / 100
+
+    def get_stop_loss_price(self, price: float, percent: float, side: str, market: str):
+        return self.round_price(market, self._stop_loss_price(price, percent, side))
+
+    def get_take_profit_price(self, price: float, percent: float, side: str, market: str):
+        return self.round_price(market, self._take_profit_price(price, percent, side))
 
     @staticmethod
     def _inverse_position(side: str) -> str:
@@ -361,7 +539,10 @@ class FtxClient:
         size = self.generate_order_size(order["entry"], order["market"], percent=account_percent)
         price = self.get_latest_price(order["market"], order["side"])
         stop_loss_price = self.get_stop_loss_price(price, stop_loss_percent, order["side"], order["market"])
+        return self._build_orders(order, price, size, stop_loss_price)
 
+    @staticmethod
+    def _build_orders(order: dict, price: float, size: float, stop_loss_price: float) -> Tuple[dict, dict]:
         order_to_place = {
             "market": order["market"],
             "side": order["side"],
@@ -372,7 +553,7 @@ class FtxClient:
 
         stop_loss_order = {
             "market": order["market"],
-            "side": self._inverse_position(order["side"]),
+            "side": FtxClient._inverse_position(order["side"]),
             "size": size,
             "type": "stop",
             "reduce_only": True,
@@ -0,0 +1,113 @@
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+from talib import EMA, RSI, STOCH
+
+import supertrend as spt
+
+INPUT_COLUMNS = ("open", "high", "low", "close", "volume")
+
+
+class _Indicator:
+    def __init__(self, outputs: Tuple[str, ...], inputs: Tuple[str, ...], func: Callable) -> None:
+        self.outputs = outputs
+        self.inputs = inputs
+        self.func = func
+
+
+def _supertrend(upper_band: np.ndarray, lower_band: np.ndarray, close: np.ndarray) -> np.ndarray:
+    st = spt._supertrend_loop(upper_band[np.newaxis], lower_band[np.newaxis], close)[0]
+    st[:1] = np.nan
+    return st
+
+
+def _st_signal(close: np.ndarray, st: np.ndarray) -> np.ndarray:
+    return spt.supertrend_signals(close, st)[2]
+
+
+def _stoch_rsi(rsi: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    return STOCH(rsi, rsi, rsi, fastk_period=3, slowk_period=3, slowk_matype=0, slowd_period=3, slowd_matype=0)
+
+
+class IndicatorPanel:
+    """
+    All indicators of one market in a single contiguous float64 block, one row per input column or indicator.
+    Indicators are computed on first access, after the ones they depend on (TR -> ATR -> bands -> supertrend ->
+    signals, RSI -> StochRSI), and at most once. Indexing returns read-only views into the block and frame()
+    a DataFrame over the same memory, so the signal, chart and backtest code share one copy of every column.
+    The results are the same as supertrend_analysis, supertrend_signals, calculate_ema and calculate_stoch_rsi.
+    """
+
+    def __init__(self, df: pd.DataFrame, look_back: int, multiplier: float, ema_period: int = 200) -> None:
+        self.index = df.index
+        self.look_back = look_back
+        self.multiplier = multiplier
+        self.ema_period = ema_period
+
+        self.graph = self._build_graph()
+        self.columns = list(INPUT_COLUMNS) + [name for indicator in self.graph.values() for name in indicator.outputs]
+        self._rows = {name: row for row, name in enumerate(self.columns)}
+        self._owner = {name: indicator for indicator in self.graph.values() for name in indicator.outputs}
+
+        self._block = np.full((len(self.columns), len(df)), np.nan)
+        for column in INPUT_COLUMNS:
+            if column in df:
+                self._block[self._rows[column]] = df[column].values
+        self._computed = set(INPUT_COLUMNS)
+
+    def _build_graph(self) -> Dict[str, _Indicator]:
+        look_back, multiplier, ema_period = float(self.look_back), self.multiplier, self.ema_period
+        indicators = [
+            _Indicator(("tr",), ("high", "low", "close"), spt.true_range),
+            _Indicator(("atr",), ("tr",), lambda tr: spt.ewm_mean(tr, look_back)),
+            _Indicator(("hl_avg",), ("high", "low"), lambda high, low: (high + low) / 2),
+            _Indicator(("upper_band",), ("hl_avg", "atr"), lambda hl_avg, atr: hl_avg + multiplier * atr),
+            _Indicator(("lower_band",), ("hl_avg", "atr"), lambda hl_avg, atr: hl_avg - multiplier * atr),
+            _Indicator(("st",), ("upper_band", "lower_band", "close"), _supertrend),
+            _Indicator(("upt",), ("close", "st"), lambda close, st: np.where(close > st, st, np.nan)),
+            _Indicator(("dt",), ("close", "st"), lambda close, st: np.where(close < st, st, np.nan)),
+            _Indicator(("st_signal",), ("close", "st"), _st_signal),
+            _Indicator(("long_trig",), ("close", "st_signal"),
+                       lambda close, st_signal: np.where(st_signal == 1, close, np.nan)),
+            _Indicator(("short_trig",), ("close", "st_signal"),
+                       lambda close, st_signal: np.where(st_signal == -1, close, np.nan)),
+            _Indicator(("ema200",), ("close",), lambda close: EMA(close, timeperiod=ema_period)),
+            _Indicator(("vol_ema200",), ("volume",), lambda volume: EMA(volume, timeperiod=ema_period)),
+            _Indicator(("rsi",), ("close",), lambda close: RSI(close, timeperiod=14)),
+            _Indicator(("slowk", "slowd"), ("rsi",), _stoch_rsi),
+        ]
+        return {indicator.outputs[0]: indicator for indicator in indicators}
+
+    def _row(self, name: str) -> np.ndarray:
+        return self._block[self._rows[name]]
+
+    def compute(self, *names: str) -> None:
+        for name in names:
+            if name in self._computed:
+                continue
+            indicator = self._owner[name]
+            self.compute(*indicator.inputs)
+            results = indicator.func(*(self._row(column) for column in indicator.inputs))
+            if len(indicator.outputs) == 1:
+                results = (results,)
+            for output, result in zip(indicator.outputs, results):
+                self._row(output)[:] = result
+                self._computed.add(output)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        self.compute(name)
+        view = self._row(name)
+        view.flags.writeable = False
+        return view
+
+    def __len__(self) -> int:
+        return self._block.shape[1]
+
+    def series(self, name: str) -> pd.Series:
+        return pd.Series(self[name], index=self.index, name=name, copy=False)
+
+    def frame(self, *names: str) -> pd.DataFrame:
+        # Every column of the block without copying it, the named indicators are computed first
+        self.compute(*names)
+        return pd.DataFrame(self._block.T, index=self.index, columns=self.columns, copy=False)
@@ -0,0 +1,201 @@
+import cProfile
+import functools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+
+class _NullTimer:
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """
+    Timers and counters aggregated per stage and per market. Disabled it does nothing but an attribute check, so
+    the timers can stay on the hot paths. The market of a timer or counter is the one given, or else the one set
+    for the current thread with `market()`. Code running in other processes reports its timings through record().
+    Inside `collect(target)` everything the current thread records goes to the target instance instead, so jobs
+    running in parallel threads keep their metrics apart while the hot paths keep recording to the global one.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            # (stage, market) -> [calls, total seconds, max seconds]
+            self._timers = defaultdict(lambda: [0, 0., 0.])
+            # (name, market) -> value
+            self._counters = defaultdict(float)
+            self._started = time.time()
+
+    def _market(self, market: Optional[str]) -> Optional[str]:
+        return market if market is not None else getattr(self._local, "market", None)
+
+    @contextmanager
+    def market(self, market: str):
+        previous = getattr(self._local, "market", None)
+        self._local.market = market
+        try:
+            yield
+        finally:
+            self._local.market = previous
+
+    @contextmanager
+    def collect(self, target: "Metrics"):
+        previous = getattr(self._local, "target", None)
+        self._local.target = None if target is self else target
+        try:
+            yield
+        finally:
+            self._local.target = previous
+
+    def record(self, stage: str, seconds: float, market: Optional[str] = None) -> None:
+        if not self.enabled:
+            return
+        target = getattr(self._local, "target", None)
+        if target is not None:
+            target.record(stage, seconds, self._market(market))
+            return
+        with self._lock:
+            timer = self._timers[stage, self._market(market)]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def count(self, name: str, value: float = 1, market: Optional[str] = None) -> None:
+        if not self.enabled:
+            return
+        target = getattr(self._local, "target", None)
+        if target is not None:
+            target.count(name, value, self._market(market))
+            return
+        with self._lock:
+            self._counters[name, self._market(market)] += value
+
+    @contextmanager
+    def _timer(self, stage: str, market: Optional[str]):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, market)
+
+    def timer(self, stage: str, market: Optional[str] = None):
+        if not self.enabled:
+            return _NULL_TIMER
+        return self._timer(stage, market)
+
+    def timed(self, stage: str) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self._timer(stage, None):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self) -> dict:
+        with self._lock:
+            timers = {key: list(value) for key, value in self._timers.items()}
+            counters = dict(self._counters)
+
+        stages = defaultdict(lambda: {"calls": 0, "seconds": 0., "max_seconds": 0.})
+        markets = defaultdict(dict)
+        for (stage, market), (calls, total, longest) in timers.items():
+            stages[stage]["calls"] += calls
+            stages[stage]["seconds"] += total
+            stages[stage]["max_seconds"] = max(stages[stage]["max_seconds"], longest)
+            if market is not None:
+                markets[market][stage] = total
+
+        totals = defaultdict(float)
+        for (name, market), value in counters.items():
+            totals[name] += value
+            if market is not None:
+                markets[market][name] = markets[market].get(name, 0) + value
+
+        return {"started": self._started, "duration": time.time() - self._started, "stages": dict(stages),
+                "counters": dict(totals), "markets": dict(markets)}
+
+    def slowest_market(self, stage_prefix: str = "") -> Optional[str]:
+        market_times = defaultdict(float)
+        with self._lock:
+            for (stage, market), (_, total, _) in self._timers.items():
+                if market is not None and stage.startswith(stage_prefix):
+                    market_times[market] += total
+        return max(market_times, key=market_times.get) if market_times else None
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def write_json_line(summary: dict, filepath: str) -> None:
+    # One summary per line, appended so a file holds the history of all cycles
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    with open(filepath, "a") as json_file:
+        json_file.write(json.dumps(summary, default=float) + "\n")
+
+
+def write_prometheus(summary: dict, filepath: str, prefix: str = "supertrend", labels: Optional[dict] = None) -> None:
+    # Prometheus text exposition format for the node exporter textfile collector, replaced atomically. labels are
+    # added to every sample, e.g. the interval when several timeframes report.
+    common = "".join(f',{key}="{value}"' for key, value in (labels or {}).items())
+    lines = [f"# TYPE {prefix}_stage_seconds gauge", f"# TYPE {prefix}_stage_calls gauge"]
+    for stage, values in summary["stages"].items():
+        lines.append(f'{prefix}_stage_seconds{{stage="{stage}"{common}}} {values["seconds"]:.6f}')
+        lines.append(f'{prefix}_stage_calls{{stage="{stage}"{common}}} {values["calls"]}')
+    plain = f"{{{common[1:]}}}" if common else ""
+    for name, value in summary["counters"].items():
+        lines.append(f"{prefix}_{_metric_name(name)}{plain} {value}")
+    lines.append(f"{prefix}_cycle_seconds{plain} {summary['duration']:.6f}")
+
+    folder_path = os.path.dirname(filepath) or "."
+    os.makedirs(folder_path, exist_ok=True)
+    fd, tmp_filepath = tempfile.mkstemp(dir=folder_path, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as prom_file:
+            prom_file.write("\n".join(lines) + "\n")
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.remove(tmp_filepath)
+        raise
+
+
+def profile_call(filepath: str, func: Callable, *args, **kwargs):
+    # Runs func under cProfile and dumps the stats for `python -m pstats` or snakeviz
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(filepath)
+
+
+def endpoint_name(path: str) -> str:
+    # REST path without market names, ids and query, e.g. markets/*/candles
+    segments = ["*" if re.search(r"[A-Z0-9]", segment) else segment for segment in path.split("?")[0].split("/")]
+    return "/".join(segment for idx, segment in enumerate(segments)
+                    if not (segment == "*" and idx > 0 and segments[idx - 1] == "*"))
+
+
+metrics = Metrics()
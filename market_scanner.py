@@ -0,0 +1,175 @@
+import logging
+import multiprocessing
+import time
+from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+
+import pandas as pd
+
+from chart_renderer import CHART_COLUMNS
+from ftx_client import FtxClient, candle_resolution
+from indicator_panel import IndicatorPanel
+from instrumentation import Metrics, metrics, profile_call
+
+logger = logging.getLogger(__name__)
+
+# Spawned analysis workers by their number, starting them takes seconds of imports so the next scans reuse them
+_process_pools = {}
+
+
+def analyse_market(market: str, df: pd.DataFrame, params: dict) -> dict:
+    # CPU bound part of the scan, runs in a worker process and only returns the values the signal handling needs
+    timings = {}
+
+    # Perform supertrend analysis, check 200 EMA for confirmation
+    start = time.perf_counter()
+    panel = IndicatorPanel(df, look_back=params["Lookback"], multiplier=params["Multiplier"])
+
+    # Check last element of signal array, use slowd for StochRSI (only computed when there is a signal)
+    last_signal = int(panel["st_signal"][-1])
+    stoch_rsi = None
+    if last_signal != 0:
+        stoch_rsi = int(panel["slowd"][-1])
+    timings["indicators"] = time.perf_counter() - start
+
+    params = {"Multiplier": int(params["Multiplier"]), "Lookback": int(params["Lookback"]),
+              "TheDfactor": float(params["TheDfactor"])}
+
+    close = panel["close"]
+    return {
+        "market": market,
+        "params": params,
+        "close": close[-1],
+        "st": panel["st"][-1],
+        "ema200": panel["ema200"][-1],
+        "last_signal": last_signal,
+        "stoch_rsi": stoch_rsi,
+        # Only the columns the chart is drawn from, it is rendered later and only if somebody needs it
+        "chart": panel.frame(*CHART_COLUMNS)[CHART_COLUMNS],
+        "timings": timings,
+    }
+
+
+class MarketScanner:
+    """
+    Runs one pass of the signal scan over a list of markets. Candles are downloaded on a thread pool, the
+    indicator work is fanned out to a process pool as soon as each download finishes, and the results are
+    yielded one at a time so order execution and Telegram messages stay serial in the caller. The pool's workers
+    are spawned by the first scan and kept for the next ones. Timings and counters go to scan_metrics, the global
+    metrics if not given.
+    """
+
+    def __init__(self, ftx: FtxClient, interval: str, start_time: str, min_data_length: int,
+                 fetch_workers: int = 8, analysis_workers: int = 4, scan_metrics: Optional[Metrics] = None) -> None:
+        self.ftx = ftx
+        self.interval = interval
+        self.resolution = candle_resolution(interval)
+        self.start_time = start_time
+        self.min_data_length = min_data_length
+        self.fetch_workers = fetch_workers
+        self.analysis_workers = analysis_workers
+        self.stage_times = defaultdict(float)
+        self.metrics = scan_metrics or metrics
+
+    def _fetch(self, market: str) -> Tuple[pd.DataFrame, float]:
+        # API timings and candle counts of the download are booked under the market
+        start = time.perf_counter()
+        with metrics.collect(self.metrics), metrics.market(market):
+            df = self.ftx.get_historical_market_data(market, interval=self.interval, start_time=self.start_time)
+        return self._closed_candles(df), time.perf_counter() - start
+
+    def _closed_candles(self, df: pd.DataFrame) -> pd.DataFrame:
+        # The last candle is still in progress, right after a close it is flat at its open and would hide a
+        # crossing on the candle that just closed. Signals are taken on closed candles only, as in main_streaming.
+        current_open = self.ftx._now().timestamp() // self.resolution * self.resolution
+        return df[df.index < pd.Timestamp(current_open, unit="s", tz="UTC")]
+
+    def profile_market(self, market: str, params: dict, filepath: str) -> dict:
+        # Download and analysis of one market in this process under cProfile, the stats are dumped to filepath
+        return profile_call(filepath, lambda: analyse_market(market, self._fetch(market)[0], params))
+
+    @contextmanager
+    def _analysis_pool(self) -> Iterator[Executor]:
+        # A single worker thread keeps everything in one process, which is easier to debug
+        if self.analysis_workers <= 1:
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                yield pool
+            return
+
+        # Workers are spawned, a forked one would inherit the locks of the download threads and the websocket loop
+        # in whatever state they are in at the time
+        pool = _process_pools.get(self.analysis_workers)
+        if pool is None:
+            pool = _process_pools[self.analysis_workers] = ProcessPoolExecutor(
+                max_workers=self.analysis_workers, mp_context=multiprocessing.get_context("spawn"))
+        yield pool
+
+    def _discard_analysis_pool(self) -> None:
+        # A worker died and the pool refuses any more work, the next scan spawns new ones
+        pool = _process_pools.pop(self.analysis_workers, None)
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def scan(self, markets: list, market_params: dict) -> Iterator[dict]:
+        self.stage_times = defaultdict(float)
+        scan_start = time.perf_counter()
+        n_analysed = 0
+
+        # Optimizing is a separate offline job (optimize_markets.py), markets it has not covered are left out
+        missing = [market for market in markets if market not in market_params]
+        if missing:
+            logger.warning(f"Skipping {len(missing)} markets without optimized parameters: {missing}")
+            markets = [market for market in markets if market in market_params]
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as fetch_pool, self._analysis_pool() as analysis_pool:
+            fetches = {fetch_pool.submit(self._fetch, market): market for market in markets}
+            analyses = {}
+            pending = set(fetches)
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    market = fetches.get(future) or analyses.get(future)
+                    try:
+                        result = future.result()
+                    except Exception as exc:
+                        logger.error(f"{market}: {exc}")
+                        if isinstance(exc, BrokenProcessPool):
+                            self._discard_analysis_pool()
+                        continue
+
+                    if future in fetches:
+                        df, elapsed = result
+                        self.stage_times["fetch"] += elapsed
+                        self.metrics.record("scan:fetch", elapsed, market=market)
+                        self.metrics.count("rows_processed", len(df), market=market)
+                        if len(df) < self.min_data_length:
+                            continue
+                        try:
+                            analysis = analysis_pool.submit(analyse_market, market, df, market_params[market])
+                        except BrokenProcessPool as exc:
+                            # A worker died while the pool was idle or earlier in this scan
+                            logger.error(f"{market}: {exc}")
+                            self._discard_analysis_pool()
+                            continue
+                        analyses[analysis] = market
+                        pending.add(analysis)
+                    else:
+                        # Timed in the worker process, which has its own metrics
+                        for stage, elapsed in result["timings"].items():
+                            self.stage_times[stage] += elapsed
+                            self.metrics.record(f"scan:{stage}", elapsed, market=market)
+                        n_analysed += 1
+                        logger.debug(f"{market} timings: {result['timings']}")
+                        start = time.perf_counter()
+                        with metrics.market(market):
+                            yield result
+                        self.stage_times["signal"] += time.perf_counter() - start
+                        self.metrics.record("scan:signal", time.perf_counter() - start, market=market)
+
+        stages = ", ".join(f"{stage} {elapsed:.1f}s" for stage, elapsed in self.stage_times.items())
+        logger.info(f"Scanned {n_analysed}/{len(markets)} markets in {time.perf_counter() - scan_start:.1f}s "
+                    f"({stages})")
@@ -0,0 +1,485 @@
+import asyncio
+import bisect
+import datetime
+import itertools
+import json
+import re
+import threading
+import time
+from typing import Any, Optional, List
+
+import numpy as np
+from aiohttp import web
+from ciso8601 import parse_datetime
+
+from ftx_client import FtxClient
+from instrumentation import endpoint_name, metrics
+
+
+def ohlcv_to_candles(ohlcv: dict, resolution: int, start_time: float) -> List[dict]:
+    # FTX style candle dicts from arrays of open/high/low/close/volume
+    candles = []
+    for idx, (open_, high, low, close, volume) in enumerate(zip(ohlcv["open"], ohlcv["high"], ohlcv["low"],
+                                                                 ohlcv["close"], ohlcv["volume"])):
+        timestamp = start_time + idx * resolution
+        candles.append({
+            "startTime": datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat(),
+            "time": timestamp * 1000.,
+            "open": float(open_),
+            "high": float(high),
+            "low": float(low),
+            "close": float(close),
+            "volume": float(volume),
+        })
+    return candles
+
+
+def candles_to_trades(market: str, candles: List[dict], resolution: int) -> List[tuple]:
+    # Four (timestamp, market, price, size) trades per candle that aggregate back to it: open, the high and low in
+    # the order a bullish or bearish candle would print them, and close
+    trades = []
+    for candle in candles:
+        start = candle["time"] / 1000
+        first, second = ("low", "high") if candle["close"] >= candle["open"] else ("high", "low")
+        size = candle["volume"] / 4
+        for fraction, key in ((0.01, "open"), (0.3, first), (0.6, second), (0.99, "close")):
+            trades.append((start + fraction * resolution, market, candle[key], size))
+    return trades
+
+
+class MockExchange:
+    """
+    In-memory stand-in for the parts of the FTX REST API the bot uses. Market orders fill immediately at the top
+    of the book, which is derived from the last close of each market's candles. Fills and order updates are passed
+    to every listener(channel, data), as the websocket fills and orders channels would push them. With `now` set
+    the exchange is at that point of its history: only candles up to then exist, the one in progress is flat at its
+    open, and prices and fill times are those of `now`. Advancing it replays the candles cycle by cycle.
+    """
+
+    def __init__(self, candles: dict, usd_balance: float = 10000, leverage: float = 1, spread: float = 0.001,
+                 funding_rate: float = 0.0001, now: Optional[float] = None,
+                 market_info: Optional[List[dict]] = None) -> None:
+        # candles maps (market, resolution) to a list of FTX candle dicts, market_info holds recorded /markets
+        # entries, markets without one trade in increments of 0.001
+        self.candles = candles
+        self.market_info = {market["name"]: market for market in market_info or []}
+        self.now = now
+        self._candle_times = {}
+        self.usd_balance = usd_balance
+        self.leverage = leverage
+        self.spread = spread
+        self.funding_rate = funding_rate
+        self.positions = {}
+        self.orders = []
+        self.conditional_orders = []
+        self.fills = []
+        self.listeners = []
+        self._ids = itertools.count(1)
+
+    def _publish(self, channel: str, data: dict) -> None:
+        for listener in self.listeners:
+            listener(channel, dict(data))
+
+    def clock(self) -> float:
+        return time.time() if self.now is None else self.now
+
+    def _visible_candles(self, market: str, resolution: int, start_time: float = 0) -> List[dict]:
+        candles = self.candles.get((market, resolution), [])
+        times = self._candle_times.get((market, resolution))
+        if times is None or len(times) != len(candles):
+            times = self._candle_times[market, resolution] = [candle["time"] / 1000 for candle in candles]
+        end = len(candles) if self.now is None else bisect.bisect_right(times, self.now)
+        visible = candles[bisect.bisect_left(times, start_time):end]
+        if visible and self.now is not None and times[end - 1] + resolution > self.now:
+            # Without trades inside the candle the one in progress has only traded at its open
+            last = visible[-1]
+            visible[-1] = dict(last, high=last["open"], low=last["open"], close=last["open"], volume=0.)
+        return visible
+
+    @property
+    def markets(self) -> list:
+        return sorted({market for market, resolution in self.candles if self._visible_candles(market, resolution)})
+
+    def last_price(self, market: str) -> float:
+        for name, resolution in self.candles:
+            if name == market:
+                candles = self._visible_candles(name, resolution)
+                if candles:
+                    return candles[-1]["close"]
+        raise KeyError(f"No such market: {market}")
+
+    def list_futures(self) -> List[dict]:
+        return [{"name": market, "type": "perpetual", "volumeUsd24h": 1e8} for market in self.markets]
+
+    def list_markets(self) -> List[dict]:
+        default = {"type": "future", "priceIncrement": 0.001, "sizeIncrement": 0.001, "minProvideSize": 0.001}
+        return [dict(self.market_info.get(market, default), name=market, price=self.last_price(market))
+                for market in self.markets]
+
+    def get_orderbook(self, market: str, depth: int = 1) -> dict:
+        price = self.last_price(market)
+        return {"bids": [[round(price * (1 - self.spread / 2), 3), 1.001]] * depth,
+                "asks": [[round(price * (1 + self.spread / 2), 3), 1.001]] * depth}
+
+    def get_historical_prices(self, market: str, resolution: int, start_time: float = 0) -> List[dict]:
+        return self._visible_candles(market, resolution, start_time)
+
+    def get_last_funding_rates(self, market: str) -> List[dict]:
+        return [{"future": market, "rate": self.funding_rate, "time": self._isotime()}]
+
+    def _isotime(self) -> str:
+        return datetime.datetime.fromtimestamp(self.clock(), datetime.timezone.utc).isoformat()
+
+    def get_account_info(self) -> dict:
+        return {"leverage": self.leverage, "collateral": self.usd_balance, "freeCollateral": self.usd_balance}
+
+    def get_balances(self) -> List[dict]:
+        return [{"coin": "USD", "free": self.usd_balance, "total": self.usd_balance}]
+
+    def get_positions(self) -> List[dict]:
+        return list(self.positions.values())
+
+    def advance(self, now: float) -> None:
+        # Moves the clock to now, open limit orders and stops the candles in between traded through are filled
+        previous = self.clock()
+        self.now = now
+        for order in list(self.orders):
+            low, high = self._range_between(order["market"], previous, now)
+            buy = order["side"] == "buy"
+            if (buy and low <= order["price"]) or (not buy and high >= order["price"]):
+                self.orders.remove(order)
+                self._fill(order, order["price"])
+
+        for order in list(self.conditional_orders):
+            low, high = self._range_between(order["market"], previous, now)
+            trigger = order["triggerPrice"]
+            if (order["side"] == "sell" and low <= trigger) or (order["side"] == "buy" and high >= trigger):
+                self.conditional_orders.remove(order)
+                order["status"] = "triggered"
+                position = self.positions.get(order["market"], {}).get("netSize", 0.)
+                size = order["size"]
+                if order["reduceOnly"]:
+                    # Never more than the position it reduces, nothing if there is none left
+                    size = min(size, abs(position)) if position * (1 if order["side"] == "sell" else -1) > 0 else 0
+                if size > 0:
+                    self._fill({"id": next(self._ids), "market": order["market"], "side": order["side"],
+                                "price": None, "size": size, "type": "market", "reduceOnly": order["reduceOnly"],
+                                "status": "new", "filledSize": 0, "clientId": None}, trigger)
+
+    def _range_between(self, market: str, start: float, end: float) -> tuple:
+        # Lowest low and highest high of the market's candles from start to end
+        low, high = np.inf, -np.inf
+        for name, resolution in self.candles:
+            if name == market:
+                for candle in self._visible_candles(name, resolution, start - resolution):
+                    if candle["time"] / 1000 + resolution > start:
+                        low, high = min(low, candle["low"]), max(high, candle["high"])
+                break
+        return low, high
+
+    def _fill(self, order: dict, price: float) -> None:
+        size = order["size"] if order["side"] == "buy" else -order["size"]
+        position = self.positions.get(order["market"], {"future": order["market"], "netSize": 0., "size": 0.,
+                                                         "side": "buy", "entryPrice": price})
+        net_size = round(position["netSize"] + size, 8)
+        if position["netSize"] == 0 or np.sign(net_size) != np.sign(position["netSize"]):
+            position["entryPrice"] = price
+        position.update({"netSize": net_size, "size": abs(net_size), "side": "buy" if net_size >= 0 else "sell"})
+        self.positions[order["market"]] = position
+        order.update({"status": "closed", "filledSize": order["size"], "avgFillPrice": price})
+        fill = {"market": order["market"], "side": order["side"], "size": order["size"], "price": price,
+                "orderId": order["id"], "time": self._isotime()}
+        self.fills.append(fill)
+        self._publish("fills", fill)
+        self._publish("orders", order)
+
+    def place_order(self, params: dict) -> dict:
+        order = {"id": next(self._ids), "market": params["market"], "side": params["side"],
+                 "price": params.get("price"), "size": params["size"], "type": params.get("type", "limit"),
+                 "reduceOnly": params.get("reduceOnly", False), "status": "new", "filledSize": 0,
+                 "clientId": params.get("clientId")}
+        book = self.get_orderbook(order["market"])
+        best = book["asks"][0][0] if order["side"] == "buy" else book["bids"][0][0]
+        if order["type"] == "market" or (best - order["price"]) * (1 if order["side"] == "buy" else -1) <= 0:
+            self._fill(order, best)
+        else:
+            order["status"] = "open"
+            self.orders.append(order)
+            self._publish("orders", order)
+        return order
+
+    def place_conditional_order(self, params: dict) -> dict:
+        order = {"id": next(self._ids), "market": params["market"], "side": params["side"], "size": params["size"],
+                 "type": params.get("type", "stop"), "triggerPrice": params.get("triggerPrice"),
+                 "orderPrice": params.get("orderPrice"), "reduceOnly": params.get("reduceOnly", False),
+                 "status": "open"}
+        self.conditional_orders.append(order)
+        return order
+
+    def get_open_orders(self, market: str = None) -> List[dict]:
+        return [order for order in self.orders if market is None or order["market"] == market]
+
+    def get_conditional_orders(self, market: str = None) -> List[dict]:
+        return [order for order in self.conditional_orders if market is None or order["market"] == market]
+
+    def cancel_orders(self, params: dict) -> str:
+        market = params.get("market")
+        if not params.get("limitOrdersOnly"):
+            self.conditional_orders = [order for order in self.conditional_orders
+                                       if market is not None and order["market"] != market]
+        if not params.get("conditionalOrdersOnly"):
+            self.orders = [order for order in self.orders if market is not None and order["market"] != market]
+        return "Orders queued for cancellation"
+
+    def handle(self, method: str, path: str, params: Optional[dict] = None) -> Any:
+        # The result of a REST request like MockExchangeServer answers it, for clients that skip HTTP
+        params = params or {}
+        market = re.match(r"markets/([^/]+)/(orderbook|candles)$", path)
+        if method == "GET" and market is not None and market.group(2) == "orderbook":
+            return self.get_orderbook(market.group(1), int(params.get("depth") or 1))
+        if method == "GET" and market is not None:
+            return self.get_historical_prices(market.group(1), int(params["resolution"]),
+                                              float(params.get("start_time") or 0))
+
+        routes = {
+            ("GET", "futures"): lambda: self.list_futures(),
+            ("GET", "markets"): lambda: self.list_markets(),
+            ("GET", "funding_rates"): lambda: self.get_last_funding_rates(params["future"]),
+            ("GET", "account"): lambda: self.get_account_info(),
+            ("GET", "wallet/balances"): lambda: self.get_balances(),
+            ("GET", "positions"): lambda: self.get_positions(),
+            ("GET", "orders"): lambda: self.get_open_orders(params.get("market")),
+            ("POST", "orders"): lambda: self.place_order(params),
+            ("DELETE", "orders"): lambda: self.cancel_orders(params),
+            ("GET", "conditional_orders"): lambda: self.get_conditional_orders(params.get("market")),
+            ("POST", "conditional_orders"): lambda: self.place_conditional_order(params),
+        }
+        if (method, path) not in routes:
+            raise KeyError(f"Not found: {method} {path}")
+        return routes[method, path]()
+
+
+class MockFtxClient(FtxClient):
+    """
+    FtxClient answered by a MockExchange in this process instead of over HTTP, so everything above _request (caches,
+    candle parsing, order helpers) runs as in production without credentials or network. Relative start times
+    count back from the exchange's clock. Every request is delayed by latency seconds, and error_rate of them
+    (drawn from a seeded generator, so replays are repeatable) or the next fail_next() ones fail like an exchange
+    error would.
+    """
+
+    def __init__(self, exchange: MockExchange, latency: float = 0, error_rate: float = 0, seed: int = 0,
+                 **kwargs) -> None:
+        super().__init__(api_key="", api_secret="", **kwargs)
+        self.exchange = exchange
+        self.latency = latency
+        self.error_rate = error_rate
+        self.request_count = 0
+        self.rejected_count = 0
+        self._failures = 0
+        self._rng = np.random.default_rng(seed)
+        # The scanner downloads from several threads, the exchange isn't thread safe
+        self._lock = threading.Lock()
+
+    def fail_next(self, count: int = 1) -> None:
+        self._failures += count
+
+    def _now(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.exchange.clock())
+
+    def _request(self, method: str, path: str, **kwargs) -> Any:
+        params = kwargs.get("params") if method == "GET" else kwargs.get("json")
+        with metrics.timer(f"api:{endpoint_name(path)}"):
+            if self.latency:
+                time.sleep(self.latency)
+            with self._lock:
+                self.request_count += 1
+                if self._failures or (self.error_rate and self._rng.random() < self.error_rate):
+                    self._failures = max(self._failures - 1, 0)
+                    self.rejected_count += 1
+                    data = {"success": False, "error": "Injected failure"}
+                else:
+                    try:
+                        data = {"success": True, "result": self.exchange.handle(method, path, params)}
+                    except (KeyError, ValueError) as exc:
+                        data = {"success": False, "error": str(exc)}
+        metrics.count("api_calls")
+        return self._process_data(data)
+
+
+class MockExchangeServer:
+    """
+    Serves a MockExchange over HTTP with the FTX response envelope, for offline tests of the REST clients.
+    latency delays every response, fail_next makes the next requests return an error status and rate_limit
+    answers 429 once more than that many requests arrive within a second. /ws is a websocket with the FTX
+    login/subscribe/ping ops that pushes the exchange's fills and orders updates to subscribers, and the trades
+    and ticker of a market given to publish_trades() or replay_trades().
+    """
+
+    def __init__(self, exchange: MockExchange, host: str = "127.0.0.1", port: int = 0, latency: float = 0,
+                 rate_limit: Optional[int] = None) -> None:
+        self.exchange = exchange
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.request_count = 0
+        self.rejected_count = 0
+        self._failures = []
+        self._request_times = []
+        self._runner = None
+        # Keyed by channel, or (channel, market) for the market channels
+        self._subscribers = {"fills": set(), "orders": set()}
+        exchange.listeners.append(self._push)
+
+        self.app = web.Application(middlewares=[self._middleware])
+        self.app.add_routes([
+            web.get("/api/futures", self._handler(lambda request, body: exchange.list_futures())),
+            web.get("/api/markets", self._handler(lambda request, body: exchange.list_markets())),
+            web.get("/api/markets/{market}/orderbook", self._handler(
+                lambda request, body: exchange.get_orderbook(request.match_info["market"],
+                                                             int(request.query.get("depth", 1))))),
+            web.get("/api/markets/{market}/candles", self._handler(
+                lambda request, body: exchange.get_historical_prices(request.match_info["market"],
+                                                                     int(request.query["resolution"]),
+                                                                     float(request.query.get("start_time", 0))))),
+            web.get("/api/funding_rates", self._handler(
+                lambda request, body: exchange.get_last_funding_rates(request.query["future"]))),
+            web.get("/api/account", self._handler(lambda request, body: exchange.get_account_info())),
+            web.get("/api/wallet/balances", self._handler(lambda request, body: exchange.get_balances())),
+            web.get("/api/positions", self._handler(lambda request, body: exchange.get_positions())),
+            web.get("/api/orders", self._handler(
+                lambda request, body: exchange.get_open_orders(request.query.get("market")))),
+            web.post("/api/orders", self._handler(lambda request, body: exchange.place_order(body))),
+            web.delete("/api/orders", self._handler(lambda request, body: exchange.cancel_orders(body or {}))),
+            web.get("/api/conditional_orders", self._handler(
+                lambda request, body: exchange.get_conditional_orders(request.query.get("market")))),
+            web.post("/api/conditional_orders", self._handler(
+                lambda request, body: exchange.place_conditional_order(body))),
+            web.get("/ws", self._websocket),
+        ])
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://{self.host}:{self.port}/api/"
+
+    def fail_next(self, count: int = 1, status: int = 500) -> None:
+        self._failures.extend([status] * count)
+
+    @staticmethod
+    def _handler(func):
+        async def handler(request: web.Request) -> web.Response:
+            body = json.loads(await request.text() or "null")
+            try:
+                result = func(request, body)
+            except (KeyError, ValueError) as exc:
+                return web.json_response({"success": False, "error": str(exc)}, status=400)
+            return web.json_response({"success": True, "result": result})
+        return handler
+
+    def _push(self, channel: str, data: dict) -> None:
+        for ws in list(self._subscribers[channel]):
+            asyncio.ensure_future(ws.send_json({"channel": channel, "type": "update", "data": data}))
+
+    async def publish_trades(self, market: str, trades: List[dict]) -> None:
+        # trades are FTX trade dicts, the ticker channel gets the last one
+        for ws in list(self._subscribers.get(("trades", market), ())):
+            await ws.send_json({"channel": "trades", "market": market, "type": "update", "data": trades})
+        if trades:
+            ticker = {"bid": trades[-1]["price"], "ask": trades[-1]["price"], "last": trades[-1]["price"],
+                      "time": parse_datetime(trades[-1]["time"]).timestamp()}
+            for ws in list(self._subscribers.get(("ticker", market), ())):
+                await ws.send_json({"channel": "ticker", "market": market, "type": "update", "data": ticker})
+
+    async def replay_trades(self, trades: List[tuple], speed: float = 1., align: float = 1.) -> None:
+        # trades are (timestamp, market, price, size) sorted by time and sent time-shifted to now, `speed` times
+        # faster than recorded. The shift is a multiple of `align`, so candles keep their boundaries.
+        if not trades:
+            return
+        await asyncio.sleep(align - (time.time() - trades[0][0]) % align)
+        offset = round((time.time() - trades[0][0]) / align) * align
+        start = time.monotonic()
+        for timestamp, market, price, size in trades:
+            delay = (timestamp - trades[0][0]) / speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            trade_time = datetime.datetime.fromtimestamp(timestamp + offset, datetime.timezone.utc).isoformat()
+            await self.publish_trades(market, [{"id": next(self.exchange._ids), "price": price, "size": size,
+                                                "side": "buy", "liquidation": False, "time": trade_time}])
+
+    async def _websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        try:
+            async for msg in ws:
+                message = json.loads(msg.data)
+                if message["op"] == "ping":
+                    await ws.send_json({"type": "pong"})
+                elif message["op"] == "subscribe" and message["channel"] in self._subscribers:
+                    self._subscribers[message["channel"]].add(ws)
+                    await ws.send_json({"type": "subscribed", "channel": message["channel"]})
+                elif message["op"] == "subscribe" and message["channel"] in ("trades", "ticker"):
+                    self._subscribers.setdefault((message["channel"], message["market"]), set()).add(ws)
+                    await ws.send_json({"type": "subscribed", "channel": message["channel"],
+                                        "market": message["market"]})
+        finally:
+            for subscribers in self._subscribers.values():
+                subscribers.discard(ws)
+        return ws
+
+    async def disconnect_websockets(self) -> None:
+        for ws in set().union(*self._subscribers.values()):
+            await ws.close()
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler) -> web.Response:
+        self.request_count += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.rate_limit is not None:
+            now = time.monotonic()
+            self._request_times = [t for t in self._request_times if now - t < 1] + [now]
+            if len(self._request_times) > self.rate_limit:
+                self.rejected_count += 1
+                return web.json_response({"success": False, "error": "Do not send more than rate limit"},
+                                         status=429)
+
+        if self._failures:
+            self.rejected_count += 1
+            return web.json_response({"success": False, "error": "Injected failure"}, status=self._failures.pop(0))
+        return await handler(request)
+
+    async def start(self) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return self.endpoint
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from benchmarks import synthetic_ohlcv
+
+    arg_parser = argparse.ArgumentParser(description="Serve a mock FTX REST API with synthetic candles")
+    arg_parser.add_argument("--markets", type=int, default=100)
+    arg_parser.add_argument("--candles", type=int, default=600)
+    arg_parser.add_argument("--port", type=int, default=8080)
+    arg_parser.add_argument("--latency", type=float, default=0)
+    args = arg_parser.parse_args()
+
+    resolution = 14400
+    start = (time.time() // resolution - args.candles + 1) * resolution
+    mock_candles = {(f"MOCK{idx}-PERP", resolution): ohlcv_to_candles(synthetic_ohlcv(args.candles, seed=idx),
+                                                                       resolution, start)
+                    for idx in range(args.markets)}
+    server = MockExchangeServer(MockExchange(mock_candles), port=args.port, latency=args.latency)
+    web.run_app(server.app, host=server.host, port=server.port)
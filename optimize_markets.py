@@ -0,0 +1,268 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional, Tuple
+
+import pandas as pd
+
+import backtesting as bt
+from candle_panel import CandlePanel, build_candle_panel
+from candle_store import CandleStore
+from ftx_client import FtxClient
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+try:
+    from config import API_KEY, API_SECRET
+except ImportError:
+    # Runs on a candle panel don't need credentials
+    API_KEY = API_SECRET = None
+
+with open("settings.json") as jsonfile:
+    settings = json.load(jsonfile)
+
+BACKTEST_FOLDER = settings["filepaths"]["backtest_folder"]
+OPTIMIZEDML_FILEPATH = os.path.join(BACKTEST_FOLDER, settings["filepaths"]["optimized_ml_file"])
+CHECKPOINT_FILEPATH = os.path.join(BACKTEST_FOLDER, settings["optimization"]["checkpoint_file"])
+CANDLE_PANEL_FOLDER = settings["filepaths"]["candle_panel_folder"]
+
+_ftx = None
+_panel = None
+
+
+def _init_worker(panel_path: str = None) -> None:
+    # One client per worker process, all sharing the on-disk candle store. With a candle panel every worker
+    # maps the same file instead of fetching or receiving the candles.
+    global _ftx, _panel
+    _ftx = FtxClient(api_key=API_KEY, api_secret=API_SECRET,
+                     candle_store=CandleStore(settings["filepaths"]["candle_folder"]))
+    _panel = CandlePanel(panel_path) if panel_path is not None else None
+
+
+def timeframe_start_time(interval: str) -> str:
+    return settings["schedule"]["start_times"].get(interval, settings["analysis"]["start_time"])
+
+
+def optimized_params_filepath(interval: str) -> str:
+    # The analysis interval keeps the original file, the parameters of other timeframes are optimized on their own
+    # candles into their own file
+    if interval == settings["analysis"]["interval"]:
+        return OPTIMIZEDML_FILEPATH
+    root, extension = os.path.splitext(OPTIMIZEDML_FILEPATH)
+    return f"{root}_{interval}{extension}"
+
+
+def perpetual_markets(ftx: FtxClient) -> list:
+    markets = []
+    for future in ftx.list_futures():
+        if future["type"] == "perpetual":
+            if (future["volumeUsd24h"] > settings["markets"]["min_volume_usd_24h"] and
+                    future["name"] not in settings["markets"]["blacklist"]):
+                markets.append(future["name"])
+    return markets
+
+
+def optimize_market(market: str, multipliers: list, lookbacks: list, optimize_to: str = "TheDfactor",
+                    exit_params: dict = None, interval: str = settings["analysis"]["interval"]) -> dict:
+    if _panel is not None:
+        if market not in _panel:
+            return {"Name": market, "Skipped": "not in the candle panel"}
+        df = _panel.frame(market)
+    else:
+        df = _ftx.get_historical_market_data(market, interval=interval, start_time=timeframe_start_time(interval))
+
+    if len(df) < settings["analysis"]["min_data_length"]:
+        return {"Name": market, "Skipped": f"only {len(df)} candles"}
+
+    try:
+        result = bt.optimize_m_l(df, optimize_to=optimize_to, return_optimize_to=True, multipliers=multipliers,
+                                 lookbacks=lookbacks, **(exit_params or {}))
+    except ValueError as exc:
+        return {"Name": market, "Skipped": str(exc)}
+    result["Name"] = market
+    return result
+
+
+def load_checkpoint(filepath: str) -> Tuple[Optional[dict], dict]:
+    # The parameter grid the checkpoint was written for (its first line) and the results by market
+    grid, results = None, {}
+    if not os.path.exists(filepath):
+        return grid, results
+    with open(filepath, "rb+") as checkpoint_file:
+        data = checkpoint_file.read()
+        # Drop the partially written last line of an interrupted run so new results start on a fresh line
+        checkpoint_file.truncate(data.rfind(b"\n") + 1)
+    for line in data.splitlines(keepends=True):
+        if line.endswith(b"\n"):
+            record = json.loads(line)
+            if "Grid" in record:
+                grid = record["Grid"]
+            else:
+                results[record["Name"]] = record
+    return grid, results
+
+
+def write_csv_atomic(df: pd.DataFrame, filepath: str) -> None:
+    # A uniquely named temporary file, concurrent runs writing the same output don't share one
+    fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", newline="") as csv_file:
+            df.to_csv(csv_file, index=False)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.remove(tmp_filepath)
+        raise
+
+
+def merge_results(optimized_params: pd.DataFrame, filepath: str) -> pd.DataFrame:
+    # Rows of the markets just optimized replace theirs in the existing file, every other market (including the
+    # ones skipped this time) keeps its row
+    if not os.path.exists(filepath):
+        return optimized_params
+    existing = pd.read_csv(filepath)
+    existing = existing[~existing["Name"].isin(optimized_params["Name"])]
+    return pd.concat((existing, optimized_params), ignore_index=True)
+
+
+def optimize_all_markets(markets: list, multipliers: list, lookbacks: list, workers: int,
+                         checkpoint_filepath: str, output_filepath: str, fresh: bool = False,
+                         optimize_to: str = "TheDfactor", exit_params: dict = None,
+                         panel_path: str = None, merge: bool = False,
+                         interval: str = settings["analysis"]["interval"]) -> Optional[pd.DataFrame]:
+    # exit_params are the stop_losses/take_profits sweeps and fee/slippage of optimize_m_l. With merge the
+    # results of markets are merged into output_filepath instead of replacing it, for runs over some markets only.
+    # A candle panel has to hold candles of the interval.
+    os.makedirs(os.path.dirname(checkpoint_filepath) or ".", exist_ok=True)
+    if fresh and os.path.exists(checkpoint_filepath):
+        os.remove(checkpoint_filepath)
+
+    # Results of another grid or candle history must not be mixed into this run (through JSON like the checkpoint,
+    # so both compare equal)
+    grid = json.loads(json.dumps({
+        "multipliers": multipliers, "lookbacks": lookbacks, "optimize_to": optimize_to, "exit_params": exit_params,
+        "interval": interval, "start_time": timeframe_start_time(interval)}))
+    checkpoint_grid, results = load_checkpoint(checkpoint_filepath)
+    if (checkpoint_grid is not None or results) and checkpoint_grid != grid:
+        raise ValueError(f"{checkpoint_filepath} was written for another parameter grid ({checkpoint_grid}), "
+                         f"run with --fresh to start over")
+    remaining = [market for market in markets if market not in results]
+    logger.info(f"Optimizing {len(remaining)} markets ({len(results)} already done) over "
+                f"{len(multipliers) * len(lookbacks)} multiplier/lookback combinations with {workers} workers")
+
+    start = time.perf_counter()
+    with open(checkpoint_filepath, "a") as checkpoint_file, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(panel_path,)) as pool:
+        if checkpoint_grid is None:
+            checkpoint_file.write(json.dumps({"Grid": grid}) + "\n")
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        futures = {pool.submit(optimize_market, market, multipliers, lookbacks, optimize_to, exit_params,
+                               interval): market for market in remaining}
+        for idx, future in enumerate(as_completed(futures)):
+            market = futures[future]
+            try:
+                result = future.result()
+            except Exception as exc:
+                # Not checkpointed, so the market is retried on the next run
+                logger.error(f"{market}: {exc}")
+                continue
+
+            checkpoint_file.write(json.dumps(result, default=float) + "\n")
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+            results[market] = result
+            logger.info(f"({idx + 1}/{len(remaining)}) {market}: {result}")
+
+    missing = [market for market in markets if market not in results]
+    if missing:
+        logger.warning(f"Not writing {output_filepath}, {len(missing)} markets failed: {missing}. "
+                       f"Run again to resume.")
+        return None
+
+    columns = ["Name", "Multiplier", "Lookback", optimize_to]
+    for column, sweep in (("StopLoss", "stop_losses"), ("TakeProfit", "take_profits")):
+        if (exit_params or {}).get(sweep) is not None:
+            columns.append(column)
+    optimized_params = pd.DataFrame([results[market] for market in markets if "Skipped" not in results[market]],
+                                    columns=columns)
+    if merge:
+        optimized_params = merge_results(optimized_params, output_filepath)
+    write_csv_atomic(optimized_params, output_filepath)
+    os.remove(checkpoint_filepath)
+    logger.info(f"Wrote {len(optimized_params)} markets to {output_filepath} in "
+                f"{time.perf_counter() - start:.1f}s")
+    return optimized_params
+
+
+def _optional_percent(value: str) -> Optional[float]:
+    # "none" in a sweep means no stop loss/take profit at all
+    return None if value.lower() == "none" else float(value)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Optimize supertrend multiplier/lookback for every market")
+    arg_parser.add_argument("--multipliers", type=float, nargs="+", default=settings["optimization"]["multipliers"])
+    arg_parser.add_argument("--lookbacks", type=int, nargs="+", default=settings["optimization"]["lookbacks"])
+    arg_parser.add_argument("--stop-losses", type=_optional_percent, nargs="+",
+                            default=settings["optimization"]["stop_losses"],
+                            help="Stop loss percentages to sweep (default: no stop loss)")
+    arg_parser.add_argument("--take-profits", type=_optional_percent, nargs="+",
+                            default=settings["optimization"]["take_profits"],
+                            help="Take profit percentages to sweep (default: no take profit)")
+    arg_parser.add_argument("--fee", type=float, default=settings["optimization"]["fee"],
+                            help="Fee per fill as a fraction of the notional")
+    arg_parser.add_argument("--slippage", type=float, default=settings["optimization"]["slippage"],
+                            help="Slippage per fill as a fraction of the price")
+    arg_parser.add_argument("--workers", type=int, default=settings["optimization"]["workers"])
+    arg_parser.add_argument("--markets", nargs="+",
+                            help="Only these markets (default: all perpetuals), their results are merged into "
+                                 "--output")
+    arg_parser.add_argument("--fresh", action="store_true", help="Ignore the checkpoint of an interrupted run")
+    arg_parser.add_argument("--interval", default=settings["analysis"]["interval"],
+                            help="Candle interval to optimize for, the scan of each interval uses its own results")
+    arg_parser.add_argument("--output", help="Default: the optimized parameters file of the interval")
+    arg_parser.add_argument("--panel", nargs="?", const=CANDLE_PANEL_FOLDER,
+                            help="Read the candles from this candle panel folder instead of the exchange")
+    arg_parser.add_argument("--build-panel", action="store_true",
+                            help="Build the candle panel from the interval and its start time first")
+    arg_parser.add_argument("--panel-dtype", choices=["float32", "float64"], default="float64")
+    args = arg_parser.parse_args()
+
+    # Whole multipliers stay ints so the CSV keeps its previous format
+    multipliers = [int(m) if float(m).is_integer() else m for m in args.multipliers]
+
+    markets = args.markets
+    if markets is None:
+        markets = perpetual_markets(FtxClient(api_key=API_KEY, api_secret=API_SECRET))
+
+    if args.build_panel:
+        panel_path = args.panel or CANDLE_PANEL_FOLDER
+        _init_worker()
+        start = time.perf_counter()
+        panel = build_candle_panel(_ftx, panel_path, markets, args.interval, timeframe_start_time(args.interval),
+                                   dtype=args.panel_dtype)
+        logger.info(f"Built {panel_path} with {len(panel)} markets x {len(panel.times)} bars "
+                    f"({panel.candles.nbytes / 1024 ** 2:.0f} MB) in {time.perf_counter() - start:.1f}s")
+        args.panel = panel_path
+
+    exit_params = {"stop_losses": args.stop_losses, "take_profits": args.take_profits, "fee": args.fee,
+                   "slippage": args.slippage}
+    try:
+        optimize_all_markets(markets, multipliers, args.lookbacks, workers=args.workers,
+                             checkpoint_filepath=CHECKPOINT_FILEPATH,
+                             output_filepath=args.output or optimized_params_filepath(args.interval), fresh=args.fresh,
+                             exit_params=exit_params, panel_path=args.panel, merge=args.markets is not None,
+                             interval=args.interval)
+    except ValueError as exc:
+        arg_parser.error(str(exc))
+
+
+if __name__ == '__main__':
+    main()
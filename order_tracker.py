@@ -0,0 +1,300 @@
+import asyncio
+import hmac
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+
+import aiohttp
+from ciso8601 import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+MessageCallback = Callable[[str, dict], None]
+
+
+def _fill_time(fill: dict) -> Optional[float]:
+    return parse_datetime(fill["time"]).timestamp() if "time" in fill else None
+
+
+class FillsSource:
+    """
+    Pushes updates of the FTX fills and orders channels to on_message(channel, data) and calls on_connect every
+    time the feed (re)connects, so the receiver can resynchronize whatever it may have missed in between. Updates
+    can be pushed while on_connect runs. connected is only True while the feed is up and on_connect has returned
+    for the current connection.
+    """
+    connected = False
+
+    def start(self, on_message: MessageCallback, on_connect: Callable[[], None] = None) -> None:
+        raise NotImplementedError
+
+    def stop(self) -> None:
+        pass
+
+
+class LocalFillsSource(FillsSource):
+    """In-process stand-in for the websocket feed, publish() delivers a message synchronously."""
+
+    def __init__(self) -> None:
+        self._on_message = None
+
+    def start(self, on_message: MessageCallback, on_connect: Callable[[], None] = None) -> None:
+        self._on_message = on_message
+        if on_connect is not None:
+            on_connect()
+        self.connected = True
+
+    def stop(self) -> None:
+        # Messages published from now on are lost, as they would be while the websocket is down
+        self.connected = False
+        self._on_message = None
+
+    def publish(self, channel: str, data: dict) -> None:
+        if self._on_message is not None:
+            self._on_message(channel, data)
+
+
+class FtxWebsocketSource(FillsSource):
+    """
+    Authenticated FTX websocket subscribed to the fills and orders channels, running its own event loop in a
+    daemon thread. Pings every ping_interval seconds as FTX requires and reconnects with exponential backoff.
+    """
+
+    def __init__(self, api_key: str, api_secret: str, subaccount_name: str = None,
+                 endpoint: str = "wss://ftx.com/ws/", ping_interval: float = 15,
+                 max_reconnect_delay: float = 30) -> None:
+        self.endpoint = endpoint
+        self.ping_interval = ping_interval
+        self.max_reconnect_delay = max_reconnect_delay
+        self._api_key = api_key
+        self._api_secret = api_secret
+        self._subaccount_name = subaccount_name
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _login_message(self) -> dict:
+        ts = int(time.time() * 1000)
+        signature = hmac.new(self._api_secret.encode(), f"{ts}websocket_login".encode(), "sha256").hexdigest()
+        args = {"key": self._api_key, "sign": signature, "time": ts}
+        if self._subaccount_name:
+            args["subaccount"] = self._subaccount_name
+        return {"op": "login", "args": args}
+
+    def start(self, on_message: MessageCallback, on_connect: Callable[[], None] = None) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._listen(on_message, on_connect)),
+                                        name="ftx-websocket", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.ping_interval + 1)
+            self._thread = None
+
+    async def _listen(self, on_message: MessageCallback, on_connect: Optional[Callable[[], None]]) -> None:
+        delay = 1
+        while not self._stopped.is_set():
+            try:
+                async with aiohttp.ClientSession() as session, session.ws_connect(self.endpoint) as ws:
+                    await ws.send_json(self._login_message())
+                    for channel in ("fills", "orders"):
+                        await ws.send_json({"op": "subscribe", "channel": channel})
+                    await self._receive(ws, on_message, on_connect)
+                    delay = 1
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as exc:
+                logger.warning(f"Websocket error: {exc}")
+            except Exception as exc:
+                # A failing callback must not end the feed
+                logger.error(f"Websocket message handling failed: {exc}")
+            self.connected = False
+
+            if not self._stopped.is_set():
+                logger.info(f"Websocket disconnected, reconnecting in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _on_synced(self, syncing: asyncio.Future) -> None:
+        if not syncing.cancelled() and syncing.exception() is None:
+            self.connected = True
+
+    async def _receive(self, ws: aiohttp.ClientWebSocketResponse, on_message: MessageCallback,
+                       on_connect: Optional[Callable[[], None]]) -> None:
+        syncing = None
+        try:
+            while not self._stopped.is_set():
+                if syncing is not None and syncing.done():
+                    # A failed resync drops the connection, until the next one succeeds REST is used
+                    syncing, done = None, syncing
+                    done.result()
+                try:
+                    msg = await ws.receive(timeout=self.ping_interval)
+                except asyncio.TimeoutError:
+                    await ws.send_json({"op": "ping"})
+                    continue
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    return
+
+                message = json.loads(msg.data)
+                if message["type"] == "update":
+                    on_message(message["channel"], message["data"])
+                elif message["type"] == "subscribed" and message["channel"] == "fills":
+                    # Anything filled while disconnected is only in the REST state. Updates are still received while
+                    # on_connect loads it, so the receiver can tell them apart from what the REST state already has.
+                    if on_connect is None:
+                        self.connected = True
+                    else:
+                        syncing = asyncio.get_running_loop().run_in_executor(None, on_connect)
+                        syncing.add_done_callback(self._on_synced)
+                elif message["type"] == "error":
+                    logger.error(f"Websocket error message: {message}")
+        finally:
+            # A resync still running must not mark the next connection attempt connected
+            if syncing is not None:
+                syncing.remove_done_callback(self._on_synced)
+
+
+class OrderTracker:
+    """
+    Local positions and orders, kept up to date by the fills and order updates of a FillsSource instead of
+    polling the REST API. load_positions (usually FtxClient.get_positions) seeds the positions whenever the source
+    connects. expect_close() and expect_order() return futures that resolve when the position is flat or the
+    order is closed, so callers can wait for them with a timeout or go on and check them later. Positions are only
+    trustworthy while synced: the feed is connected and the positions were seeded since it (re)connected.
+    Fills pushed while the positions load are buffered and fills from before the loaded positions are dropped, by
+    their time on the exchange's clock.
+    """
+
+    def __init__(self, source: FillsSource, load_positions: Callable[[], List[dict]] = None,
+                 clock: Callable[[], float] = time.time, max_loads: int = 3) -> None:
+        self.source = source
+        self._load_positions = load_positions
+        self._clock = clock
+        self.max_loads = max_loads
+        self._lock = threading.Lock()
+        self._net_sizes = {}
+        self._orders = {}
+        self._close_waiters = {}
+        self._order_waiters = {}
+        self._synced = False
+        # Fills received while the positions load, and the time the loaded positions are from
+        self._buffered_fills = None
+        self._positions_time = None
+        source.start(self._on_message, on_connect=self.sync_positions if load_positions is not None else None)
+
+    def _load_snapshot(self) -> Tuple[List[dict], float]:
+        # A fill from while the request was in flight may or may not be in the positions, they are loaded again
+        with self._lock:
+            self._buffered_fills = []
+        try:
+            for _ in range(self.max_loads):
+                requested = self._clock()
+                positions = self._load_positions()
+                loaded = self._clock()
+                with self._lock:
+                    fill_times = [_fill_time(fill) for fill in self._buffered_fills]
+                    if not any(fill_time is not None and requested <= fill_time <= loaded for fill_time in fill_times):
+                        return positions, requested
+            raise RuntimeError(f"Positions changed while loading them {self.max_loads} times in a row")
+        except BaseException:
+            with self._lock:
+                self._buffered_fills = None
+            raise
+
+    def sync_positions(self, positions: List[dict] = None) -> None:
+        positions_time = None
+        if positions is None:
+            positions, positions_time = self._load_snapshot()
+        with self._lock:
+            self._net_sizes = {position["future"]: float(position["netSize"]) for position in positions
+                               if position["netSize"] != 0}
+            self._positions_time = positions_time
+            self._synced = True
+            buffered_fills, self._buffered_fills = self._buffered_fills or [], None
+            for fill in buffered_fills:
+                self._apply_fill(fill)
+            for market in list(self._close_waiters):
+                if market not in self._net_sizes:
+                    self._resolve_close(market)
+
+    @property
+    def synced(self) -> bool:
+        # Without load_positions only fills since the start are known, until sync_positions is given positions
+        return self._synced and self.source.connected
+
+    def stop(self) -> None:
+        self.source.stop()
+
+    def _on_message(self, channel: str, data: dict) -> None:
+        if channel == "fills":
+            self._on_fill(data)
+        elif channel == "orders":
+            self._on_order(data)
+
+    def _on_fill(self, fill: dict) -> None:
+        with self._lock:
+            if self._buffered_fills is not None:
+                self._buffered_fills.append(fill)
+            else:
+                self._apply_fill(fill)
+
+    def _apply_fill(self, fill: dict) -> None:
+        # Fills from before the positions were requested are already in them, fills without a time are taken as new
+        fill_time = _fill_time(fill)
+        if self._positions_time is not None and fill_time is not None and fill_time < self._positions_time:
+            return
+        market = fill["market"]
+        size = fill["size"] if fill["side"] == "buy" else -fill["size"]
+        previous = self._net_sizes.get(market, 0.)
+        net_size = round(previous + size, 8)
+        if net_size == 0:
+            self._net_sizes.pop(market, None)
+        else:
+            self._net_sizes[market] = net_size
+        # A fill through zero closes the previous position too
+        if net_size == 0 or net_size * previous < 0:
+            self._resolve_close(market)
+
+    def _on_order(self, order: dict) -> None:
+        with self._lock:
+            self._orders[order["id"]] = order
+            if order["status"] == "closed":
+                for future in self._order_waiters.pop(order["id"], []):
+                    future.set_result(order)
+
+    def _resolve_close(self, market: str) -> None:
+        for future in self._close_waiters.pop(market, []):
+            future.set_result(True)
+
+    def position(self, market: str) -> dict:
+        # Same keys as the REST position, {} when flat like FtxClient.check_open_position
+        with self._lock:
+            net_size = self._net_sizes.get(market, 0.)
+        if net_size == 0:
+            return {}
+        return {"future": market, "netSize": net_size, "size": abs(net_size), "side": "buy" if net_size > 0 else "sell"}
+
+    def order(self, order_id: int) -> Optional[dict]:
+        with self._lock:
+            return self._orders.get(order_id)
+
+    def expect_close(self, market: str) -> Future:
+        # Register before placing the closing order, so its fill can't arrive first. Only a fill or a sync that
+        # leaves the market flat resolves it, a market missing from the local positions may just not be synced yet.
+        future = Future()
+        with self._lock:
+            self._close_waiters.setdefault(market, []).append(future)
+        return future
+
+    def expect_order(self, order_id: int) -> Future:
+        future = Future()
+        with self._lock:
+            order = self._orders.get(order_id)
+            if order is not None and order["status"] == "closed":
+                future.set_result(order)
+            else:
+                self._order_waiters.setdefault(order_id, []).append(future)
+        return future
@@ -0,0 +1,240 @@
+import heapq
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+import backtesting as bt
+import supertrend as spt
+
+# Within a candle the stop loss is hit before the signal on its close, _OPEN marks positions still open at the end
+_STOP, _SIGNAL, _OPEN = 0, 1, 2
+_EXIT_REASONS = np.array(["StopLoss", "Signal", "Open"])
+
+
+class PortfolioResult(NamedTuple):
+    # equity has one row per candle time of any market, trades one row per position
+    equity: pd.DataFrame
+    trades: pd.DataFrame
+    metrics: dict
+
+
+def _stop_loss_bar(side: int, stop_price: float, high: np.ndarray, low: np.ndarray, start: int, end: int) -> int:
+    # First candle in [start, end] whose range reaches the stop, -1 if there is none
+    if start > end:
+        return -1
+    hit = low[start:end + 1] <= stop_price if side == 1 else high[start:end + 1] >= stop_price
+    first = int(np.argmax(hit))
+    return start + first if hit[first] else -1
+
+
+def simulate_portfolio(candles: dict, market_params: dict, initial_balance: float = 10000,
+                       account_percent: float = 10, stop_loss_percent: float = 5, leverage: float = 1,
+                       fee: float = 0.) -> PortfolioResult:
+    """
+    Replays the supertrend signals of many markets against one shared USD balance, the way the live bot trades:
+    every signal sizes a position at account_percent of the free balance times leverage, places a stop loss
+    stop_loss_percent away (as FtxClient.get_stop_loss_price) and closes an opposite position first (as
+    market_close_and_cancel_orders). The markets' signal and stop loss events are merged into one time ordered
+    loop through a heap, positions and trades live in NumPy arrays. candles maps market to an OHLC dataframe,
+    market_params maps market to its Multiplier and Lookback. fee is charged on the notional of every fill.
+    """
+    markets = [market for market in candles if market in market_params and len(candles[market]) > 1]
+    n_markets = len(markets)
+
+    times, opens, highs, lows, closes, signal_idx, signal_side = [], [], [], [], [], [], []
+    for market in markets:
+        df = candles[market]
+        high, low, close = df.high.values, df.low.values, df.close.values
+        st, _, _ = spt.supertrend_kernel(high, low, close, look_back=market_params[market]["Lookback"],
+                                         multiplier=market_params[market]["Multiplier"])
+        positions = bt.get_supertrend_positions(st, close)
+        times.append(df.index.values.astype("datetime64[ns]").view(np.int64))
+        opens.append(np.asarray(df.open.values if "open" in df else close, dtype=np.float64))
+        highs.append(np.asarray(high, dtype=np.float64))
+        lows.append(np.asarray(low, dtype=np.float64))
+        closes.append(np.asarray(close, dtype=np.float64))
+        signal_idx.append(positions.idx)
+        signal_side.append(positions.side)
+
+    # Position state, one slot per market
+    pos_side = np.zeros(n_markets, dtype=np.int8)
+    pos_trade = np.full(n_markets, -1, dtype=np.int64)
+
+    # Trades, every signal opens at most one position
+    capacity = sum(len(idx) for idx in signal_idx)
+    trade_market = np.empty(capacity, dtype=np.int64)
+    trade_side = np.empty(capacity, dtype=np.int8)
+    trade_size = np.empty(capacity)
+    trade_entry_bar = np.empty(capacity, dtype=np.int64)
+    trade_entry_price = np.empty(capacity)
+    trade_exit_bar = np.empty(capacity, dtype=np.int64)
+    trade_exit_price = np.empty(capacity)
+    trade_exit_reason = np.empty(capacity, dtype=np.int8)
+    n_trades = 0
+
+    cash = float(initial_balance)
+    margin_used = 0.
+
+    # Heap entries are (time, kind, market, signal number or stop candle, trade)
+    heap = [(times[m][signal_idx[m][0]], _SIGNAL, m, 0, -1) for m in range(n_markets) if len(signal_idx[m])]
+    heapq.heapify(heap)
+
+    while heap:
+        _, kind, m, k, trade = heapq.heappop(heap)
+
+        if kind == _STOP:
+            if pos_trade[m] != trade:
+                continue
+            bar, side = k, trade_side[trade]
+            stop_price = trade_entry_price[trade] * (1 - side * stop_loss_percent / 100)
+            # A candle that opens beyond the stop fills at its open
+            exit_price = min(opens[m][bar], stop_price) if side == 1 else max(opens[m][bar], stop_price)
+            reason = _STOP
+        else:
+            bar, side = signal_idx[m][k], signal_side[m][k]
+            exit_price = closes[m][bar]
+            reason = _SIGNAL
+            if k + 1 < len(signal_idx[m]):
+                heapq.heappush(heap, (times[m][signal_idx[m][k + 1]], _SIGNAL, m, k + 1, -1))
+
+            if pos_side[m] == side:
+                continue
+
+        # Close the open position of this market
+        if pos_side[m] != 0:
+            open_trade = pos_trade[m]
+            size, entry_price = trade_size[open_trade], trade_entry_price[open_trade]
+            cash += pos_side[m] * size * (exit_price - entry_price) - fee * size * exit_price
+            margin_used -= size * entry_price / leverage
+            trade_exit_bar[open_trade] = bar
+            trade_exit_price[open_trade] = exit_price
+            trade_exit_reason[open_trade] = reason
+            pos_side[m] = 0
+            pos_trade[m] = -1
+
+        if kind == _STOP:
+            continue
+
+        # Open a new position in the direction of the signal
+        free_balance = cash - margin_used
+        if free_balance <= 0:
+            continue
+        price = closes[m][bar]
+        notional = free_balance * account_percent / 100 * leverage
+        cash -= fee * notional
+        margin_used += notional / leverage
+
+        trade = n_trades
+        n_trades += 1
+        trade_market[trade] = m
+        trade_side[trade] = side
+        trade_size[trade] = notional / price
+        trade_entry_bar[trade] = bar
+        trade_entry_price[trade] = price
+        trade_exit_bar[trade] = len(closes[m]) - 1
+        trade_exit_price[trade] = closes[m][-1]
+        trade_exit_reason[trade] = _OPEN
+        pos_side[m] = side
+        pos_trade[m] = trade
+
+        # The stop can only be hit before the next signal of this market closes the position anyway
+        next_signal = signal_idx[m][k + 1] if k + 1 < len(signal_idx[m]) else len(closes[m]) - 1
+        stop_bar = _stop_loss_bar(side, price * (1 - side * stop_loss_percent / 100), highs[m], lows[m],
+                                  bar + 1, next_signal)
+        if stop_bar >= 0:
+            heapq.heappush(heap, (times[m][stop_bar], _STOP, m, stop_bar, trade))
+
+    used = slice(0, n_trades)
+    trade_market, trade_side, trade_size = trade_market[used], trade_side[used], trade_size[used]
+    trade_entry_bar, trade_entry_price = trade_entry_bar[used], trade_entry_price[used]
+    trade_exit_bar, trade_exit_price = trade_exit_bar[used], trade_exit_price[used]
+    trade_exit_reason = trade_exit_reason[used]
+
+    equity = _equity_curve(times, closes, initial_balance, leverage, fee, trade_market, trade_side, trade_size,
+                           trade_entry_bar, trade_entry_price, trade_exit_bar, trade_exit_price, trade_exit_reason)
+
+    trade_pnl = trade_side * trade_size * (trade_exit_price - trade_entry_price) - \
+        fee * trade_size * (trade_entry_price + np.where(trade_exit_reason == _OPEN, 0, trade_exit_price))
+    market_names = np.array(markets, dtype=object)
+    trades = pd.DataFrame({
+        "Market": market_names[trade_market] if n_trades else [],
+        "Side": np.where(trade_side == 1, "buy", "sell"),
+        "Size": trade_size,
+        "EntryTime": pd.to_datetime([times[m][bar] for m, bar in zip(trade_market, trade_entry_bar)], utc=True),
+        "EntryPrice": trade_entry_price,
+        "ExitTime": pd.to_datetime([times[m][bar] for m, bar in zip(trade_market, trade_exit_bar)], utc=True),
+        "ExitPrice": trade_exit_price,
+        "ExitReason": _EXIT_REASONS[trade_exit_reason],
+        "Pnl": trade_pnl,
+    })
+    return PortfolioResult(equity=equity, trades=trades, metrics=portfolio_metrics(equity, trades, initial_balance))
+
+
+def _equity_curve(times: list, closes: list, initial_balance: float, leverage: float, fee: float,
+                  trade_market: np.ndarray, trade_side: np.ndarray, trade_size: np.ndarray,
+                  trade_entry_bar: np.ndarray, trade_entry_price: np.ndarray, trade_exit_bar: np.ndarray,
+                  trade_exit_price: np.ndarray, trade_exit_reason: np.ndarray) -> pd.DataFrame:
+    # Mark to market on the union of all candle times, built per trade with slices instead of per candle
+    grid = np.unique(np.concatenate(times)) if times else np.array([], dtype=np.int64)
+    n_grid = len(grid)
+    cash_flows = np.zeros(n_grid)
+    unrealized = np.zeros(n_grid)
+    margin_changes = np.zeros(n_grid + 1)
+    position_changes = np.zeros(n_grid + 1, dtype=np.int64)
+
+    for m in np.unique(trade_market):
+        grid_pos = np.searchsorted(grid, times[m])
+        # Last close of the market at every grid time (NaN before its first candle)
+        close_on_grid = np.full(n_grid, np.nan)
+        close_on_grid[grid_pos] = closes[m]
+        close_on_grid = close_on_grid[np.maximum.accumulate(np.where(~np.isnan(close_on_grid),
+                                                                     np.arange(n_grid), 0))]
+
+        for j in np.flatnonzero(trade_market == m):
+            entry, still_open = grid_pos[trade_entry_bar[j]], trade_exit_reason[j] == _OPEN
+            exit_ = n_grid if still_open else grid_pos[trade_exit_bar[j]]
+            side, size, entry_price = trade_side[j], trade_size[j], trade_entry_price[j]
+
+            unrealized[entry:exit_] += side * size * (close_on_grid[entry:exit_] - entry_price)
+            cash_flows[entry] -= fee * size * entry_price
+            if not still_open:
+                cash_flows[exit_] += side * size * (trade_exit_price[j] - entry_price) - \
+                    fee * size * trade_exit_price[j]
+            margin_changes[entry] += size * entry_price / leverage
+            margin_changes[exit_] -= size * entry_price / leverage
+            position_changes[entry] += 1
+            position_changes[exit_] -= 1
+
+    cash = initial_balance + np.cumsum(cash_flows)
+    return pd.DataFrame({
+        "equity": cash + unrealized,
+        "cash": cash,
+        "margin_used": np.cumsum(margin_changes)[:-1],
+        "open_positions": np.cumsum(position_changes)[:-1],
+    }, index=pd.to_datetime(grid, utc=True).rename("time"))
+
+
+def portfolio_metrics(equity: pd.DataFrame, trades: pd.DataFrame, initial_balance: float) -> dict:
+    equity_values = equity.equity.values
+    if len(equity_values) < 2:
+        return {}
+
+    drawdown = 1 - equity_values / np.maximum.accumulate(equity_values)
+    returns = np.diff(equity_values) / equity_values[:-1]
+    candles_per_year = pd.Timedelta(days=365) / pd.Series(equity.index).diff().median()
+    closed = trades[trades.ExitReason != "Open"]
+
+    return {
+        "FinalEquity": equity_values[-1],
+        "TotalReturn": (equity_values[-1] / initial_balance - 1) * 100,
+        "MaxDrawdown": np.max(drawdown) * 100,
+        "SharpeRatio": np.mean(returns) / np.std(returns) * np.sqrt(candles_per_year) if np.std(returns) else 0,
+        "Trades": len(closed),
+        "WinRate": (closed.Pnl > 0).mean() * 100 if len(closed) else 0,
+        "AvgTradePnl": closed.Pnl.mean() if len(closed) else 0,
+        "StopLosses": int((closed.ExitReason == "StopLoss").sum()),
+        "MaxOpenPositions": int(equity.open_positions.max()),
+        "AvgOpenPositions": equity.open_positions.mean(),
+        "MaxMarginUse": (equity.margin_used / equity.equity).max() * 100,
+    }
@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from ftx_client import candle_resolution
+from instrumentation import Metrics, metrics
+
+logger = logging.getLogger(__name__)
+
+OVERRUN_POLICIES = ("skip", "coalesce")
+
+
+class ScheduledJob:
+    def __init__(self, name: str, resolution: int, func: Callable[[float], None], delay: float, overrun: str,
+                 job_metrics: Metrics) -> None:
+        self.name = name
+        self.resolution = resolution
+        self.func = func
+        self.delay = delay
+        self.overrun = overrun
+        self.metrics = job_metrics
+        self.next_close = None
+        self.running = False
+        # Candle close of the run coalesced into the one in progress
+        self.pending = None
+        self.runs = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.last_lateness = None
+        self.max_lateness = 0.
+        self.total_lateness = 0.
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "skipped": self.skipped, "coalesced": self.coalesced,
+                "last_lateness": self.last_lateness, "max_lateness": self.max_lateness,
+                "mean_lateness": self.total_lateness / self.runs if self.runs else None}
+
+
+class CandleScheduler:
+    """
+    Calls every job's func(candle_close) `delay` seconds after each candle close of its interval, instead of
+    sleeping a fixed time after a run, so a scan never drifts away from the close however long the previous one
+    took. Jobs run in parallel threads. A job still running at its next close is either skipped for that close or
+    coalesced, run once more right after it finishes for the latest close it missed. The lateness of every run
+    (start minus candle close) is kept per job and recorded as lateness:<name> to the job's metrics, the global
+    metrics if not given.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time) -> None:
+        self.jobs: List[ScheduledJob] = []
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._executor = None
+        self._thread = None
+
+    def add_job(self, interval: str, func: Callable[[float], None], name: Optional[str] = None, delay: float = 0,
+                overrun: str = "coalesce", job_metrics: Optional[Metrics] = None) -> ScheduledJob:
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError(f"Overrun policy must be one of {OVERRUN_POLICIES}, not {overrun}")
+        resolution = candle_resolution(interval)
+        job = ScheduledJob(name or interval, resolution, func, delay, overrun, job_metrics or metrics)
+        job.next_close = (self._clock() // resolution + 1) * resolution
+        self.jobs.append(job)
+        return job
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {job.name: job.stats() for job in self.jobs}
+
+    def run(self) -> None:
+        # Blocks until stop()
+        self._stopped.clear()
+        with ThreadPoolExecutor(max_workers=max(len(self.jobs), 1), thread_name_prefix="scheduler") as executor:
+            self._executor = executor
+            while not self._stopped.is_set():
+                now = self._clock()
+                for job in self.jobs:
+                    if job.next_close + job.delay <= now:
+                        # After a suspend or clock jump only the latest close is due
+                        close = (now - job.delay) // job.resolution * job.resolution
+                        job.next_close = close + job.resolution
+                        self._dispatch(job, close)
+                wake_up = min(job.next_close + job.delay for job in self.jobs) if self.jobs else now + 1
+                self._stopped.wait(max(wake_up - self._clock(), 0.))
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.run, name="candle-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        # Running jobs are finished first
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _dispatch(self, job: ScheduledJob, close: float) -> None:
+        with self._lock:
+            if not job.running:
+                job.running = True
+                self._executor.submit(self._run, job, close)
+            elif job.overrun == "coalesce":
+                if job.pending is not None:
+                    job.skipped += 1
+                job.pending = close
+                job.coalesced += 1
+            else:
+                job.skipped += 1
+                logger.warning(f"{job.name}: still running at the {close:.0f} close, skipped")
+
+    def _run(self, job: ScheduledJob, close: float) -> None:
+        while True:
+            lateness = self._clock() - close
+            with self._lock:
+                job.runs += 1
+                job.last_lateness = lateness
+                job.max_lateness = max(job.max_lateness, lateness)
+                job.total_lateness += lateness
+            job.metrics.record(f"lateness:{job.name}", lateness)
+            logger.info(f"{job.name}: running for the {close:.0f} close, {lateness:.2f}s after it")
+            try:
+                job.func(close)
+            except Exception as exc:
+                logger.error(f"{job.name} failed: {exc}")
+
+            with self._lock:
+                if job.pending is None:
+                    job.running = False
+                    return
+                close, job.pending = job.pending, None
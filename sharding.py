@@ -0,0 +1,351 @@
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from bisect import bisect
+from multiprocessing import Process
+from multiprocessing.connection import Client, Listener
+from typing import Callable, Dict, List, Optional, Tuple
+
+import supertrend_4h as st4h
+from chart_renderer import RenderQueue, prune_charts
+from ftx_client import FtxClient
+from instrumentation import Metrics, metrics
+from scheduler import CandleScheduler
+from telegram_api_manager import TelegramAPIManager
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import SHARD_AUTHKEY
+except ImportError:
+    # Without a shared key only `sharding.py local` runs, its workers are handed the coordinator's random process
+    # key explicitly. The coordinator and worker commands refuse to start.
+    SHARD_AUTHKEY = None
+
+settings = st4h.settings
+
+
+def _hash(key: str) -> int:
+    # Python's hash() is salted per process, every process has to agree on the ring
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of market names onto shards: every shard owns `replicas` points on a ring of hashes and a
+    market belongs to the shard of the first point after its own hash. The assignment only depends on the shard
+    names, so workers find their markets without asking anyone, and adding or removing a shard moves about 1/N of
+    the markets instead of reshuffling all of them.
+    """
+
+    def __init__(self, shards: List[str], replicas: int = 100) -> None:
+        if not shards:
+            raise ValueError("A hash ring needs at least one shard")
+        self.shards = list(shards)
+        points = sorted((_hash(f"{shard}#{idx}"), shard) for shard in self.shards for idx in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard_for(self, market: str) -> str:
+        return self._owners[bisect(self._hashes, _hash(market)) % len(self._hashes)]
+
+    def assign(self, markets: List[str]) -> Dict[str, List[str]]:
+        shards = {shard: [] for shard in self.shards}
+        for market in markets:
+            shards[self.shard_for(market)].append(market)
+        return shards
+
+
+def coordinator_address() -> Tuple[str, int]:
+    return settings["sharding"]["coordinator_host"], settings["sharding"]["coordinator_port"]
+
+
+def _authkey() -> bytes:
+    # Never None: multiprocessing connections without an authkey skip authentication altogether, and the
+    # coordinator unpickles whatever a connected peer sends
+    return SHARD_AUTHKEY.encode() if SHARD_AUTHKEY else bytes(multiprocessing.current_process().authkey)
+
+
+def connect(address: Tuple[str, int], authkey: Optional[bytes] = None, timeout: float = 60):
+    # Workers may start before the coordinator listens
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return Client(address, authkey=authkey or _authkey())
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+
+
+class ShardWorker:
+    """
+    Scans the markets of one shard at the candle closes of every scheduled interval, and sends each new position
+    with its rendered chart to the coordinator. Workers only read public market data, they never alert, journal
+    or trade. Messages are dicts with a "type" of hello, position, cycle or error.
+    """
+
+    def __init__(self, shard: str, ring: HashRing, address: Tuple[str, int] = None,
+                 intervals: Optional[List[str]] = None, market_params: Optional[dict] = None,
+                 ftx: Optional[FtxClient] = None, authkey: Optional[bytes] = None) -> None:
+        self.shard = shard
+        self.ring = ring
+        if intervals is None:
+            intervals = st4h.scheduled_intervals() if market_params is None else settings["schedule"]["intervals"]
+        self.intervals = intervals
+        self.market_params = market_params
+        # Markets belong to a single shard, workers on one host can share the candle store folder
+        self.ftx = ftx or FtxClient(candle_store=st4h.candle_store)
+        self._connection = connect(address or coordinator_address(), authkey=authkey)
+        self._send_lock = threading.Lock()
+        self._render_queues = {}
+        # Intervals scan in parallel, each records and reports its own metrics
+        self._metrics = {}
+
+        self.scheduler = CandleScheduler()
+        for interval in self.intervals:
+            self._metrics[interval] = Metrics(enabled=metrics.enabled)
+            figure_path, _ = st4h.timeframe_paths(interval)
+            self._render_queues[interval] = RenderQueue(os.path.join(figure_path, shard), dpi=settings["charts"]["dpi"],
+                                                        fmt=settings["charts"]["format"])
+            self.scheduler.add_job(interval, self._job(interval), delay=settings["schedule"]["delay_seconds"],
+                                   overrun=settings["schedule"]["overrun"], job_metrics=self._metrics[interval])
+        self.send({"type": "hello", "shard": shard, "intervals": self.intervals})
+
+    def send(self, message: dict) -> None:
+        # Timeframes scan in parallel threads over one connection
+        with self._send_lock:
+            self._connection.send(message)
+
+    def markets(self) -> List[str]:
+        return [market for market in st4h.perpetual_markets(self.ftx) if self.ring.shard_for(market) == self.shard]
+
+    def scan(self, interval: str, candle_close: float) -> None:
+        with metrics.collect(self._metrics[interval]):
+            self._scan(interval, candle_close)
+
+    def _scan(self, interval: str, candle_close: float) -> None:
+        started = time.monotonic()
+        markets = self.markets()
+        if self.market_params is None:
+            market_params = st4h.load_market_params(markets, interval)
+        else:
+            market_params = {market: self.market_params[market] for market in markets if market in self.market_params}
+
+        render_queue = self._render_queues[interval]
+        render_queue.prune(max_age=settings["charts"]["max_age_hours"] * 60 * 60)
+        scanner = st4h.create_scanner(self.ftx, interval, st4h.timeframe_start_time(interval),
+                                      scan_metrics=self._metrics[interval])
+        n_signals = 0
+        for new_position, figure_path in st4h.scan_signals(self.ftx, scanner, render_queue, markets, market_params,
+                                                           interval):
+            # The chart goes along, the coordinator may run on another host
+            with open(figure_path, "rb") as image_file:
+                chart = image_file.read()
+            self.send({"type": "position", "shard": self.shard, "interval": interval, "position": new_position,
+                       "chart": chart, "chart_name": os.path.basename(figure_path)})
+            n_signals += 1
+
+        summary = st4h.report_cycle(scanner, market_params, interval) if scanner.metrics.enabled else None
+        self.send({"type": "cycle", "shard": self.shard, "interval": interval, "close": candle_close,
+                   "markets": len(market_params), "signals": n_signals, "seconds": time.monotonic() - started,
+                   "summary": summary})
+
+    def _job(self, interval: str) -> Callable[[float], None]:
+        def job(candle_close: float) -> None:
+            try:
+                self.scan(interval, candle_close)
+            except Exception as exc:
+                logger.error(f"{self.shard} {interval}: {exc}")
+                try:
+                    self.send({"type": "error", "shard": self.shard, "interval": interval, "error": str(exc)})
+                except OSError:
+                    # Lost the coordinator, nothing left to report to
+                    logger.error(f"{self.shard}: coordinator connection lost")
+                    self.scheduler.stop()
+        return job
+
+    def run(self) -> None:
+        try:
+            self.scheduler.run()
+        finally:
+            for render_queue in self._render_queues.values():
+                render_queue.close()
+            self._connection.close()
+
+
+class Coordinator:
+    """
+    Owns everything with side effects in a sharded deployment: the Telegram alerts, the trades journals and the
+    position closes. Workers connect over a multiprocessing connection (TCP, so they can run on other hosts) and
+    their messages are handled one at a time from a queue, so journal writes and orders never race. Closes are
+    reported when the shard that triggered them finishes its cycle, like in a single process cycle. Only workers
+    holding the authkey can connect, it listens on the coordinator_host of settings.json (localhost by default).
+    """
+
+    def __init__(self, ftx: FtxClient, tapi: TelegramAPIManager, ring: HashRing,
+                 address: Tuple[str, int] = None, authkey: Optional[bytes] = None) -> None:
+        self.ftx = ftx
+        self.tapi = tapi
+        self.ring = ring
+        self._listener = Listener(address or coordinator_address(), authkey=authkey or _authkey())
+        self.address = self._listener.address
+        self._messages = queue.Queue()
+        self.connected = set()
+        self.trades = {}
+        self._pending_closes = {}
+        self._cycles = {}
+
+    def start(self) -> None:
+        threading.Thread(target=self._accept, name="coordinator-accept", daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                connection = self._listener.accept()
+            except OSError:
+                # Listener closed
+                return
+            except Exception as exc:
+                # Wrong authkey, the listener keeps serving
+                logger.warning(f"Rejected a worker connection: {exc}")
+                continue
+            threading.Thread(target=self._receive, args=(connection,), daemon=True).start()
+
+    def _receive(self, connection) -> None:
+        shard = None
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                self._messages.put({"type": "disconnect", "shard": shard})
+                return
+            shard = message.get("shard", shard)
+            self._messages.put(message)
+
+    def run(self) -> None:
+        # Blocks until close()
+        while True:
+            message = self._messages.get()
+            if message is None:
+                return
+            try:
+                self.handle(message)
+            except Exception as exc:
+                logger.error(f"Handling {message['type']} from {message.get('shard')} failed: {exc}")
+                self.tapi.send_message(f"Exception: {exc}")
+
+    def handle(self, message: dict) -> None:
+        shard, kind = message.get("shard"), message["type"]
+        if kind == "hello":
+            self.connected.add(shard)
+            logger.info(f"{shard} connected ({', '.join(message['intervals'])}), "
+                        f"{len(self.connected)}/{len(self.ring.shards)} shards")
+        elif kind == "position":
+            self._handle_position(shard, message)
+        elif kind == "cycle":
+            self._handle_cycle(shard, message)
+        elif kind == "error":
+            logger.error(f"{shard} {message['interval']}: {message['error']}")
+            self.tapi.send_message(f"Exception ({shard}, {message['interval']}): {message['error']}")
+        elif kind == "disconnect":
+            self.connected.discard(shard)
+            logger.warning(f"{shard} disconnected")
+            self.tapi.send_message(f"Shard {shard} disconnected, its markets are not scanned")
+
+    def _handle_position(self, shard: str, message: dict) -> None:
+        interval = message["interval"]
+        figure_folder, trades_file = st4h.timeframe_paths(interval)
+        os.makedirs(figure_folder, exist_ok=True)
+        figure_path = os.path.join(figure_folder, message["chart_name"])
+        with open(figure_path, "wb") as image_file:
+            image_file.write(message["chart"])
+
+        logger.info(f"New Position from {shard}: {message['position']}")
+        pending_close = st4h.handle_position(self.ftx, self.tapi, self.trades.setdefault(interval, []),
+                                             message["position"], figure_path, trades_file)
+        if pending_close is not None:
+            self._pending_closes.setdefault((shard, interval), []).append(pending_close)
+
+    def _handle_cycle(self, shard: str, message: dict) -> None:
+        interval = message["interval"]
+        st4h.report_closes(self.tapi, self._pending_closes.pop((shard, interval), []))
+        figure_folder, _ = st4h.timeframe_paths(interval)
+        prune_charts(figure_folder, settings["charts"]["max_age_hours"] * 60 * 60, settings["charts"]["format"])
+
+        cycles = self._cycles.setdefault((interval, message["close"]), {})
+        cycles[shard] = message
+        if len(cycles) == len(self.ring.shards):
+            del self._cycles[interval, message["close"]]
+            slowest = max(cycles.values(), key=lambda cycle: cycle["seconds"])
+            logger.info(f"{interval} cycle: {sum(cycle['markets'] for cycle in cycles.values())} markets over "
+                        f"{len(cycles)} shards, {sum(cycle['signals'] for cycle in cycles.values())} signals, "
+                        f"slowest {slowest['shard']} {slowest['seconds']:.1f}s")
+
+    def close(self) -> None:
+        self._listener.close()
+        self._messages.put(None)
+
+
+def create_ring() -> HashRing:
+    return HashRing(settings["sharding"]["shards"], replicas=settings["sharding"]["replicas"])
+
+
+def run_coordinator(workers: Optional[List[Process]] = None, authkey: Optional[bytes] = None) -> None:
+    # Local workers are forked before the coordinator starts its threads, they connect when it listens
+    for worker in workers or []:
+        worker.start()
+    coordinator = Coordinator(FtxClient(api_key=st4h.API_KEY, api_secret=st4h.API_SECRET,
+                                        order_tracker=st4h.create_order_tracker()),
+                              TelegramAPIManager(group=False), create_ring(), authkey=authkey)
+    coordinator.start()
+    logger.info(f"Coordinator listening on {coordinator.address}")
+    try:
+        coordinator.run()
+    finally:
+        coordinator.close()
+        for worker in workers or []:
+            worker.terminate()
+
+
+def run_worker(shard: str, address: Optional[Tuple[str, int]] = None, authkey: Optional[bytes] = None) -> None:
+    ring = create_ring()
+    if shard not in ring.shards:
+        raise ValueError(f"Unknown shard {shard}, shards are {ring.shards}")
+    ShardWorker(shard, ring, address, authkey=authkey).run()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Run the scan loop as a coordinator and sharded workers")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("coordinator", help="Alerts, journals and closes positions for the workers")
+    worker_parser = subparsers.add_parser("worker", help="Scans one shard of the markets")
+    worker_parser.add_argument("shard")
+    worker_parser.add_argument("--coordinator", metavar="HOST:PORT", help="Coordinator address from settings.json "
+                                                                         "if not given")
+    subparsers.add_parser("local", help="Coordinator with a worker process per shard on this host")
+    subparsers.add_parser("assign", help="Print the shard of every scanned market")
+    args = arg_parser.parse_args()
+    if args.command in ("coordinator", "worker") and not SHARD_AUTHKEY:
+        arg_parser.error("Separate coordinator and worker processes need a shared SHARD_AUTHKEY in config.py")
+
+    if args.command == "coordinator":
+        run_coordinator()
+    elif args.command == "worker":
+        worker_address = None
+        if args.coordinator:
+            host, port = args.coordinator.rsplit(":", 1)
+            worker_address = (host, int(port))
+        run_worker(args.shard, worker_address)
+    elif args.command == "local":
+        local_authkey = _authkey()
+        run_coordinator([Process(target=run_worker, args=(shard, None, local_authkey), name=shard)
+                         for shard in settings["sharding"]["shards"]], authkey=local_authkey)
+    else:
+        for shard_name, shard_markets in create_ring().assign(st4h.perpetual_markets(FtxClient())).items():
+            print(f"{shard_name}: {len(shard_markets)} markets: {', '.join(shard_markets)}")
@@ -0,0 +1,243 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import time
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+import supertrend_4h as st4h
+from benchmarks import load_candle_fixtures, load_markets_fixture, regime_switching_ohlcv
+from candle_store import candles_to_dataframe
+from chart_renderer import RenderQueue
+from ftx_client import FtxClient, candle_resolution, str_to_datetime
+from indicator_panel import IndicatorPanel
+from instrumentation import metrics
+from mock_exchange import MockExchange, MockFtxClient, ohlcv_to_candles
+from order_tracker import LocalFillsSource, OrderTracker
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingTelegram:
+    """Takes the place of TelegramAPIManager in a replay, messages are kept instead of sent."""
+
+    def __init__(self) -> None:
+        self.messages = []
+
+    def send_message(self, text: str, markdown: bool = False) -> None:
+        self.messages.append(text)
+
+    def send_photo(self, image_path: str, caption: str = None, markdown: bool = False) -> None:
+        self.messages.append(caption)
+
+
+def synthetic_exchange(n_markets: int, n_candles: int, resolution: int, end_time: float, seed: int = 0) \
+        -> MockExchange:
+    # Regime switching markets whose last candle starts at end_time
+    start = (end_time // resolution - n_candles + 1) * resolution
+    return MockExchange({(f"MOCK{idx}-PERP", resolution): ohlcv_to_candles(
+        regime_switching_ohlcv(n_candles, seed=seed + idx), resolution, start) for idx in range(n_markets)})
+
+
+def fixture_exchange(folder_path: str) -> MockExchange:
+    # Recorded candles and markets, see benchmarks.py --record-fixture
+    candles = {}
+    for name, fixture in load_candle_fixtures(folder_path).items():
+        market, resolution = name.rsplit("_", 1)
+        candles[market, int(resolution)] = fixture
+    return MockExchange(candles, market_info=load_markets_fixture(folder_path))
+
+
+def _percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    p50, p95 = np.percentile(values, [50, 95])
+    return {"p50": p50, "p95": p95, "max": max(values)}
+
+
+class CycleReplay:
+    """
+    Runs the 4h scan loop of supertrend_4h (run_cycle) against a MockExchange whose clock steps from one candle
+    close to the next, as fast as possible or `speed` times faster than real time. With execute_orders every new
+    position is also ordered like /makeorder would, so the replay covers the whole signal -> order pipeline; opposite
+    positions are closed through an order tracker fed by the exchange's fills. Collects the wall time of every
+    cycle and the latency from the candle close (the start of the cycle) to every order acknowledgement. With
+    market_params given every cycle's signals are checked against the crossings on the candle that just closed,
+    counted straight from the exchange's candles.
+    """
+
+    def __init__(self, exchange: MockExchange, folder_path: str, market_params: Optional[dict] = None,
+                 latency: float = 0, error_rate: float = 0, seed: int = 0, execute_orders: bool = True,
+                 dpi: int = 50) -> None:
+        self.exchange = exchange
+        self.folder_path = folder_path
+        self.market_params = market_params
+        self.execute_orders = execute_orders
+        self.resolution = candle_resolution(st4h.settings["analysis"]["interval"])
+
+        source = LocalFillsSource()
+        exchange.listeners.append(source.publish)
+        # Quotes are cached for wall clock seconds, a replayed cycle must not reuse the previous one's
+        self.ftx = MockFtxClient(exchange, latency=latency, error_rate=error_rate, seed=seed, quote_ttl=0,
+                                 order_tracker=OrderTracker(source, load_positions=exchange.get_positions,
+                                                            clock=exchange.clock))
+        self.tapi = RecordingTelegram()
+        self.render_queue = RenderQueue(os.path.join(folder_path, "figures"), dpi=dpi)
+        self.trades = []
+        self.order_latencies = []
+        self._cycle_start = None
+        self._frames = {}
+        # The stage timings and market counts of a cycle come from the instrumentation
+        metrics.enabled = True
+
+    def _execute(self, new_position: dict) -> None:
+        order, stop_loss = self.ftx.generate_order(new_position)
+        self.ftx.place_order(**order)
+        self.ftx.place_conditional_order(market=stop_loss["market"], side=stop_loss["side"], size=stop_loss["size"],
+                                         type=stop_loss["type"], reduce_only=stop_loss["reduce_only"],
+                                         trigger_price=stop_loss["trigger_price"])
+        self.order_latencies.append(time.perf_counter() - self._cycle_start)
+
+    def expected_signals(self, now: float) -> Optional[int]:
+        # Crossings on the candle that closed at `now`, over the same history window as the scan
+        if self.market_params is None:
+            return None
+        analysis = st4h.settings["analysis"]
+        start = int(str_to_datetime(analysis["start_time"], now=datetime.datetime.fromtimestamp(now)).timestamp())
+        start, end = pd.Timestamp(start, unit="s", tz="UTC"), pd.Timestamp(now, unit="s", tz="UTC")
+        n_signals = 0
+        for market in self.exchange.markets:
+            if market not in self.market_params:
+                continue
+            if market not in self._frames:
+                self._frames[market] = candles_to_dataframe(FtxClient._parse_candles(
+                    self.exchange.candles[market, self.resolution]))
+            df = self._frames[market]
+            df = df[(df.index >= start) & (df.index < end)]
+            if len(df) < analysis["min_data_length"]:
+                continue
+            params = self.market_params[market]
+            panel = IndicatorPanel(df, look_back=int(params["Lookback"]), multiplier=params["Multiplier"])
+            n_signals += int(panel["st_signal"][-1] != 0)
+        return n_signals
+
+    def run_cycle(self, now: float) -> dict:
+        self.exchange.advance(now)
+        expected_signals = self.expected_signals(now)
+        n_trades, n_requests, n_rejected = len(self.trades), self.ftx.request_count, self.ftx.rejected_count
+        n_orders = len(self.order_latencies)
+        metrics.reset()
+        self._cycle_start = time.perf_counter()
+        error, summary = None, None
+        try:
+            summary = st4h.run_cycle(self.ftx, self.tapi, self.render_queue, self.trades,
+                                     market_params=self.market_params,
+                                     on_position=self._execute if self.execute_orders else None,
+                                     trades_file=os.path.join(self.folder_path, "trades.json"))
+        except Exception as exc:
+            # The live loop gives up on the cycle too
+            error = str(exc)
+            logger.error(f"Cycle at {now:.0f} failed: {exc}")
+
+        if summary is None:
+            summary = metrics.summary()
+        return {"time": now, "seconds": time.perf_counter() - self._cycle_start,
+                "markets": summary["stages"].get("scan:indicators", {}).get("calls", 0),
+                "signals": len(self.trades) - n_trades, "expected_signals": expected_signals,
+                "orders": len(self.order_latencies) - n_orders,
+                "requests": self.ftx.request_count - n_requests, "rejected": self.ftx.rejected_count - n_rejected,
+                "error": error, "stages": {stage: values["seconds"] for stage, values in summary["stages"].items()}}
+
+    def run(self, start: float, end: float, speed: Optional[float] = None) -> List[dict]:
+        start = start // self.resolution * self.resolution
+        cycle_times = np.arange(start, end + 1, self.resolution)
+        wall_start = time.monotonic()
+        cycles = []
+        for now in cycle_times:
+            if speed:
+                time.sleep(max(0., wall_start + (now - start) / speed - time.monotonic()))
+            cycle = self.run_cycle(float(now))
+            cycles.append(cycle)
+            logger.info(f"{time.strftime('%Y-%m-%d %H:%M', time.gmtime(now))}: {cycle['markets']} markets in "
+                        f"{cycle['seconds']:.2f}s, {cycle['signals']} signals, {cycle['orders']} orders, "
+                        f"{cycle['rejected']}/{cycle['requests']} requests rejected")
+        return cycles
+
+    def close(self) -> None:
+        self.render_queue.close()
+        self.ftx._order_tracker.stop()
+
+    def report(self, cycles: List[dict]) -> dict:
+        seconds = sum(cycle["seconds"] for cycle in cycles)
+        markets = sum(cycle["markets"] for cycle in cycles)
+        return {
+            "cycles": len(cycles),
+            "failed_cycles": sum(cycle["error"] is not None for cycle in cycles),
+            "seconds": seconds,
+            "markets_per_second": markets / seconds if seconds else 0.,
+            "cycle_seconds": _percentiles([cycle["seconds"] for cycle in cycles]),
+            "signals": sum(cycle["signals"] for cycle in cycles),
+            # Cycles that failed are not expected to signal
+            "signal_mismatches": [cycle["time"] for cycle in cycles if cycle["error"] is None and
+                                  cycle["expected_signals"] is not None and
+                                  cycle["signals"] != cycle["expected_signals"]],
+            "orders": len(self.order_latencies),
+            "order_latency": _percentiles(self.order_latencies),
+            "requests": self.ftx.request_count,
+            "rejected": self.ftx.rejected_count,
+            "messages": len(self.tapi.messages),
+        }
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Replay 4h scan cycles against an offline mock exchange")
+    arg_parser.add_argument("--markets", type=int, default=100, help="Number of synthetic markets")
+    arg_parser.add_argument("--fixtures", metavar="FOLDER", help="Replay recorded candle fixtures instead")
+    arg_parser.add_argument("--days", type=float, default=30, help="Days of cycles to replay")
+    arg_parser.add_argument("--history-days", type=float, default=110, help="Synthetic history before the replay")
+    arg_parser.add_argument("--speed", type=float, default=None,
+                            help="Simulated seconds per wall clock second, as fast as possible if not given")
+    arg_parser.add_argument("--latency", type=float, default=0, help="Seconds added to every request")
+    arg_parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests that fail")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--multiplier", type=float, default=3)
+    arg_parser.add_argument("--lookback", type=int, default=10)
+    arg_parser.add_argument("--no-orders", action="store_true", help="Only alert, like the live loop")
+    arg_parser.add_argument("--output", default="simulation", help="Folder for charts, trades and reports")
+    args = arg_parser.parse_args()
+
+    resolution = candle_resolution(st4h.settings["analysis"]["interval"])
+    end_time = time.time() // resolution * resolution
+    if args.fixtures:
+        mock_exchange = fixture_exchange(args.fixtures)
+        end_time = max(candles[-1]["time"] / 1000 for candles in mock_exchange.candles.values())
+    else:
+        n_candles = int((args.history_days + args.days) * 86400 // resolution)
+        mock_exchange = synthetic_exchange(args.markets, n_candles, resolution, end_time, seed=args.seed)
+
+    os.makedirs(args.output, exist_ok=True)
+    # The per cycle instrumentation reports of run_cycle go to the output folder
+    st4h.settings["instrumentation"].update(report_file=os.path.join(args.output, "cycles.jsonl"),
+                                            prometheus_file=None, profile_slowest_market=False)
+
+    params = {"Multiplier": args.multiplier, "Lookback": args.lookback, "TheDfactor": 0.}
+    market_params = {market: params for market in mock_exchange.markets}
+    replay = CycleReplay(mock_exchange, args.output, market_params=market_params, latency=args.latency,
+                         error_rate=args.error_rate, seed=args.seed, execute_orders=not args.no_orders)
+    try:
+        replay_cycles = replay.run(end_time - args.days * 86400, end_time, speed=args.speed)
+    finally:
+        replay.close()
+
+    replay_report = replay.report(replay_cycles)
+    with open(os.path.join(args.output, "report.json"), "w") as json_file:
+        json.dump(replay_report, json_file, indent=2)
+    print(json.dumps(replay_report, indent=2))
+    if replay_report["signal_mismatches"]:
+        logger.error(f"{len(replay_report['signal_mismatches'])} cycles did not signal every crossing on the candle "
+                     f"that closed")
+        raise SystemExit(1)
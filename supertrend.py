@@ -1,127 +1,181 @@
-import os
+import json
 from typing import Tuple
 
-import matplotlib.dates as mdates
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from talib import EMA, SMA, RSI, STOCH
 
+from instrumentation import metrics
+
+
+def _jit(func):
+    # Compile hot loops with numba when it is installed, otherwise run them as plain Python over NumPy arrays
+    try:
+        from numba import njit
+    except ImportError:
+        return func
+    return njit(cache=True, nogil=True)(func)
+
+
+def true_range(high: np.ndarray, low: np.ndarray, close: np.ndarray) -> np.ndarray:
+    prev_close = np.empty_like(close)
+    prev_close[0] = np.nan
+    prev_close[1:] = close[:-1]
+    tr = np.fmax(high - low, np.abs(high - prev_close))
+    return np.fmax(tr, np.abs(low - prev_close))
+
+
+@_jit
+def ewm_mean(values: np.ndarray, com: float) -> np.ndarray:
+    # Same recursion as pandas ewm(com).mean() with adjust=True, so results match bit for bit
+    alpha = 1. / (1. + com)
+    old_wt_factor = 1. - alpha
+    output = np.empty(values.shape[0])
+    if values.shape[0] == 0:
+        return output
+
+    weighted = values[0]
+    nobs = 1 if weighted == weighted else 0
+    output[0] = weighted if nobs else np.nan
+    old_wt = 1.
+    for i in range(1, values.shape[0]):
+        cur = values[i]
+        is_observation = cur == cur
+        nobs += is_observation
+        if weighted == weighted:
+            old_wt *= old_wt_factor
+            if is_observation:
+                if weighted != cur:
+                    weighted = ((old_wt * weighted) + cur) / (old_wt + 1.)
+                old_wt += 1.
+        elif is_observation:
+            weighted = cur
+        output[i] = weighted if nobs else np.nan
+    return output
+
+
+@_jit
+def _supertrend_loop(upper_band: np.ndarray, lower_band: np.ndarray, close: np.ndarray) -> np.ndarray:
+    # Bands are (params x candles), one row per parameter combination sharing the same close
+    n_params, n = upper_band.shape
+    st = np.zeros((n_params, n))
+    if n == 0:
+        return st
+
+    for p in range(n_params):
+        # Bands and supertrend are seeded with 0 on the first candle
+        final_upper = 0.
+        final_lower = 0.
+        for i in range(1, n):
+            prev_upper, prev_lower = final_upper, final_lower
+
+            # FINAL UPPER BAND
+            if upper_band[p, i] < prev_upper or close[i - 1] > prev_upper:
+                final_upper = upper_band[p, i]
+
+            # FINAL LOWER BAND
+            if lower_band[p, i] > prev_lower or close[i - 1] < prev_lower:
+                final_lower = lower_band[p, i]
+
+            # SUPERTREND
+            if st[p, i - 1] == prev_upper and close[i] < final_upper:
+                st[p, i] = final_upper
+            elif st[p, i - 1] == prev_upper and close[i] > final_upper:
+                st[p, i] = final_lower
+            elif st[p, i - 1] == prev_lower and close[i] > final_lower:
+                st[p, i] = final_lower
+            elif st[p, i - 1] == prev_lower and close[i] < final_lower:
+                st[p, i] = final_upper
+    return st
+
+
+@metrics.timed("supertrend_kernel")
+def supertrend_kernel(high: np.ndarray, low: np.ndarray, close: np.ndarray, look_back: int, multiplier: float) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    high = np.ascontiguousarray(high, dtype=np.float64)
+    low = np.ascontiguousarray(low, dtype=np.float64)
+    close = np.ascontiguousarray(close, dtype=np.float64)
+    metrics.count("supertrend_rows", len(close))
 
-def supertrend_analysis(high, low, close, look_back, multiplier):
     # ATR
-    tr1 = pd.DataFrame(high - low)
-    tr2 = pd.DataFrame(abs(high - close.shift(1)))
-    tr3 = pd.DataFrame(abs(low - close.shift(1)))
-    frames = [tr1, tr2, tr3]
-    tr = pd.concat(frames, axis=1, join='inner').max(axis=1)
-    atr = tr.ewm(look_back).mean()
+    atr = ewm_mean(true_range(high, low, close), float(look_back))
 
     # H/L AVG AND BASIC UPPER & LOWER BAND
     hl_avg = (high + low) / 2
-    upper_band = (hl_avg + multiplier * atr).dropna()
-    lower_band = (hl_avg - multiplier * atr).dropna()
+    upper_band = hl_avg + multiplier * atr
+    lower_band = hl_avg - multiplier * atr
 
-    # FINAL UPPER BAND
-    final_bands = pd.DataFrame(columns=['upper', 'lower'])
-    final_bands.iloc[:, 0] = [x for x in upper_band - upper_band]
-    final_bands.iloc[:, 1] = final_bands.iloc[:, 0]
-
-    for i in range(len(final_bands)):
-        if i == 0:
-            final_bands.iloc[i, 0] = 0
-        else:
-            if (upper_band[i] < final_bands.iloc[i - 1, 0]) | (close[i - 1] > final_bands.iloc[i - 1, 0]):
-                final_bands.iloc[i, 0] = upper_band[i]
-            else:
-                final_bands.iloc[i, 0] = final_bands.iloc[i - 1, 0]
-
-    # FINAL LOWER BAND
-    for i in range(len(final_bands)):
-        if i == 0:
-            final_bands.iloc[i, 1] = 0
-        else:
-            if (lower_band[i] > final_bands.iloc[i - 1, 1]) | (close[i - 1] < final_bands.iloc[i - 1, 1]):
-                final_bands.iloc[i, 1] = lower_band[i]
-            else:
-                final_bands.iloc[i, 1] = final_bands.iloc[i - 1, 1]
-
-    # SUPERTREND
-    supertrend = pd.DataFrame(columns=[f'supertrend_{look_back}'])
-    supertrend.iloc[:, 0] = [x for x in final_bands['upper'] - final_bands['upper']]
-
-    for i in range(len(supertrend)):
-        if i == 0:
-            supertrend.iloc[i, 0] = 0
-        elif supertrend.iloc[i - 1, 0] == final_bands.iloc[i - 1, 0] and close[i] < final_bands.iloc[i, 0]:
-            supertrend.iloc[i, 0] = final_bands.iloc[i, 0]
-        elif supertrend.iloc[i - 1, 0] == final_bands.iloc[i - 1, 0] and close[i] > final_bands.iloc[i, 0]:
-            supertrend.iloc[i, 0] = final_bands.iloc[i, 1]
-        elif supertrend.iloc[i - 1, 0] == final_bands.iloc[i - 1, 1] and close[i] > final_bands.iloc[i, 1]:
-            supertrend.iloc[i, 0] = final_bands.iloc[i, 1]
-        elif supertrend.iloc[i - 1, 0] == final_bands.iloc[i - 1, 1] and close[i] < final_bands.iloc[i, 1]:
-            supertrend.iloc[i, 0] = final_bands.iloc[i, 0]
-
-    supertrend = supertrend.set_index(upper_band.index)
-    supertrend = supertrend.dropna()[1:]
+    st = _supertrend_loop(upper_band[np.newaxis], lower_band[np.newaxis], close)[0]
+    st[:1] = np.nan
 
     # ST UPTREND/DOWNTREND
-    upt = []
-    dt = []
-    close = close.iloc[len(close) - len(supertrend):]
-
-    for i in range(len(supertrend)):
-        if close[i] > supertrend.iloc[i, 0]:
-            upt.append(supertrend.iloc[i, 0])
-            dt.append(np.nan)
-        elif close[i] < supertrend.iloc[i, 0]:
-            upt.append(np.nan)
-            dt.append(supertrend.iloc[i, 0])
-        else:
-            upt.append(np.nan)
-            dt.append(np.nan)
-
-    st, upt, dt = pd.Series(supertrend.iloc[:, 0]), pd.Series(upt), pd.Series(dt)
-    upt.index, dt.index = supertrend.index, supertrend.index
+    upt = np.where(close > st, st, np.nan)
+    dt = np.where(close < st, st, np.nan)
 
     return st, upt, dt
 
 
-def get_supertrend_signals(prices, st):
-    long_trigger = []
-    short_trigger = []
-    st_signal = []
-    signal = 0
-
-    for i in range(len(st)):
-        if st[i - 1] > prices[i - 1] and st[i] < prices[i]:
-            if signal != 1:
-                long_trigger.append(prices[i])
-                short_trigger.append(np.nan)
-                signal = 1
-                st_signal.append(signal)
-            else:
-                long_trigger.append(np.nan)
-                short_trigger.append(np.nan)
-                st_signal.append(0)
-        elif st[i - 1] < prices[i - 1] and st[i] > prices[i]:
-            if signal != -1:
-                long_trigger.append(np.nan)
-                short_trigger.append(prices[i])
-                signal = -1
-                st_signal.append(signal)
-            else:
-                long_trigger.append(np.nan)
-                short_trigger.append(np.nan)
-                st_signal.append(0)
-        else:
-            long_trigger.append(np.nan)
-            short_trigger.append(np.nan)
-            st_signal.append(0)
+@metrics.timed("supertrend_grid")
+def supertrend_grid(high: np.ndarray, low: np.ndarray, close: np.ndarray, look_backs: list, multipliers: list) \
+        -> np.ndarray:
+    # Supertrend for every (multiplier, look_back) in itertools.product order, shape (params x candles)
+    high = np.ascontiguousarray(high, dtype=np.float64)
+    low = np.ascontiguousarray(low, dtype=np.float64)
+    close = np.ascontiguousarray(close, dtype=np.float64)
+    metrics.count("supertrend_rows", len(close) * len(look_backs) * len(multipliers))
+
+    # True range once per market, ATR once per look back
+    tr = true_range(high, low, close)
+    atrs = np.stack([ewm_mean(tr, float(look_back)) for look_back in look_backs])
+
+    # Broadcast all multipliers against all ATRs
+    hl_avg = (high + low) / 2
+    scaled_atr = (np.asarray(multipliers, dtype=np.float64)[:, np.newaxis, np.newaxis] * atrs).reshape(-1, len(close))
+    upper_band = hl_avg + scaled_atr
+    lower_band = hl_avg - scaled_atr
+
+    st = _supertrend_loop(upper_band, lower_band, close)
+    st[:, :1] = np.nan
+    return st
+
+
+def supertrend_analysis(high: pd.Series, low: pd.Series, close: pd.Series, look_back: int, multiplier: float) \
+        -> Tuple[pd.Series, pd.Series, pd.Series]:
+    st, upt, dt = supertrend_kernel(high.values, low.values, close.values, look_back=look_back,
+                                    multiplier=multiplier)
+
+    # The first candle only seeds the bands
+    index = close.index[1:]
+    st = pd.Series(st[1:], index=index, name=f'supertrend_{look_back}')
+    return st, pd.Series(upt[1:], index=index), pd.Series(dt[1:], index=index)
+
+
+def supertrend_signals(prices: np.ndarray, st: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    prices = np.asarray(prices, dtype=np.float64)
+    st = np.asarray(st, dtype=np.float64)
+    prices = prices[:len(st)]
+
+    # Crossovers of price and supertrend, the first candle has nothing to cross from
+    crosses = np.zeros(len(st), dtype=np.int8)
+    crosses[1:][(st[:-1] > prices[:-1]) & (st[1:] < prices[1:])] = 1
+    crosses[1:][(st[:-1] < prices[:-1]) & (st[1:] > prices[1:])] = -1
 
+    # A crossover only signals if it differs from the previous one (repeated same side signals are ignored)
+    last_cross_idx = np.maximum.accumulate(np.where(crosses != 0, np.arange(len(crosses)), 0))
+    previous_cross = np.zeros_like(crosses)
+    previous_cross[1:] = crosses[last_cross_idx[:-1]]
+    st_signal = np.where(crosses != previous_cross, crosses, 0).astype(np.int8)
+
+    long_trigger = np.where(st_signal == 1, prices, np.nan)
+    short_trigger = np.where(st_signal == -1, prices, np.nan)
     return long_trigger, short_trigger, st_signal
 
 
+def get_supertrend_signals(prices, st) -> Tuple[list, list, list]:
+    long_trigger, short_trigger, st_signal = supertrend_signals(prices, st)
+    return long_trigger.tolist(), short_trigger.tolist(), st_signal.tolist()
+
+
 def calculate_sma(df: pd.Series, time_period: int = 200) -> pd.Series:
     return SMA(df, timeperiod=time_period)
 
@@ -136,6 +190,212 @@ def calculate_stoch_rsi(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
     return slowk, slowd
 
 
+class SupertrendState:
+    """
+    Supertrend, EMA and StochRSI carried forward one closed candle at a time.
+    Every step reproduces the batch functions (supertrend_analysis, get_supertrend_signals, calculate_ema and
+    calculate_stoch_rsi) bar for bar, so a state seeded with from_history can be fed new candles in O(1)
+    instead of recomputing the whole history. Supertrend, signals and EMA are exact, StochRSI agrees with
+    TA-Lib up to floating point rounding.
+    """
+    RSI_PERIOD = 14
+    FASTK_PERIOD = 3
+    SLOWK_PERIOD = 3
+    SLOWD_PERIOD = 3
+
+    def __init__(self, look_back: int, multiplier: float, ema_period: int = 200) -> None:
+        self.look_back = look_back
+        self.multiplier = multiplier
+        self.ema_period = ema_period
+        self.last_time = None
+        self.n_candles = 0
+
+        # ATR (pandas style adjusted EWM)
+        self._prev_close = np.nan
+        self._atr = np.nan
+        self._atr_old_wt = 1.
+
+        # Final bands, supertrend and signal
+        self._final_upper = 0.
+        self._final_lower = 0.
+        self._st = 0.
+        self._signal = 0
+
+        # EMA, seeded with the SMA of the first ema_period closes
+        self._ema = np.nan
+        self._ema_total = 0.
+
+        # RSI (Wilder smoothing) and the STOCH windows and running SMA totals over it
+        self._avg_gain = 0.
+        self._avg_loss = 0.
+        self._rsi_window = []
+        self._fastk_window = []
+        self._fastk_total = 0.
+        self._slowk_window = []
+        self._slowk_total = 0.
+
+    @classmethod
+    def from_history(cls, df: pd.DataFrame, look_back: int, multiplier: float, ema_period: int = 200) \
+            -> "SupertrendState":
+        state = cls(look_back, multiplier, ema_period=ema_period)
+        state.update_from_dataframe(df)
+        return state
+
+    def update_from_dataframe(self, df: pd.DataFrame) -> list:
+        # Only candles newer than the last one seen are applied, so overlapping downloads are safe
+        if self.last_time is not None:
+            df = df[df.index > pd.Timestamp(self.last_time)]
+        return [self.update(high, low, close, time=time)
+                for time, high, low, close in zip(df.index, df.high.values, df.low.values, df.close.values)]
+
+    def update(self, high: float, low: float, close: float, time=None) -> dict:
+        high, low, close = float(high), float(low), float(close)
+        result = {"time": time, "close": close}
+        result.update(self._update_supertrend(high, low, close))
+        result["ema200"] = self._update_ema(close)
+        result["slowk"], result["slowd"] = self._update_stoch_rsi(close)
+
+        self._prev_close = close
+        self.n_candles += 1
+        if time is not None:
+            self.last_time = pd.Timestamp(time).isoformat()
+        return result
+
+    def _update_supertrend(self, high: float, low: float, close: float) -> dict:
+        prev_close = self._prev_close
+
+        # ATR
+        tr = high - low
+        if prev_close == prev_close:
+            tr = max(tr, abs(high - prev_close), abs(low - prev_close))
+        if self.n_candles == 0 or self._atr != self._atr:
+            self._atr = tr
+        else:
+            self._atr_old_wt *= 1. - 1. / (1. + self.look_back)
+            if tr == tr:
+                if self._atr != tr:
+                    self._atr = ((self._atr_old_wt * self._atr) + tr) / (self._atr_old_wt + 1.)
+                self._atr_old_wt += 1.
+
+        if self.n_candles == 0:
+            # The first candle only seeds the bands
+            return {"st": np.nan, "upt": np.nan, "dt": np.nan, "st_signal": 0, "long_trig": np.nan,
+                    "short_trig": np.nan}
+
+        # H/L AVG AND BASIC UPPER & LOWER BAND
+        hl_avg = (high + low) / 2
+        upper_band = hl_avg + self.multiplier * self._atr
+        lower_band = hl_avg - self.multiplier * self._atr
+
+        # FINAL UPPER & LOWER BAND
+        prev_upper, prev_lower = self._final_upper, self._final_lower
+        if upper_band < prev_upper or prev_close > prev_upper:
+            self._final_upper = upper_band
+        if lower_band > prev_lower or prev_close < prev_lower:
+            self._final_lower = lower_band
+
+        # SUPERTREND
+        prev_st = self._st
+        if prev_st == prev_upper and close < self._final_upper:
+            st = self._final_upper
+        elif prev_st == prev_upper and close > self._final_upper:
+            st = self._final_lower
+        elif prev_st == prev_lower and close > self._final_lower:
+            st = self._final_lower
+        elif prev_st == prev_lower and close < self._final_lower:
+            st = self._final_upper
+        else:
+            st = 0.
+        self._st = st
+
+        # SIGNAL (the seed candle has no supertrend to cross)
+        st_signal, long_trig, short_trig = 0, np.nan, np.nan
+        if self.n_candles > 1:
+            if prev_st > prev_close and st < close and self._signal != 1:
+                self._signal = st_signal = 1
+                long_trig = close
+            elif prev_st < prev_close and st > close and self._signal != -1:
+                self._signal = st_signal = -1
+                short_trig = close
+
+        return {"st": st, "upt": st if close > st else np.nan, "dt": st if close < st else np.nan,
+                "st_signal": st_signal, "long_trig": long_trig, "short_trig": short_trig}
+
+    def _update_ema(self, close: float) -> float:
+        if self.n_candles < self.ema_period:
+            self._ema_total += close
+            if self.n_candles == self.ema_period - 1:
+                self._ema = self._ema_total / self.ema_period
+            return self._ema
+        self._ema = ((close - self._ema) * (2. / (self.ema_period + 1))) + self._ema
+        return self._ema
+
+    def _update_stoch_rsi(self, close: float) -> Tuple[float, float]:
+        # RSI, seeded with the plain average gain/loss of the first RSI_PERIOD moves
+        if self.n_candles == 0:
+            return np.nan, np.nan
+        diff = close - self._prev_close
+        if self.n_candles > self.RSI_PERIOD:
+            self._avg_gain *= self.RSI_PERIOD - 1
+            self._avg_loss *= self.RSI_PERIOD - 1
+        if diff < 0:
+            self._avg_loss -= diff
+        else:
+            self._avg_gain += diff
+        if self.n_candles < self.RSI_PERIOD:
+            return np.nan, np.nan
+        self._avg_gain /= self.RSI_PERIOD
+        self._avg_loss /= self.RSI_PERIOD
+        total = self._avg_gain + self._avg_loss
+        rsi = 100. * (self._avg_gain / total) if not -1e-8 < total < 1e-8 else 0.
+
+        # Fast %K over the last FASTK_PERIOD RSI values
+        self._rsi_window = (self._rsi_window + [rsi])[-self.FASTK_PERIOD:]
+        if len(self._rsi_window) < self.FASTK_PERIOD:
+            return np.nan, np.nan
+        lowest, highest = min(self._rsi_window), max(self._rsi_window)
+        fastk = (rsi - lowest) / (highest - lowest) * 100. if highest != lowest else 0.
+
+        # Slow %K and slow %D are running-sum SMAs
+        slowk, self._fastk_window, self._fastk_total = self._running_sma(
+            fastk, self._fastk_window, self._fastk_total, self.SLOWK_PERIOD)
+        if slowk != slowk:
+            return np.nan, np.nan
+        slowd, self._slowk_window, self._slowk_total = self._running_sma(
+            slowk, self._slowk_window, self._slowk_total, self.SLOWD_PERIOD)
+        if slowd != slowd:
+            return np.nan, np.nan
+        return slowk, slowd
+
+    @staticmethod
+    def _running_sma(value: float, window: list, total: float, period: int) -> Tuple[float, list, float]:
+        window = (window + [value])[-period:]
+        total += value
+        if len(window) < period:
+            return np.nan, window, total
+        sma = total / period
+        total -= window[0]
+        return sma, window, total
+
+    def to_dict(self) -> dict:
+        return {key: value.item() if isinstance(value, np.generic) else value for key, value in vars(self).items()}
+
+    @classmethod
+    def from_dict(cls, state_dict: dict) -> "SupertrendState":
+        state = cls(state_dict["look_back"], state_dict["multiplier"], ema_period=state_dict["ema_period"])
+        state.__dict__.update(state_dict)
+        return state
+
+    def save(self, filepath: str) -> None:
+        with open(filepath, "w") as json_file:
+            json.dump(self.to_dict(), json_file)
+
+    @classmethod
+    def load(cls, filepath: str) -> "SupertrendState":
+        with open(filepath) as json_file:
+            return cls.from_dict(json.load(json_file))
+
+
 def take_profit_calc(close: float, profit_percent: float, precision: int) -> Tuple[float, float]:
     long_profit = round(close + close * profit_percent / 100, precision)
     short_profit = round(close - close * profit_percent / 100, precision)
@@ -148,43 +408,6 @@ def stop_loss_calc(close: float, loss_percent: float, precision: int) -> Tuple[f
     return long_loss, short_loss
 
 
-def plot_and_save_figure(market: str, df: pd.DataFrame, params: dict, folder_path: str) -> str:
-    # Plot and save results
-    fig, (ax, ax1) = plt.subplots(nrows=2, sharex="all", gridspec_kw={'height_ratios': [3, 1]})
-
-    ax.plot(df.index, df.close, ".-", color="tab:blue")
-    ax.plot(df.index, df.ema200, color="tab:orange")
-    ax.plot(df.index, df.st, color="tab:gray")
-
-    ax.plot(df.index, df.short_trig, marker='^', color='tab:red', markersize=8, linewidth=0, label='Short')
-    ax.plot(df.index, df.long_trig, marker='v', color='tab:green', markersize=8, linewidth=0, label='Long')
-
-    ax1.plot(df.index, df.vol_ema200, color="tab:orange")
-
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%b-%d %H:%m'))
-    fig.autofmt_xdate()
-
-    title = f"{market} ("
-    for idx, (key, val) in enumerate(params.items()):
-        if isinstance(val, float):
-            title += f"{key}={val:.2f}"
-        else:
-            title += f"{key}={val}"
-        if idx != len(params) - 1:
-            title += " "
-    title += ")"
-    ax.set_title(title)
-
-    plt.close(fig)
-    ax.legend()
-
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
-    figure_path = os.path.join(folder_path, f"{market}.jpg")
-    fig.savefig(figure_path, dpi=300)
-    return figure_path
-
-
 def calculate_pnl(markets: list, trades: dict, leverage: float = 1):
     pnl_list = []
     for market in markets:
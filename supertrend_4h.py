@@ -1,16 +1,27 @@
+import concurrent.futures
 import json
 import logging
+import math
 import os
 import sys
 import time
+from typing import Callable, Iterator, Optional, Tuple
 
 import matplotlib.pyplot as plt
 import pandas as pd
 
-import backtesting as bt
 import supertrend as spt
-from config import API_KEY, API_SECRET
-from ftx_client import FtxClient
+from candle_store import CandleStore
+from candle_stream import CandleStream, StreamingSignals
+from chart_renderer import CHART_COLUMNS, RenderQueue
+from ftx_client import FtxClient, candle_resolution
+from indicator_panel import IndicatorPanel
+from instrumentation import Metrics, metrics, write_json_line, write_prometheus
+from market_scanner import MarketScanner
+from optimize_markets import optimized_params_filepath, perpetual_markets, timeframe_start_time
+from order_tracker import FtxWebsocketSource, OrderTracker
+from scheduler import CandleScheduler
+from supertrend import SupertrendState
 from telegram_api_manager import TelegramAPIManager
 
 plt.ioff()
@@ -19,17 +30,21 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
                     stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+try:
+    from config import API_KEY, API_SECRET
+except ImportError:
+    # Offline replays against the mock exchange (simulate_cycles.py) run without credentials
+    API_KEY = API_SECRET = None
+
 with open("settings.json") as jsonfile:
     settings = json.load(jsonfile)
 
 testing = False
 BACKTEST_FOLDER = settings["filepaths"]["backtest_folder"]
-OPTIMIZEDML_FILEPATH = os.path.join(BACKTEST_FOLDER, settings["filepaths"]["optimized_ml_file"])
-ANALYSIS_FILEPATH = os.path.join(BACKTEST_FOLDER, settings["filepaths"]["analysis_file"])
 FIGURE_PATH = os.path.join(settings["filepaths"]["figure_folder"], settings["filepaths"]["figure_subfolder"])
 
-tapi = TelegramAPIManager(group=False)
-trades = []
+candle_store = CandleStore(settings["filepaths"]["candle_folder"])
+metrics.enabled = settings["instrumentation"]["enabled"]
 
 
 def markdown_format_message(position: dict) -> str:
@@ -50,140 +65,353 @@ def markdown_format_message(position: dict) -> str:
     return msg_text
 
 
-while True:
-    try:
-        # Open new FTX Session
-        ftx = FtxClient(api_key=API_KEY, api_secret=API_SECRET)
-        optimzed_ml = pd.read_csv(OPTIMIZEDML_FILEPATH)
-        market_analysis = pd.read_csv(ANALYSIS_FILEPATH)
-
-        # Get list of all markets according to criteria
-        markets = []
-        for future in ftx.list_futures():
-            if future["type"] == "perpetual":
-                if (future["volumeUsd24h"] > settings["markets"]["min_volume_usd_24h"] and
-                        future["name"] not in settings["markets"]["blacklist"]):
-                    markets.append(future["name"])
-
-        # Delete all old images in folder
-        for filename in os.listdir(FIGURE_PATH):
-            if not filename.endswith(".jpg"):
-                continue
-            os.remove(os.path.join(FIGURE_PATH, filename))
-
-        for market in markets:
-            df = ftx.get_historical_market_data(market, interval=settings["analysis"]["interval"],
-                                                start_time=settings["analysis"]["start_time"])
-
-            if len(df) < settings["analysis"]["min_data_length"]:
-                continue
-
-            # Get optimized values for supertrend inputs
-            try:
-                multiplier = optimzed_ml.loc[optimzed_ml['Name'] == market]["Multiplier"].values[0]
-                lookback = optimzed_ml.loc[optimzed_ml['Name'] == market]["Lookback"].values[0]
-                thedfactor = market_analysis.loc[market_analysis["Name"] == market]["TheDfactor"].values[0]
-            except IndexError:
-                result = bt.optimize_m_l(df, optimize_to="TheDfactor", return_optimize_to=True)
-                multiplier = result["Multiplier"]
-                lookback = result["Lookback"]
-                thedfactor = result["TheDfactor"]
-                text = f"{market} optimized to Multiplier={multiplier} and Lookback={lookback}, TheDfactor={thedfactor}"
-                logger.info(text)
-
-            # Perform supertrend analysis
-            df["st"], df["upt"], df["dt"] = spt.supertrend_analysis(df.high, df.low, df.close, look_back=lookback,
-                                                                    multiplier=multiplier)
-            df["long_trig"], df["short_trig"], df["st_signal"] = spt.get_supertrend_signals(df.close, df.st)
-
-            # Check 200 EMA for confirmation
-            df["ema200"] = spt.calculate_ema(df.close, time_period=200)
-            df["vol_ema200"] = spt.calculate_ema(df.volume, time_period=200)
-
-            params = {"Multiplier": int(multiplier), "Lookback": int(lookback), "TheDfactor": float(thedfactor)}
-            figure_path = spt.plot_and_save_figure(market, df, params, folder_path=FIGURE_PATH)
-            # Set precision for orders
-            precision = len(str(df.close[0]).split(".")[1])
-
-            # Take profit calculator and stop loss
-            stop_loss = round(df.st[-1], precision)
-            long_profit_10pct, short_profit_10pct = spt.take_profit_calc(df.close[-1], profit_percent=10,
-                                                                         precision=precision)
-            long_profit_5pct, short_profit_5pct = spt.take_profit_calc(df.close[-1], profit_percent=5,
-                                                                       precision=precision)
-            long_profit_75pct, short_profit_75pct = spt.take_profit_calc(df.close[-1], profit_percent=7.5,
-                                                                         precision=precision)
-            long_loss_5pct, short_loss_5pct = spt.stop_loss_calc(df.close[-1], loss_percent=5,
-                                                                 precision=precision)
-            # Check last element of signal array
-            last_signal = df.st_signal[-1]
-
+def backfill_start_time(state: SupertrendState) -> str:
+    # From the state's last candle on, however long the stream was down
+    if state.last_time is None:
+        return settings["analysis"]["start_time"]
+    minutes = math.ceil((time.time() - pd.Timestamp(state.last_time).timestamp()) / 60)
+    return f"{max(minutes, 1)} minutes ago"
+
+
+def load_market_params(markets: list, interval: str = settings["analysis"]["interval"]) -> dict:
+    # Get optimized values for supertrend inputs on the interval's candles, markets without them are skipped.
+    # TheDfactor is the one optimize_markets found for the market's parameters.
+    optimized_ml = pd.read_csv(optimized_params_filepath(interval))
+    market_params = {}
+    for market in markets:
+        row = optimized_ml.loc[optimized_ml["Name"] == market]
+        if row.empty:
+            continue
+        market_params[market] = {column: row[column].values[0] for column in ("Multiplier", "Lookback", "TheDfactor")}
+    return market_params
+
+
+def build_new_position(ftx: FtxClient, result: dict, last_signal: int,
+                       interval: str = settings["analysis"]["interval"]) -> dict:
+    market = result["market"]
+    close = result["close"]
+
+    # Set precision for orders, from the market's price increment
+    precision = ftx.get_price_precision(market)
+
+    # Take profit calculator and stop loss
+    stop_loss = round(result["st"], precision)
+    long_profit_10pct, short_profit_10pct = spt.take_profit_calc(close, profit_percent=10, precision=precision)
+    long_profit_5pct, short_profit_5pct = spt.take_profit_calc(close, profit_percent=5, precision=precision)
+    long_profit_75pct, short_profit_75pct = spt.take_profit_calc(close, profit_percent=7.5, precision=precision)
+    long_loss_5pct, short_loss_5pct = spt.stop_loss_calc(close, loss_percent=5, precision=precision)
+
+    # Set up dict for new position
+    new_position = {
+        "market": market,
+        "interval": interval,
+        "funding_rate": ftx.get_last_funding_rate(market),
+        "entry": close,
+        "stop_loss": stop_loss,
+    }
+
+    if last_signal == 1:
+        # Long position
+        new_position["side"] = "buy"
+        new_position["10pctprofit"] = long_profit_10pct
+        new_position["5pctprofit"] = long_profit_5pct
+        new_position["75pctprofit"] = long_profit_75pct
+        new_position["5pctloss"] = long_loss_5pct
+    elif last_signal == -1:
+        # Short position
+        new_position["side"] = "sell"
+        new_position["10pctprofit"] = short_profit_10pct
+        new_position["5pctprofit"] = short_profit_5pct
+        new_position["75pctprofit"] = short_profit_75pct
+        new_position["5pctloss"] = short_loss_5pct
+
+    if close < result["ema200"]:
+        new_position["ema200"] = "under"
+    else:
+        new_position["ema200"] = "over"
+
+    new_position["stoch_rsi"] = result["stoch_rsi"]
+    return new_position
+
+
+def record_trade(trades: list, new_position: dict, trades_file: str = settings["filepaths"]["trades_file"]) -> None:
+    trades.append(new_position)
+    with open(trades_file, 'w') as json_file:
+        json.dump(trades, json_file)
+
+
+def close_opposite_position(ftx: FtxClient, market: str, side: str) -> Optional[tuple]:
+    # Close position if needed, returns the close future and order response without waiting for the fill
+    open_position = ftx.check_open_position(market)
+    if open_position and open_position["side"] != side:
+        return ftx.market_close(market, side=side, size=open_position["size"])
+    return None
+
+
+def report_closes(tapi: TelegramAPIManager, pending_closes: list) -> None:
+    deadline = time.monotonic() + settings["orders"]["close_timeout"]
+    for market, closed, response, figure_path in pending_closes:
+        try:
+            is_closed = closed.result(timeout=max(0., deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            is_closed = False
+        if is_closed:
+            close_position_text = f"({market}) Position closed at {response['price']}"
+        else:
+            close_position_text = f"({market}) Position failed to close: Error: {response}"
+        tapi.send_photo(figure_path, caption=close_position_text)
+
+
+def create_order_tracker() -> OrderTracker:
+    # Positions are tracked across sessions from the fills feed
+    return OrderTracker(
+        FtxWebsocketSource(API_KEY, API_SECRET, endpoint=settings["orders"]["websocket_endpoint"]),
+        load_positions=FtxClient(api_key=API_KEY, api_secret=API_SECRET).get_positions)
+
+
+def timeframe_paths(interval: str) -> Tuple[str, str]:
+    # The analysis interval keeps the original charts and trades files, other timeframes get their own since
+    # chart names don't include the interval
+    if interval == settings["analysis"]["interval"]:
+        return FIGURE_PATH, settings["filepaths"]["trades_file"]
+    return os.path.join(settings["filepaths"]["figure_folder"], interval), f"trades_{interval}.json"
+
+
+def timeframe_metrics_path(filepath: str, interval: str) -> str:
+    if interval == settings["analysis"]["interval"]:
+        return filepath
+    root, extension = os.path.splitext(filepath)
+    return f"{root}_{interval}{extension}"
+
+
+def scheduled_intervals() -> list:
+    # Timeframes without optimized parameters of their own are not scanned
+    intervals = []
+    for interval in settings["schedule"]["intervals"]:
+        if os.path.exists(optimized_params_filepath(interval)):
+            intervals.append(interval)
+        else:
+            logger.warning(f"Not scanning {interval}, {optimized_params_filepath(interval)} doesn't exist. "
+                           f"Run optimize_markets.py --interval {interval} first.")
+    return intervals
+
+
+def create_scanner(ftx: FtxClient, interval: str = settings["analysis"]["interval"],
+                   start_time: str = settings["analysis"]["start_time"],
+                   scan_metrics: Optional[Metrics] = None) -> MarketScanner:
+    return MarketScanner(ftx, interval=interval, start_time=start_time,
+                         min_data_length=settings["analysis"]["min_data_length"],
+                         fetch_workers=settings["scan"]["fetch_workers"],
+                         analysis_workers=settings["scan"]["analysis_workers"], scan_metrics=scan_metrics)
+
+
+def scan_signals(ftx: FtxClient, scanner: MarketScanner, render_queue: RenderQueue, markets: list,
+                 market_params: dict, interval: str = settings["analysis"]["interval"]) -> Iterator[Tuple[dict, str]]:
+    # New positions of the signalling markets and the paths of their charts
+    for result in scanner.scan(markets, market_params):
+        market = result["market"]
+        # Check last element of signal array
+        last_signal = result["last_signal"]
+
+        if testing:
+            last_signal = -1
+
+        if last_signal != 0:
+            # Only signalling markets get a chart, it renders in the background while the position is set up
+            figure = render_queue.submit(market, result["chart"], result["params"])
+            new_position = build_new_position(ftx, result, last_signal, interval)
+
+            logger.info(f"New Position: {new_position}")
+            with metrics.timer("render_wait"):
+                figure_path = figure.result()
+            yield new_position, figure_path
             if testing:
-                last_signal = -1
-
-            if last_signal != 0:
-                # Set up dict for new position
-                new_position = {
-                    "market": market,
-                    "interval": "4h",
-                    "funding_rate": ftx.get_last_funding_rate(market),
-                    "entry": df.close[-1],
-                    "stop_loss": stop_loss,
-                }
-
-                if last_signal == 1:
-                    # Long position
-                    new_position["side"] = "buy"
-                    new_position["10pctprofit"] = long_profit_10pct
-                    new_position["5pctprofit"] = long_profit_5pct
-                    new_position["75pctprofit"] = long_profit_75pct
-                    new_position["5pctloss"] = long_loss_5pct
-                elif last_signal == -1:
-                    # Short position
-                    new_position["side"] = "sell"
-                    new_position["10pctprofit"] = short_profit_10pct
-                    new_position["5pctprofit"] = short_profit_5pct
-                    new_position["75pctprofit"] = short_profit_75pct
-                    new_position["5pctloss"] = short_loss_5pct
-
-                if df.close[-1] < df.ema200[-1]:
-                    new_position["ema200"] = "under"
-                else:
-                    new_position["ema200"] = "over"
-
-                # Use slowd for StochRSI
-                _, slowd = spt.calculate_stoch_rsi(df)
-                new_position["stoch_rsi"] = int(slowd[-1])
-
-                logger.info(f"New Position: {new_position}")
-                tapi.send_photo(figure_path, caption=markdown_format_message(new_position), markdown=True)
-                trades.append(new_position)
-
-                with open(settings["filepaths"]["trades_file"], 'w') as json_file:
-                    json.dump(trades, json_file)
-
-                # Close position if needed
-                open_position = ftx.check_open_position(market)
-                if open_position:
-                    if open_position["side"] != new_position["side"]:
-                        success, response = ftx.market_close_and_cancel_orders(
-                            market,
-                            side=new_position["side"],
-                            size=open_position["size"]
-                        )
-
-                        if success:
-                            close_position_text = f"({market}) Position closed at {response['price']}"
-                        else:
-                            close_position_text = f"({market}) Position failed to close: Error: {response}"
-
-                        tapi.send_photo(figure_path, caption=close_position_text)
-                if testing:
-                    break
-
-    except Exception as exc:
-        logger.error(f"{exc}")
-        tapi.send_message(f"Exception: {exc}")
-
-    logger.info("Sleeping for 4 hours")
-    time.sleep(60 * 60 * 4)
+                break
+
+
+def handle_position(ftx: FtxClient, tapi: TelegramAPIManager, trades: list, new_position: dict, figure_path: str,
+                    trades_file: str = settings["filepaths"]["trades_file"],
+                    on_position: Optional[Callable[[dict], None]] = None) -> Optional[tuple]:
+    # Alerts and records a new position and closes an opposite one, returns the pending close for report_closes
+    market = new_position["market"]
+    tapi.send_photo(figure_path, caption=markdown_format_message(dict(new_position)), markdown=True)
+    record_trade(trades, new_position, trades_file)
+    if on_position is not None:
+        on_position(new_position)
+
+    # The scan goes on while the close is confirmed by the fills feed
+    close = close_opposite_position(ftx, market, new_position["side"])
+    if close is not None:
+        return (market, *close, figure_path)
+    return None
+
+
+def report_cycle(scanner: MarketScanner, market_params: dict, interval: str = settings["analysis"]["interval"]) \
+        -> dict:
+    # Per-cycle profile from the scanner's metrics: stage and per-market timings and counters, cProfile of the slowest
+    # market on request. The metrics are reset after, the next report starts from here.
+    cycle_metrics = scanner.metrics
+    summary = cycle_metrics.summary()
+    summary["interval"] = interval
+    instrumentation = settings["instrumentation"]
+    write_json_line(summary, instrumentation["report_file"])
+    if instrumentation["prometheus_file"]:
+        # One file per timeframe, the textfile collector merges them by the interval label
+        write_prometheus(summary, timeframe_metrics_path(instrumentation["prometheus_file"], interval),
+                         labels={"interval": interval})
+
+    slowest = cycle_metrics.slowest_market("scan:")
+    if instrumentation["profile_slowest_market"] and slowest is not None:
+        filepath = os.path.join(instrumentation["profile_folder"], f"{slowest}_{int(summary['started'])}.prof")
+        scanner.profile_market(slowest, market_params[slowest], filepath)
+        logger.info(f"Profiled slowest market {slowest}: {filepath}")
+
+    stages = ", ".join(f"{stage} {values['seconds']:.1f}s" for stage, values in sorted(
+        summary["stages"].items(), key=lambda item: -item[1]["seconds"])[:5])
+    logger.info(f"{interval} cycle took {summary['duration']:.1f}s, slowest market {slowest} ({stages})")
+    cycle_metrics.reset()
+    return summary
+
+
+def run_cycle(ftx: FtxClient, tapi: TelegramAPIManager, render_queue: RenderQueue, trades: list,
+              market_params: Optional[dict] = None, on_position: Optional[Callable[[dict], None]] = None,
+              trades_file: str = settings["filepaths"]["trades_file"], interval: str = settings["analysis"]["interval"],
+              start_time: str = settings["analysis"]["start_time"], cycle_metrics: Optional[Metrics] = None) \
+        -> Optional[dict]:
+    # One scan of all markets. on_position(new_position) is called for every new position right after it is
+    # recorded, market_params are read from the optimization results when not given. Everything the cycle records
+    # goes to cycle_metrics (the global metrics if not given), its summary is returned when enabled.
+    cycle_metrics = cycle_metrics or metrics
+    with metrics.collect(cycle_metrics):
+        pending_closes = []
+        markets = perpetual_markets(ftx)
+        if market_params is None:
+            market_params = load_market_params(markets, interval)
+
+        # Delete old charts
+        render_queue.prune(max_age=settings["charts"]["max_age_hours"] * 60 * 60)
+
+        scanner = create_scanner(ftx, interval, start_time, scan_metrics=cycle_metrics)
+        for new_position, figure_path in scan_signals(ftx, scanner, render_queue, markets, market_params, interval):
+            pending_close = handle_position(ftx, tapi, trades, new_position, figure_path, trades_file, on_position)
+            if pending_close is not None:
+                pending_closes.append(pending_close)
+
+        report_closes(tapi, pending_closes)
+        if cycle_metrics.enabled:
+            return report_cycle(scanner, market_params, interval)
+    return None
+
+
+def timeframe_job(ftx: FtxClient, tapi: TelegramAPIManager, interval: str, job_metrics: Metrics) \
+        -> Callable[[float], None]:
+    figure_path, trades_file = timeframe_paths(interval)
+    start_time = timeframe_start_time(interval)
+    render_queue = RenderQueue(figure_path, dpi=settings["charts"]["dpi"], fmt=settings["charts"]["format"])
+    trades = []
+
+    def job(candle_close: float) -> None:
+        try:
+            run_cycle(ftx, tapi, render_queue, trades, trades_file=trades_file, interval=interval,
+                      start_time=start_time, cycle_metrics=job_metrics)
+        except Exception as exc:
+            logger.error(f"{interval}: {exc}")
+            tapi.send_message(f"Exception ({interval}): {exc}")
+
+    return job
+
+
+def main():
+    """
+    Scans every interval in settings["schedule"] that has optimized parameters of its own right after its candles
+    close. All timeframes share one FTX
+    session, candle store and order tracker, a scan still running at its next close is skipped or coalesced. Each
+    timeframe records and reports its own metrics.
+    """
+    tapi = TelegramAPIManager(group=False)
+    ftx = FtxClient(api_key=API_KEY, api_secret=API_SECRET, candle_store=candle_store,
+                    order_tracker=create_order_tracker())
+
+    scheduler = CandleScheduler()
+    intervals = scheduled_intervals()
+    for interval in intervals:
+        job_metrics = Metrics(enabled=metrics.enabled)
+        scheduler.add_job(interval, timeframe_job(ftx, tapi, interval, job_metrics),
+                          delay=settings["schedule"]["delay_seconds"], overrun=settings["schedule"]["overrun"],
+                          job_metrics=job_metrics)
+    logger.info(f"Scanning {', '.join(intervals)} at the candle closes")
+    scheduler.run()
+
+
+def main_streaming():
+    """
+    Signals at the candle close instead of every 4 hours: every market's SupertrendState is seeded from the REST
+    history once, then updated from bars aggregated from the websocket trades. The alert goes out as soon as a
+    bar flips the supertrend, the chart and the position handling follow.
+    """
+    tapi = TelegramAPIManager(group=False)
+    render_queue = RenderQueue(FIGURE_PATH, dpi=settings["charts"]["dpi"], fmt=settings["charts"]["format"])
+    trades = []
+    ftx = FtxClient(api_key=API_KEY, api_secret=API_SECRET, candle_store=candle_store,
+                    order_tracker=create_order_tracker())
+    interval = settings["analysis"]["interval"]
+    resolution = candle_resolution(interval)
+
+    market_params = load_market_params(perpetual_markets(ftx))
+    states = {}
+    for market, params in market_params.items():
+        df = ftx.get_historical_market_data(market, interval=interval, start_time=settings["analysis"]["start_time"])
+        # The last REST candle is still open, the stream closes it
+        df = df[df.index < pd.Timestamp(time.time() // resolution * resolution, unit="s", tz="UTC")]
+        if len(df) < settings["analysis"]["min_data_length"]:
+            continue
+        states[market] = SupertrendState.from_history(df, look_back=int(params["Lookback"]),
+                                                      multiplier=params["Multiplier"])
+    logger.info(f"Streaming {len(states)} markets")
+
+    # Signals are handled one at a time off the stream thread, REST and Telegram calls must not delay bar closes
+    handler = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def handle_signal(market: str, state_result: dict) -> None:
+        params = market_params[market]
+        result = {"market": market, "close": state_result["close"], "st": state_result["st"],
+                  "ema200": state_result["ema200"], "stoch_rsi": int(state_result["slowd"])}
+        new_position = build_new_position(ftx, result, state_result["st_signal"])
+        logger.info(f"New Position ({state_result['time']}): {new_position}")
+        tapi.send_message(markdown_format_message(dict(new_position)), markdown=True)
+        record_trade(trades, new_position)
+        close = close_opposite_position(ftx, market, new_position["side"])
+
+        df = ftx.get_historical_market_data(market, interval=interval, start_time=settings["analysis"]["start_time"])
+        panel = IndicatorPanel(df[df.index <= state_result["time"]], look_back=int(params["Lookback"]),
+                               multiplier=params["Multiplier"])
+        chart_params = {"Multiplier": int(params["Multiplier"]), "Lookback": int(params["Lookback"]),
+                        "TheDfactor": float(params["TheDfactor"])}
+        figure_path = render_queue.submit(market, panel.frame(*CHART_COLUMNS), chart_params).result()
+        tapi.send_photo(figure_path, caption=f"{market} ({new_position['side']})")
+        if close is not None:
+            report_closes(tapi, [(market, *close, figure_path)])
+
+    def log_failure(future: concurrent.futures.Future) -> None:
+        if future.exception() is not None:
+            logger.error(f"Signal handling failed: {future.exception()}")
+            tapi.send_message(f"Exception: {future.exception()}")
+
+    def on_signal(market: str, state_result: dict) -> None:
+        handler.submit(handle_signal, market, state_result).add_done_callback(log_failure)
+
+    signals = StreamingSignals(states, on_signal, backfill=lambda market: ftx.get_historical_market_data(
+        market, interval=interval, start_time=backfill_start_time(states[market])))
+    stream = CandleStream(list(states), resolution, signals.on_bar_close, endpoint=settings["stream"]["endpoint"],
+                          channel=settings["stream"]["channel"], grace=settings["stream"]["grace_seconds"])
+    stream.start()
+    while True:
+        time.sleep(60 * 60)
+        render_queue.prune(max_age=settings["charts"]["max_age_hours"] * 60 * 60)
+
+
+if __name__ == '__main__':
+    if settings["stream"]["enabled"]:
+        main_streaming()
+    else:
+        main()
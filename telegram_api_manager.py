@@ -4,11 +4,14 @@ import sys
 
 import telegram
 
-import config
+from instrumentation import metrics
 
 
 class TelegramAPIManager:
     def __init__(self, group=False):
+        # Imported here, so modules using the class can be imported without credentials
+        import config
+
         logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                             stream=sys.stdout, level=logging.INFO)
         self.logger = logging.getLogger(__name__)
@@ -25,12 +28,14 @@ class TelegramAPIManager:
                        f' {"group" if group else "personal"} chat id'
         self.logger.info(startup_text)
 
+    @metrics.timed("telegram")
     def send_message(self, text: str, markdown: bool = False) -> telegram.Message:
         if markdown:
             return self.bot.send_message(self.chat_id, text, parse_mode=telegram.ParseMode.MARKDOWN_V2)
         else:
             return self.bot.send_message(self.chat_id, text)
 
+    @metrics.timed("telegram")
     def send_photo(self, image_path: str, caption: str = None, markdown: bool = False) -> telegram.Message:
         if markdown:
             return self.bot.send_photo(self.chat_id, photo=open(image_path, "rb"), caption=caption,
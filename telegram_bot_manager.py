@@ -11,8 +11,12 @@ from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, Callb
 
 import backtesting as bt
 import config
+from backtest_cache import BacktestCache
+from candle_store import CandleStore
+from chart_renderer import CHART_COLUMNS, ChartRenderer
 from config import API_KEY, API_SECRET
 from ftx_client import FtxClient
+from indicator_panel import IndicatorPanel
 
 STATE = None
 CONFIRM_ORDER = 1
@@ -25,14 +29,20 @@ BACKTEST_FOLDER = settings["filepaths"]["backtest_folder"]
 OPTIMIZEDML_FILEPATH = os.path.join(BACKTEST_FOLDER, settings["filepaths"]["optimized_ml_file"])
 ANALYSIS_FILEPATH = os.path.join(BACKTEST_FOLDER, settings["filepaths"]["analysis_file"])
 FIGURE_PATH = os.path.join(settings["filepaths"]["figure_folder"], settings["filepaths"]["figure_subfolder"])
+CANDLE_STORE = CandleStore(settings["filepaths"]["candle_folder"])
+BACKTEST_CACHE = BacktestCache(settings["filepaths"]["backtest_cache_folder"],
+                               max_entries=settings["backtest_cache"]["max_entries"],
+                               max_disk_bytes=settings["backtest_cache"]["max_disk_mb"] * 1024 ** 2)
 
 
 class TelegramBotManager(FtxClient):
     def __init__(self):
-        super(TelegramBotManager, self).__init__(api_key=API_KEY, api_secret=API_SECRET)
+        super(TelegramBotManager, self).__init__(api_key=API_KEY, api_secret=API_SECRET, candle_store=CANDLE_STORE)
         logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                             stream=sys.stdout, level=logging.INFO)
         self.logger = logging.getLogger(__name__)
+        self.chart_renderer = ChartRenderer(FIGURE_PATH, dpi=settings["charts"]["dpi"],
+                                            fmt=settings["charts"]["format"])
 
         # create the updater, that will automatically create also a dispatcher and a queue to
         # make them dialogue
@@ -130,8 +140,6 @@ class TelegramBotManager(FtxClient):
         update.message.reply_text(f"<b>Rankings:</b>\n" + rankings, parse_mode=ParseMode.HTML)
 
     def backtest(self, update: Update, context: CallbackContext):
-        super(TelegramBotManager, self).__init__(api_key=API_KEY, api_secret=API_SECRET)
-
         if context.args:
             try:
                 market = context.args[0].upper()
@@ -155,10 +163,17 @@ class TelegramBotManager(FtxClient):
                     lookback = 9
 
                 # Perform backtesting and calculate rank
-                result = bt.backtest_dataframe(df, look_back=lookback, multiplier=multiplier)
+                result = BACKTEST_CACHE.backtest_dataframe(df, look_back=lookback, multiplier=multiplier)
+                self.logger.info(f"Backtest cache: {BACKTEST_CACHE.stats()}")
                 ranking = bt.get_backtest_ranking(result["TheDfactor"], filename=ANALYSIS_FILEPATH,
                                                   sort_by_column="TheDfactor")
 
+                # Rendered on demand, a repeated request for the same candles and parameters reuses the chart
+                params = {"Multiplier": int(multiplier), "Lookback": int(lookback),
+                          "TheDfactor": float(result["TheDfactor"])}
+                panel = IndicatorPanel(df, look_back=lookback, multiplier=multiplier)
+                figure_path = self.chart_renderer.render(market, panel.frame(*CHART_COLUMNS), params)
+
                 # Format dictionary for message
                 for k, v in result.items():
                     result[k] = str(round(v, 1))
@@ -168,12 +183,8 @@ class TelegramBotManager(FtxClient):
                 result["Multiplier"] = multiplier
                 result["Lookback"] = lookback
 
-                figure_path = os.path.join(FIGURE_PATH, f"{market}.jpg")
                 text = "<b>Backtesting Result:</b>\n" + self.tabulate_dict(result) + f"Ranking = {ranking}"
-                if os.path.exists(figure_path):
-                    update.message.reply_photo(open(figure_path, "rb"), caption=text, parse_mode=ParseMode.HTML)
-                else:
-                    update.message.reply_text(text, parse_mode=ParseMode.HTML)
+                update.message.reply_photo(open(figure_path, "rb"), caption=text, parse_mode=ParseMode.HTML)
 
             except Exception as exc:
                 update.message.reply_text(f"Error: {exc}")
@@ -254,8 +265,6 @@ class TelegramBotManager(FtxClient):
 
     def make_order(self, update: Update, context: CallbackContext):
         global STATE
-        super(TelegramBotManager, self).__init__(api_key=API_KEY, api_secret=API_SECRET)
-
         try:
             trades_4h = json.load(open(self.trades_4h_json))
         except Exception as exc:
@@ -0,0 +1,28 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Recorded candles and markets, in the format of benchmarks.py --record-fixture
+FIXTURE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def random_walk_ohlcv(n_candles: int, seed: int = 0, volatility: float = 0.01) -> pd.DataFrame:
+    # Driftless geometric random walk, every candle opens at the previous close
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, volatility, n_candles)))
+    open_ = np.concatenate(([100.], close[:-1]))
+    wick = np.abs(rng.normal(0, volatility / 2, n_candles)) * close
+    return pd.DataFrame({"open": open_, "high": np.maximum(open_, close) + wick,
+                         "low": np.minimum(open_, close) - wick, "close": close,
+                         "volume": rng.uniform(1e5, 1e6, n_candles)},
+                        index=pd.date_range("2021-01-01", periods=n_candles, freq="4h", tz="UTC", name="time"))
+
+
+@pytest.fixture
+def ohlcv() -> pd.DataFrame:
+    return random_walk_ohlcv(1000)
@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+import pytest
+
+import async_ftx_client
+from async_ftx_client import AsyncFtxClient, TokenBucket
+from conftest import random_walk_ohlcv
+from mock_exchange import MockExchange, MockExchangeServer, MockFtxClient, ohlcv_to_candles
+
+MARKET = "MOCK-PERP"
+
+
+@pytest.fixture
+def exchange() -> MockExchange:
+    ohlcv = random_walk_ohlcv(10)
+    return MockExchange({(MARKET, 3600): ohlcv_to_candles({column: ohlcv[column].values for column in ohlcv}, 3600,
+                                                          1.6e9)})
+
+
+def _run(exchange: MockExchange, test, **client_kwargs) -> MockExchangeServer:
+    # Runs test(client, server) against the exchange served over HTTP
+    server = MockExchangeServer(exchange)
+
+    async def run() -> None:
+        endpoint = await server.start()
+        try:
+            async with AsyncFtxClient(api_key="key", api_secret="secret", endpoint=endpoint,
+                                      **client_kwargs) as client:
+                await test(client, server)
+        finally:
+            await server.stop()
+
+    asyncio.run(run())
+    return server
+
+
+def test_token_bucket_paces_after_the_burst():
+    async def acquire_times() -> list:
+        bucket = TokenBucket(rate=20, capacity=3)
+        start = time.monotonic()
+        times = []
+        for _ in range(7):
+            await bucket.acquire()
+            times.append(time.monotonic() - start)
+        return times
+
+    times = asyncio.run(acquire_times())
+    assert times[2] < 0.03
+    # Then one every 1/20 s
+    assert times[-1] == pytest.approx(4 / 20, abs=0.03)
+
+
+def test_rate_limited_requests_are_retried(exchange):
+    async def test(client: AsyncFtxClient, server: MockExchangeServer) -> None:
+        server.fail_next(2, status=429)
+        assert await client.get_positions() == []
+        # 429 means the order was not taken, posting it again is safe
+        server.fail_next(1, status=429)
+        order = await client.place_order(MARKET, side="buy", price=0, size=1, type="market")
+        assert order["status"] == "closed"
+
+    server = _run(exchange, test, backoff=0.001)
+    assert (server.request_count, server.rejected_count) == (5, 3)
+    assert len(exchange.fills) == 1
+
+
+def test_server_errors_are_only_retried_for_reads(exchange):
+    async def test(client: AsyncFtxClient, server: MockExchangeServer) -> None:
+        server.fail_next(1, status=502)
+        assert await client.get_positions() == []
+        # The order may have gone through before the error, it is not posted twice
+        server.fail_next(1, status=500)
+        with pytest.raises(Exception, match="Injected failure"):
+            await client.place_order(MARKET, side="buy", price=0, size=1, type="market")
+
+        server.fail_next(3, status=503)
+        with pytest.raises(Exception, match="Injected failure"):
+            await client.get_positions()
+
+    server = _run(exchange, test, backoff=0.001, max_retries=2)
+    assert (server.request_count, server.rejected_count) == (6, 5)
+    assert exchange.fills == []
+
+
+def test_retries_back_off_with_full_jitter(exchange, monkeypatch):
+    ceilings = []
+
+    def uniform(low: float, high: float) -> float:
+        ceilings.append((low, high))
+        return 0.
+
+    monkeypatch.setattr(async_ftx_client.random, "uniform", uniform)
+
+    async def test(client: AsyncFtxClient, server: MockExchangeServer) -> None:
+        server.fail_next(4, status=500)
+        await client.get_positions()
+
+    _run(exchange, test, backoff=0.25)
+    assert ceilings == [(0, 0.25), (0, 0.5), (0, 1.), (0, 2.)]
+
+
+def test_generate_order_matches_the_sync_client(exchange):
+    order = {"market": MARKET, "side": "buy", "entry": exchange.last_price(MARKET)}
+    expected = MockFtxClient(exchange).generate_order(order, account_percent=10, stop_loss_percent=5)
+    generated = []
+
+    async def test(client: AsyncFtxClient, server: MockExchangeServer) -> None:
+        generated.append(await client.generate_order(order, account_percent=10, stop_loss_percent=5))
+        # Market metadata, leverage and the quote are cached for the next order
+        requests = server.request_count
+        await client.generate_order(order, account_percent=10, stop_loss_percent=5)
+        assert server.request_count == requests + 1
+
+    _run(exchange, test)
+    assert generated == [expected]
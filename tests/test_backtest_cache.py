@@ -0,0 +1,82 @@
+import json
+import os
+
+import pytest
+
+import backtesting as bt
+from backtest_cache import BacktestCache
+
+
+def _compute(value: int):
+    calls = []
+
+    def func() -> dict:
+        calls.append(value)
+        return {"value": value}
+
+    return func, calls
+
+
+def test_memory_lru_evicts_the_least_recently_used():
+    cache = BacktestCache(max_entries=2)
+    for key in ("a", "b"):
+        cache.get_or_compute(key, _compute(0)[0])
+    # "a" is used again, "b" is evicted by "c"
+    cache.get_or_compute("a", _compute(0)[0])
+    cache.get_or_compute("c", _compute(0)[0])
+    assert list(cache._memory) == ["a", "c"]
+
+    func, calls = _compute(1)
+    assert cache.get_or_compute("b", func) == {"value": 1}
+    assert calls == [1]
+    assert cache.stats() == {"hits": 1, "disk_hits": 0, "misses": 4, "entries": 2}
+
+
+def test_results_are_copies():
+    cache = BacktestCache()
+    cache.get_or_compute("a", _compute(0)[0])["value"] = "formatted"
+    assert cache.get_or_compute("a", _compute(1)[0]) == {"value": 0}
+
+
+def test_disk_results_are_shared_and_counted(tmp_path):
+    BacktestCache(str(tmp_path)).get_or_compute("a", _compute(0)[0])
+    assert os.listdir(tmp_path) == ["a.json"]
+
+    cache = BacktestCache(str(tmp_path))
+    func, calls = _compute(1)
+    assert cache.get_or_compute("a", func) == {"value": 0}
+    assert cache.get_or_compute("a", func) == {"value": 0}
+    assert calls == []
+    assert cache.stats() == {"hits": 2, "disk_hits": 1, "misses": 0, "entries": 1}
+
+
+def test_disk_is_evicted_by_size_oldest_first(tmp_path):
+    entry_size = len(json.dumps({"value": 0}))
+    cache = BacktestCache(str(tmp_path), max_disk_bytes=3 * entry_size)
+    for idx, key in enumerate(("a", "b", "c")):
+        cache.get_or_compute(key, _compute(0)[0])
+        os.utime(tmp_path / f"{key}.json", (1000 + idx, 1000 + idx))
+    # Loading "a" from another process marks it as recently used
+    BacktestCache(str(tmp_path)).get_or_compute("a", _compute(1)[0])
+
+    cache.get_or_compute("d", _compute(0)[0])
+    assert sorted(os.listdir(tmp_path)) == ["a.json", "c.json", "d.json"]
+
+
+def test_failed_store_leaves_no_file(tmp_path):
+    cache = BacktestCache(str(tmp_path))
+    with pytest.raises(TypeError):
+        cache.get_or_compute("a", lambda: {"value": object()})
+    assert os.listdir(tmp_path) == []
+
+
+def test_backtest_is_keyed_on_candles_and_parameters(ohlcv):
+    cache = BacktestCache()
+    result = cache.backtest_dataframe(ohlcv, look_back=10, multiplier=3)
+    assert result == bt.backtest_dataframe(ohlcv, look_back=10, multiplier=3)
+    cache.backtest_dataframe(ohlcv, look_back=10, multiplier=3)
+    cache.backtest_dataframe(ohlcv, look_back=11, multiplier=3)
+    shifted = ohlcv.copy()
+    shifted.iloc[-1, shifted.columns.get_loc("close")] *= 1.01
+    cache.backtest_dataframe(shifted, look_back=10, multiplier=3)
+    assert (cache.hits, cache.misses) == (1, 3)
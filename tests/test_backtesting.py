@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+import backtesting as bt
+from conftest import random_walk_ohlcv
+from indicator_panel import IndicatorPanel
+
+
+def _positions(idx: list, side: list, price: list) -> bt.Positions:
+    return bt.Positions(idx=np.array(idx), side=np.array(side, dtype=np.int8), price=np.array(price, dtype=float))
+
+
+def test_first_touch_exits():
+    positions = _positions([0, 5], [1, -1], [100., 110.])
+    high = np.array([101., 104., 111., 105., 103., 112.])
+    low = np.array([99., 98., 100., 94., 97., 108.])
+
+    exits = bt.simulate_exits(positions, high, low, stop_loss_percent=5)
+    assert (exits.idx[0], exits.price[0], exits.reason[0]) == (3, 95., bt.EXIT_STOP_LOSS)
+
+    # The take profit is reached first
+    exits = bt.simulate_exits(positions, high, low, stop_loss_percent=5, take_profit_percent=10)
+    assert (exits.idx[0], exits.price[0], exits.reason[0]) == (2, 110.00000000000001, bt.EXIT_TAKE_PROFIT)
+
+    # Neither touched, the position closes on the next signal
+    exits = bt.simulate_exits(positions, high, low, stop_loss_percent=20, take_profit_percent=20)
+    assert (exits.idx[0], exits.price[0], exits.reason[0]) == (5, 110., bt.EXIT_SIGNAL)
+
+
+def test_stop_loss_wins_a_candle_touching_both():
+    positions = _positions([0, 3], [-1, 1], [100., 100.])
+    high = np.array([100., 106., 100., 100.])
+    low = np.array([100., 89., 100., 100.])
+    exits = bt.simulate_exits(positions, high, low, stop_loss_percent=5, take_profit_percent=10)
+    assert (exits.idx[0], exits.reason[0]) == (1, bt.EXIT_STOP_LOSS)
+
+
+def test_entries_are_the_live_signals(ohlcv):
+    panel = IndicatorPanel(ohlcv, look_back=10, multiplier=3)
+    positions = bt.get_supertrend_positions(panel["st"], panel["close"])
+    signal_idx = np.flatnonzero(panel["st_signal"])
+    np.testing.assert_array_equal(positions.idx, signal_idx)
+    np.testing.assert_array_equal(positions.price, ohlcv.close.values[signal_idx])
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_driftless_stop_loss_take_profit_returns():
+    # Symmetric exits on random walks have no edge once entries only see closed candles
+    returns = []
+    for seed in range(20):
+        df = random_walk_ohlcv(2000, seed=seed)
+        panel = IndicatorPanel(df, look_back=10, multiplier=3)
+        positions = bt.get_supertrend_positions(panel["st"], panel["close"])
+        exits = bt.simulate_exits(positions, df.high.values, df.low.values, stop_loss_percent=3,
+                                  take_profit_percent=3)
+        returns.append(bt.exits_profits(positions, exits))
+    returns = np.concatenate(returns)
+    assert len(returns) > 500
+    assert abs(returns.mean()) < 3 * returns.std() / np.sqrt(len(returns))
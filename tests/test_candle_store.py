@@ -0,0 +1,149 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import candle_store as cs
+from conftest import random_walk_ohlcv
+from mock_exchange import MockExchange, MockFtxClient, ohlcv_to_candles
+
+MARKET = "MOCK-PERP"
+RESOLUTION = 4 * 3600
+
+
+def _candles(n_candles: int, start_time: float = 1.6e9, seed: int = 0) -> np.ndarray:
+    df = random_walk_ohlcv(n_candles, seed=seed)
+    times = start_time + np.arange(n_candles) * RESOLUTION
+    return np.column_stack((times, df[cs.CANDLE_COLUMNS[1:]].values))
+
+
+def test_save_writes_through_unique_temporary_files(tmp_path, monkeypatch):
+    store = cs.CandleStore(str(tmp_path))
+    replaced = []
+    replace = os.replace
+
+    def recording_replace(src, dst):
+        replaced.append(src)
+        replace(src, dst)
+
+    monkeypatch.setattr(cs.os, "replace", recording_replace)
+    store.save(MARKET, RESOLUTION, _candles(10))
+    store.save(MARKET, RESOLUTION, _candles(20))
+
+    assert len(set(replaced)) == 2
+    assert all(os.path.dirname(src) == str(tmp_path) for src in replaced)
+    assert os.listdir(tmp_path) == [f"{MARKET}_{RESOLUTION}.npy"]
+    np.testing.assert_array_equal(store.load(MARKET, RESOLUTION), _candles(20))
+
+
+def test_failed_save_keeps_the_stored_candles(tmp_path, monkeypatch):
+    store = cs.CandleStore(str(tmp_path))
+    store.save(MARKET, RESOLUTION, _candles(10))
+
+    def failing_save(npy_file, candles):
+        npy_file.write(b"partial")
+        raise OSError("Disk full")
+
+    monkeypatch.setattr(cs.np, "save", failing_save)
+    with pytest.raises(OSError):
+        store.save(MARKET, RESOLUTION, _candles(20))
+    monkeypatch.undo()
+
+    assert os.listdir(tmp_path) == [f"{MARKET}_{RESOLUTION}.npy"]
+    np.testing.assert_array_equal(store.load(MARKET, RESOLUTION), _candles(10))
+
+
+def test_concurrent_saves_leave_one_complete_array(tmp_path):
+    store = cs.CandleStore(str(tmp_path))
+    versions = [_candles(500, seed=seed) for seed in range(8)]
+    errors = []
+
+    def save(candles):
+        try:
+            for _ in range(20):
+                store.save(MARKET, RESOLUTION, candles)
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=save, args=(candles,)) for candles in versions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    stored = np.asarray(store.load(MARKET, RESOLUTION))
+    assert any(np.array_equal(stored, candles) for candles in versions)
+    assert os.listdir(tmp_path) == [f"{MARKET}_{RESOLUTION}.npy"]
+
+
+@pytest.fixture
+def exchange() -> MockExchange:
+    # 300 candles, the last one closed at `now`
+    ohlcv = random_walk_ohlcv(300)
+    end_time = 1.6e9 // RESOLUTION * RESOLUTION
+    candles = ohlcv_to_candles({column: ohlcv[column].values for column in ohlcv}, RESOLUTION,
+                               end_time - 300 * RESOLUTION)
+    return MockExchange({(MARKET, RESOLUTION): candles}, now=end_time)
+
+
+def _seeded_client(exchange: MockExchange, folder_path: str, n_stored: int) -> MockFtxClient:
+    # A store holding the first n_stored candles of the exchange
+    store = cs.CandleStore(folder_path)
+    store.save(MARKET, RESOLUTION, MockFtxClient._parse_candles(exchange.candles[MARKET, RESOLUTION][:n_stored]))
+    return MockFtxClient(exchange, candle_store=store)
+
+
+def _record_requests(exchange: MockExchange, monkeypatch, drop: int = 0) -> list:
+    # Start time of every candle request, a delta from the last stored candle on loses its first `drop` candles
+    requests = []
+    get_historical_prices = exchange.get_historical_prices
+    first_time = exchange.candles[MARKET, RESOLUTION][0]["time"] / 1000
+
+    def recording_get_historical_prices(market, resolution, start_time=0):
+        requests.append(start_time)
+        candles = get_historical_prices(market, resolution, start_time)
+        return candles[drop:] if start_time > first_time else candles
+
+    monkeypatch.setattr(exchange, "get_historical_prices", recording_get_historical_prices)
+    return requests
+
+
+def test_contiguous_delta_is_merged(tmp_path, exchange, monkeypatch):
+    ftx = _seeded_client(exchange, str(tmp_path), 250)
+    last_stored = ftx._candle_store.last_time(MARKET, RESOLUTION)
+    requests = _record_requests(exchange, monkeypatch)
+
+    df = ftx.get_historical_market_data(MARKET, "4h", "40 days ago")
+    assert requests == [last_stored]
+    assert ftx._candle_store.first_time(MARKET, RESOLUTION) is None
+    assert len(df) == 240 and (np.diff(df.index.values) == np.timedelta64(RESOLUTION, "s")).all()
+    assert len(ftx._candle_store.load(MARKET, RESOLUTION)) == 300
+
+
+def test_delta_with_a_gap_refetches_the_whole_range(tmp_path, exchange, monkeypatch):
+    ftx = _seeded_client(exchange, str(tmp_path), 250)
+    last_stored = ftx._candle_store.last_time(MARKET, RESOLUTION)
+    requests = _record_requests(exchange, monkeypatch, drop=10)
+
+    df = ftx.get_historical_market_data(MARKET, "4h", "40 days ago")
+    assert requests[0] == last_stored and len(requests) == 2 and requests[1] < last_stored
+    assert len(df) == 240 and (np.diff(df.index.values) == np.timedelta64(RESOLUTION, "s")).all()
+    stored = ftx._candle_store.load(MARKET, RESOLUTION)
+    assert len(stored) == 300 and (np.diff(stored[:, 0]) == RESOLUTION).all()
+
+
+def test_market_listed_after_the_start_time_is_covered(tmp_path, exchange, monkeypatch):
+    # The exchange's 300 candles are 50 days, the market was listed after the start of the 60 day range
+    ftx = MockFtxClient(exchange, candle_store=cs.CandleStore(str(tmp_path)))
+    requests = _record_requests(exchange, monkeypatch)
+    assert len(ftx.get_historical_market_data(MARKET, "4h", "60 days ago")) == 300
+    first_time = exchange.candles[MARKET, RESOLUTION][0]["time"] / 1000
+    assert ftx._candle_store.first_time(MARKET, RESOLUTION) == first_time
+
+    # Later cycles only request the candles from the last stored one on
+    last_stored = ftx._candle_store.last_time(MARKET, RESOLUTION)
+    df = ftx.get_historical_market_data(MARKET, "4h", "60 days ago")
+    assert requests[1:] == [last_stored]
+    assert len(df) == 300 and df.index[0].timestamp() == first_time
@@ -0,0 +1,98 @@
+import asyncio
+import datetime
+import json
+import math
+import threading
+import time
+
+import pandas as pd
+
+from candle_stream import CandleStream, StreamingSignals
+from mock_exchange import MockExchange, MockExchangeServer
+from supertrend import SupertrendState
+
+MARKET = "MOCK-PERP"
+
+
+def _bar(df: pd.DataFrame, idx: int, partial: bool = False, scale: float = 1.) -> dict:
+    candle = df.iloc[idx]
+    return {"time": df.index[idx].timestamp(), "open": candle.open * scale, "high": candle.high * scale,
+            "low": candle.low * scale, "close": candle.close * scale, "volume": candle.volume, "partial": partial}
+
+
+def test_partial_bar_is_backfilled_off_the_calling_thread(ohlcv):
+    state = SupertrendState.from_history(ohlcv.iloc[:600], look_back=10, multiplier=3)
+    release = threading.Event()
+    backfill_threads = []
+
+    def backfill(market: str) -> pd.DataFrame:
+        backfill_threads.append(threading.current_thread())
+        release.wait(5)
+        return ohlcv.iloc[:602]
+
+    signals = StreamingSignals({MARKET: state}, on_signal=lambda market, result: None, backfill=backfill)
+    start = time.monotonic()
+    # The streamed partial bar missed trades, the exchange's candle replaces it
+    signals.on_bar_close(MARKET, _bar(ohlcv, 600, partial=True, scale=2.))
+    signals.on_bar_close(MARKET, _bar(ohlcv, 601))
+    assert time.monotonic() - start < 1
+    assert state.n_candles == 600
+
+    release.set()
+    signals.stop()
+    assert backfill_threads and backfill_threads[0] is not threading.current_thread()
+    assert state.n_candles == 602
+
+    # Nothing queued anymore, the next bar is applied right away
+    signals.on_bar_close(MARKET, _bar(ohlcv, 602))
+    expected = SupertrendState.from_history(ohlcv.iloc[:603], look_back=10, multiplier=3)
+    assert json.dumps(state.to_dict()) == json.dumps(expected.to_dict())
+
+
+def test_signals_of_backfilled_bars_arrive_in_order(ohlcv):
+    state = SupertrendState.from_history(ohlcv.iloc[:300], look_back=10, multiplier=3)
+    expected = [result["time"] for result in SupertrendState.from_history(
+        ohlcv.iloc[:300], look_back=10, multiplier=3).update_from_dataframe(ohlcv) if result["st_signal"] != 0]
+    received = []
+    signals = StreamingSignals({MARKET: state}, on_signal=lambda market, result: received.append(result["time"]),
+                               backfill=lambda market: ohlcv)
+    # Every tenth bar is partial, the ones after it queue up behind its backfill
+    for idx in range(300, len(ohlcv)):
+        signals.on_bar_close(MARKET, _bar(ohlcv, idx, partial=idx % 10 == 0))
+    signals.stop()
+    assert len(expected) > 3
+    assert received == expected
+
+
+async def _wait_for(condition, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_bars_closed_while_disconnected_are_partial():
+    bars = []
+
+    async def run() -> None:
+        server = MockExchangeServer(MockExchange({}))
+        await server.start()
+        stream = CandleStream([MARKET], 60, lambda market, bar: bars.append(bar),
+                              endpoint=f"ws://127.0.0.1:{server.port}/ws", max_reconnect_delay=1)
+        listening = asyncio.ensure_future(stream._listen())
+        await _wait_for(lambda: 0 < stream.aggregator.partial_before < math.inf)
+        now = time.time()
+        await server.publish_trades(MARKET, [{"price": 100., "size": 1., "time": datetime.datetime.fromtimestamp(
+            now, datetime.timezone.utc).isoformat()}])
+        await _wait_for(lambda: MARKET in stream.aggregator._bars)
+
+        # Down for good, the timer closes the bar and the next ones without their trades
+        await server.disconnect_websockets()
+        await server.stop()
+        await _wait_for(lambda: stream.aggregator.partial_before == math.inf)
+        stream.aggregator.close_due(now + 180)
+        stream._stopped.set()
+        listening.cancel()
+
+    asyncio.run(run())
+    assert len(bars) == 3 and all(bar["partial"] for bar in bars)
@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from chart_renderer import CHART_COLUMNS, ChartRenderer, RenderQueue, chart_path, prune_charts
+from conftest import random_walk_ohlcv
+
+MARKET = "MOCK-PERP"
+PARAMS = {"Multiplier": 3, "Lookback": 10, "TheDfactor": 1.5}
+
+
+@pytest.fixture
+def chart_df() -> pd.DataFrame:
+    ohlcv = random_walk_ohlcv(100)
+    close = ohlcv.close
+    return pd.DataFrame({"close": close, "ema200": close.ewm(span=200).mean(), "st": close * 0.98,
+                         "short_trig": close.where(np.arange(len(close)) % 17 == 0),
+                         "long_trig": close.where(np.arange(len(close)) % 23 == 0),
+                         "vol_ema200": ohlcv.volume.ewm(span=200).mean()})[CHART_COLUMNS]
+
+
+def test_renders_once_under_the_chart_path(tmp_path, chart_df):
+    renderer = ChartRenderer(str(tmp_path / "charts"), dpi=20)
+    figure_path = renderer.render(MARKET, chart_df, PARAMS)
+    assert figure_path == chart_path(str(tmp_path / "charts"), MARKET, chart_df, PARAMS)
+    assert os.listdir(tmp_path / "charts") == [os.path.basename(figure_path)]
+    with open(figure_path, "rb") as figure_file:
+        # JPEG start of image marker
+        assert figure_file.read(2) == b"\xff\xd8"
+
+    # Already on disk, not drawn again
+    renderer.fig.savefig = None
+    assert renderer.render(MARKET, chart_df, PARAMS) == figure_path
+    # A new candle is a new chart
+    assert chart_path(str(tmp_path), MARKET, chart_df.iloc[:-1], PARAMS) != chart_path(str(tmp_path), MARKET,
+                                                                                     chart_df, PARAMS)
+
+
+def test_failed_render_leaves_no_file(tmp_path, chart_df, monkeypatch):
+    renderer = ChartRenderer(str(tmp_path), dpi=20)
+
+    def savefig(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(renderer.fig, "savefig", savefig)
+    with pytest.raises(OSError):
+        renderer.render(MARKET, chart_df, PARAMS)
+    assert os.listdir(tmp_path) == []
+
+
+def test_prune_removes_old_charts_only(tmp_path, chart_df):
+    renderer = ChartRenderer(str(tmp_path), dpi=20)
+    old_path = renderer.render(MARKET, chart_df.iloc[:-1], PARAMS)
+    new_path = renderer.render(MARKET, chart_df, PARAMS)
+    os.utime(old_path, (0, 0))
+    (tmp_path / "notes.txt").write_text("kept")
+    prune_charts(str(tmp_path), max_age=3600)
+    assert sorted(os.listdir(tmp_path)) == sorted([os.path.basename(new_path), "notes.txt"])
+
+
+def test_render_queue_draws_each_chart_once(tmp_path, chart_df):
+    render_queue = RenderQueue(str(tmp_path), dpi=20)
+    try:
+        future = render_queue.submit(MARKET, chart_df, PARAMS)
+        # Queued or drawn, the same chart is not submitted twice
+        assert render_queue.submit(MARKET, chart_df, PARAMS) is future
+        figure_path = future.result(timeout=60)
+        assert os.path.exists(figure_path)
+
+        render_queue.prune(max_age=3600)
+        assert render_queue._pending == {}
+        existing = render_queue.submit(MARKET, chart_df, PARAMS)
+        assert existing.done() and existing.result() == figure_path
+
+        other = render_queue.submit("OTHER-PERP", chart_df, PARAMS).result(timeout=60)
+        assert other != figure_path and os.path.exists(other)
+    finally:
+        render_queue.close()
@@ -0,0 +1,79 @@
+import pytest
+
+import ftx_client
+from conftest import random_walk_ohlcv
+from ftx_client import FtxClient
+from mock_exchange import MockExchange, MockFtxClient, ohlcv_to_candles
+
+MARKET = "MOCK-PERP"
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(ftx_client, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def exchange() -> MockExchange:
+    ohlcv = random_walk_ohlcv(10)
+    return MockExchange({(MARKET, 3600): ohlcv_to_candles({column: ohlcv[column].values for column in ohlcv}, 3600,
+                                                          1.6e9)})
+
+
+@pytest.mark.parametrize("increment, decimals", [(1e-05, 5), (0.5, 1), (0.0025, 4), (10.0, 0), (1.0, 0), (1, 0)])
+def test_increment_decimals(increment, decimals):
+    assert FtxClient._increment_decimals(increment) == decimals
+
+
+@pytest.mark.parametrize("value, increment, rounded", [(0.123456789, 1e-05, 0.12346), (2.26, 0.5, 2.5),
+                                                       (1.00374, 0.0025, 1.0025), (1.0038, 0.0025, 1.005),
+                                                       (1234.5, 10.0, 1230.), (0.3, 0.1, 0.3)])
+def test_round_to_increment(value, increment, rounded):
+    assert FtxClient._round_to_increment(value, increment) == rounded
+
+
+def test_market_info_is_cached_until_the_ttl(exchange, clock):
+    ftx = MockFtxClient(exchange, market_ttl=60)
+    assert ftx.get_market_info(MARKET)["sizeIncrement"] == 0.001
+    assert ftx.round_size(MARKET, 1.23456) == 1.235
+    assert ftx.get_price_precision(MARKET) == 3
+    assert ftx.request_count == 1
+
+    clock.now += 59
+    ftx.get_market_info(MARKET)
+    assert ftx.request_count == 1
+    clock.now += 1
+    ftx.get_market_info(MARKET)
+    assert ftx.request_count == 2
+
+    # A market listed after the last refresh is looked up right away
+    with pytest.raises(KeyError):
+        ftx.get_market_info("NEW-PERP")
+    assert ftx.request_count == 3
+
+
+def test_quote_is_cached_until_the_ttl(exchange, clock):
+    ftx = MockFtxClient(exchange, quote_ttl=1)
+    quote = ftx.get_quote(MARKET)
+    assert ftx.get_latest_price(MARKET, "sell") == quote["ask"]
+    assert ftx.get_latest_price(MARKET, "buy") == quote["bid"] < quote["ask"]
+    assert ftx.request_count == 1
+
+    clock.now += 1
+    ftx.get_quote(MARKET)
+    assert ftx.request_count == 2
+    # Quotes are per market
+    assert ftx._cached_quote("OTHER-PERP") is None
@@ -0,0 +1,85 @@
+import os
+import threading
+
+from instrumentation import Metrics, endpoint_name, write_prometheus
+
+
+def test_disabled_records_nothing():
+    metrics = Metrics()
+    with metrics.timer("stage"):
+        pass
+    metrics.count("calls")
+    assert metrics.summary()["stages"] == {} and metrics.summary()["counters"] == {}
+
+
+def test_market_of_the_thread():
+    metrics = Metrics(enabled=True)
+    with metrics.market("BTC-PERP"):
+        metrics.record("scan:fetch", 2.)
+        metrics.count("rows", 10)
+    metrics.record("scan:fetch", 1., market="ETH-PERP")
+    summary = metrics.summary()
+    assert summary["stages"]["scan:fetch"] == {"calls": 2, "seconds": 3., "max_seconds": 2.}
+    assert summary["markets"] == {"BTC-PERP": {"scan:fetch": 2., "rows": 10}, "ETH-PERP": {"scan:fetch": 1.}}
+    assert metrics.slowest_market("scan:") == "BTC-PERP"
+
+
+def test_parallel_jobs_collect_their_own_metrics():
+    # What each job thread records to the global instance, from decorated hot paths too, ends up in its own metrics
+    shared = Metrics(enabled=True)
+
+    @shared.timed("kernel")
+    def kernel() -> None:
+        shared.count("rows", 100)
+
+    jobs = {interval: Metrics(enabled=True) for interval in ("1h", "4h")}
+    barrier = threading.Barrier(len(jobs))
+
+    def job(interval: str, calls: int) -> None:
+        with shared.collect(jobs[interval]):
+            barrier.wait()
+            for _ in range(calls):
+                with shared.market(f"{interval}-PERP"):
+                    kernel()
+            if interval == "1h":
+                jobs[interval].reset()
+
+    threads = [threading.Thread(target=job, args=("1h", 50)), threading.Thread(target=job, args=("4h", 200))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Resetting the 1h metrics leaves the 4h ones alone
+    assert jobs["1h"].summary()["stages"] == {}
+    summary = jobs["4h"].summary()
+    assert summary["stages"]["kernel"]["calls"] == 200
+    assert summary["counters"] == {"rows": 200 * 100}
+    assert list(summary["markets"]) == ["4h-PERP"]
+    assert shared.summary()["stages"] == {}
+
+    # Outside collect() the global instance records again
+    kernel()
+    assert shared.summary()["counters"] == {"rows": 100}
+
+
+def test_endpoint_names():
+    assert endpoint_name("markets/BTC-PERP/candles") == "markets/*/candles"
+    assert endpoint_name("orders/12345") == "orders/*"
+    assert endpoint_name("wallet/balances") == "wallet/balances"
+
+
+def test_prometheus_samples_carry_the_labels(tmp_path):
+    summary = {"stages": {"scan:fetch": {"calls": 3, "seconds": 1.5}}, "counters": {"api_calls": 7},
+               "duration": 2.}
+    filepath = str(tmp_path / "metrics" / "supertrend.prom")
+    write_prometheus(summary, filepath, labels={"interval": "1h"})
+    lines = open(filepath).read().splitlines()
+    assert 'supertrend_stage_seconds{stage="scan:fetch",interval="1h"} 1.500000' in lines
+    assert 'supertrend_stage_calls{stage="scan:fetch",interval="1h"} 3' in lines
+    assert 'supertrend_api_calls{interval="1h"} 7' in lines
+    assert 'supertrend_cycle_seconds{interval="1h"} 2.000000' in lines
+
+    write_prometheus(summary, filepath)
+    assert "supertrend_api_calls 7" in open(filepath).read().splitlines()
+    assert os.listdir(tmp_path / "metrics") == ["supertrend.prom"]
@@ -0,0 +1,100 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+
+import market_scanner
+from benchmarks import load_candle_fixtures, load_markets_fixture
+from conftest import FIXTURE_FOLDER, random_walk_ohlcv
+from market_scanner import MarketScanner, analyse_market
+from mock_exchange import MockExchange, MockFtxClient, ohlcv_to_candles
+
+RESOLUTION = 4 * 3600
+MARKETS = ["A-PERP", "B-PERP", "C-PERP"]
+PARAMS = {"Multiplier": 3, "Lookback": 10, "TheDfactor": 1.5}
+
+
+@pytest.fixture
+def exchange() -> MockExchange:
+    # The last candle is in progress at the exchange's clock
+    start_time = (time.time() // RESOLUTION - 399) * RESOLUTION
+    candles = {}
+    for seed, market in enumerate(MARKETS):
+        ohlcv = random_walk_ohlcv(400, seed=seed, volatility=0.02)
+        candles[market, RESOLUTION] = ohlcv_to_candles({column: ohlcv[column].values for column in ohlcv},
+                                                       RESOLUTION, start_time)
+    return MockExchange(candles, now=start_time + 399 * RESOLUTION + 60)
+
+
+def _scan(exchange: MockExchange, analysis_workers: int, markets: list = MARKETS) -> dict:
+    scanner = MarketScanner(MockFtxClient(exchange), interval="4h", start_time="100 days ago", min_data_length=100,
+                            fetch_workers=2, analysis_workers=analysis_workers)
+    return {result["market"]: result for result in scanner.scan(markets, {market: PARAMS for market in MARKETS})}
+
+
+@pytest.mark.parametrize("analysis_workers", [1, 2])
+def test_scan_matches_a_serial_analysis(exchange, analysis_workers):
+    results = _scan(exchange, analysis_workers)
+    assert sorted(results) == MARKETS
+
+    ftx = MockFtxClient(exchange)
+    for market in MARKETS:
+        df = ftx.get_historical_market_data(market, interval="4h", start_time="100 days ago")
+        # Signals are taken on closed candles, the one in progress is left out
+        expected = analyse_market(market, df.iloc[:-1], PARAMS)
+        result = results[market]
+        for key in ("params", "close", "st", "ema200", "last_signal", "stoch_rsi"):
+            assert result[key] == expected[key]
+        pd.testing.assert_frame_equal(result["chart"], expected["chart"])
+
+
+def test_analysis_workers_are_spawned_once(exchange, monkeypatch):
+    monkeypatch.setattr(market_scanner, "_process_pools", {})
+    _scan(exchange, 2)
+    pool = market_scanner._process_pools[2]
+    assert pool._mp_context.get_start_method() == "spawn"
+    # The next scan reuses the workers
+    _scan(exchange, 2)
+    assert market_scanner._process_pools == {2: pool}
+    pool.shutdown()
+
+
+def test_dead_worker_is_replaced(exchange, monkeypatch):
+    monkeypatch.setattr(market_scanner, "_process_pools", {})
+    _scan(exchange, 2)
+    pool = market_scanner._process_pools[2]
+    with pytest.raises(market_scanner.BrokenProcessPool):
+        pool.submit(os._exit, 1).result()
+
+    # The scan the pool broke under loses its markets, the next one gets new workers
+    assert _scan(exchange, 2) == {}
+    assert sorted(_scan(exchange, 2)) == MARKETS
+    assert market_scanner._process_pools[2] is not pool
+    market_scanner._process_pools[2].shutdown()
+
+
+def test_markets_without_params_are_skipped(exchange):
+    results = _scan(exchange, 1, markets=MARKETS + ["D-PERP"])
+    assert sorted(results) == MARKETS
+
+
+def test_scan_of_the_recorded_fixture():
+    candles = {}
+    for name, fixture in load_candle_fixtures(FIXTURE_FOLDER).items():
+        market, resolution = name.rsplit("_", 1)
+        candles[market, int(resolution)] = fixture
+    end_time = max(fixture[-1]["time"] / 1000 for fixture in candles.values())
+    # Right after the last recorded candle closed
+    exchange = MockExchange(candles, market_info=load_markets_fixture(FIXTURE_FOLDER), now=end_time + RESOLUTION)
+    scanner = MarketScanner(MockFtxClient(exchange), interval="4h", start_time="100 days ago", min_data_length=600,
+                            analysis_workers=1)
+    markets = exchange.markets
+    results = {result["market"]: result for result in scanner.scan(markets, {market: PARAMS for market in markets})}
+    assert sorted(results) == ["HIGHPRICE-PERP", "LOWPRICE-PERP"]
+
+    ftx = MockFtxClient(exchange)
+    for market, result in results.items():
+        df = ftx.get_historical_market_data(market, interval="4h", start_time="100 days ago")
+        assert df.index[-1].timestamp() == end_time and result["close"] == candles[market, RESOLUTION][-1]["close"]
+        assert result["last_signal"] == analyse_market(market, df, PARAMS)["last_signal"]
@@ -0,0 +1,107 @@
+import json
+import sys
+
+import pandas as pd
+import pytest
+
+import optimize_markets as om
+from candle_panel import CandlePanel
+from conftest import random_walk_ohlcv
+
+MARKETS = ["A-PERP", "B-PERP", "C-PERP"]
+
+
+@pytest.fixture
+def panel_path(tmp_path) -> str:
+    frames = {market: random_walk_ohlcv(700, seed=seed, volatility=0.02) for seed, market in enumerate(MARKETS)}
+    index = frames[MARKETS[0]].index
+    panel = CandlePanel.create(str(tmp_path / "panel"), MARKETS, index[0].timestamp(), index[-1].timestamp(),
+                               4 * 3600)
+    for market, df in frames.items():
+        panel.write(market, df)
+    panel.flush()
+    return panel.folder_path
+
+
+def _optimize(tmp_path, panel_path: str, markets: list = None, multipliers: list = None, **kwargs) \
+        -> pd.DataFrame:
+    return om.optimize_all_markets(markets or MARKETS, multipliers or [3, 4], [10, 11], workers=1,
+                                   checkpoint_filepath=str(tmp_path / "checkpoint.jsonl"),
+                                   output_filepath=str(tmp_path / "optimized.csv"), panel_path=panel_path, **kwargs)
+
+
+def test_writes_the_optimized_factor(tmp_path, panel_path):
+    optimized = _optimize(tmp_path, panel_path)
+    written = pd.read_csv(tmp_path / "optimized.csv")
+    assert list(written.columns) == ["Name", "Multiplier", "Lookback", "TheDfactor"]
+    assert list(written.Name) == MARKETS and written.TheDfactor.notna().all()
+    pd.testing.assert_frame_equal(written, optimized, check_dtype=False)
+
+
+def test_resume_checks_the_parameter_grid(tmp_path, panel_path):
+    # An interrupted run: the grid header and one market's result
+    checkpoint_filepath = tmp_path / "checkpoint.jsonl"
+    _optimize(tmp_path, panel_path, markets=MARKETS[:1])
+    grid = {"multipliers": [3, 4], "lookbacks": [10, 11], "optimize_to": "TheDfactor", "exit_params": None,
+            "interval": om.settings["analysis"]["interval"], "start_time": om.settings["analysis"]["start_time"]}
+    result = pd.read_csv(tmp_path / "optimized.csv").iloc[0].to_dict()
+    checkpoint_filepath.write_text(json.dumps({"Grid": grid}) + "\n" + json.dumps(result) + "\n")
+    assert om.load_checkpoint(str(checkpoint_filepath)) == (grid, {MARKETS[0]: result})
+
+    with pytest.raises(ValueError, match="another parameter grid"):
+        _optimize(tmp_path, panel_path, multipliers=[2, 3])
+    assert om.load_checkpoint(str(checkpoint_filepath)) == (grid, {MARKETS[0]: result})
+
+    # A checkpoint from before the grid was recorded can't be checked either
+    checkpoint_filepath.write_text(json.dumps(result) + "\n")
+    with pytest.raises(ValueError, match="another parameter grid"):
+        _optimize(tmp_path, panel_path)
+
+    # The same grid resumes, --fresh starts over with another one
+    checkpoint_filepath.write_text(json.dumps({"Grid": grid}) + "\n" + json.dumps(result) + "\n")
+    assert list(_optimize(tmp_path, panel_path).Name) == MARKETS
+    assert list(_optimize(tmp_path, panel_path, multipliers=[2, 3], fresh=True).Name) == MARKETS
+    assert not checkpoint_filepath.exists()
+
+
+def test_some_markets_are_merged_into_the_output(tmp_path, panel_path, monkeypatch):
+    _optimize(tmp_path, panel_path)
+    before = pd.read_csv(tmp_path / "optimized.csv").set_index("Name")
+    monkeypatch.setattr(om, "OPTIMIZEDML_FILEPATH", str(tmp_path / "optimized.csv"))
+    monkeypatch.setattr(om, "CHECKPOINT_FILEPATH", str(tmp_path / "checkpoint.jsonl"))
+    monkeypatch.setattr(sys, "argv", ["optimize_markets.py", "--markets", MARKETS[1], "--panel", panel_path,
+                                      "--workers", "1", "--multipliers", "1", "--lookbacks", "7"])
+    om.main()
+
+    written = pd.read_csv(tmp_path / "optimized.csv").set_index("Name")
+    assert sorted(written.index) == MARKETS
+    assert (written.loc[MARKETS[1], "Multiplier"], written.loc[MARKETS[1], "Lookback"]) == (1, 7)
+    for market in (MARKETS[0], MARKETS[2]):
+        assert written.loc[market].to_dict() == before.loc[market].to_dict()
+
+
+def test_csv_is_replaced_whole(tmp_path, monkeypatch):
+    filepath = tmp_path / "optimized.csv"
+    df = pd.DataFrame({"Name": MARKETS, "Multiplier": [3., 4., 5.]})
+    om.write_csv_atomic(df, str(filepath))
+    om.write_csv_atomic(df.iloc[:1], str(filepath))
+    pd.testing.assert_frame_equal(pd.read_csv(filepath), df.iloc[:1])
+
+    def failing_to_csv(frame, path_or_buf, **kwargs):
+        path_or_buf.write("Name,Multi")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(pd.DataFrame, "to_csv", failing_to_csv)
+    with pytest.raises(OSError):
+        om.write_csv_atomic(df, str(filepath))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["optimized.csv"]
+    monkeypatch.undo()
+    pd.testing.assert_frame_equal(pd.read_csv(filepath), df.iloc[:1])
+
+
+def test_other_intervals_are_optimized_into_their_own_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(om, "OPTIMIZEDML_FILEPATH", str(tmp_path / "optimized.csv"))
+    assert om.optimized_params_filepath(om.settings["analysis"]["interval"]) == str(tmp_path / "optimized.csv")
+    assert om.optimized_params_filepath("1h") == str(tmp_path / "optimized_1h.csv")
+    assert om.timeframe_start_time("1h") == om.settings["schedule"]["start_times"]["1h"]
+    assert om.timeframe_start_time("4h") == om.settings["analysis"]["start_time"]
@@ -0,0 +1,210 @@
+import datetime
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import random_walk_ohlcv
+from mock_exchange import MockExchange, MockFtxClient, ohlcv_to_candles
+from order_tracker import FillsSource, LocalFillsSource, OrderTracker
+
+MARKET = "MOCK-PERP"
+
+
+class UnconnectedSource(FillsSource):
+    """A feed that hasn't connected yet, connect() does what the websocket does once subscribed."""
+
+    def start(self, on_message, on_connect=None) -> None:
+        self._on_message = on_message
+        self._on_connect = on_connect
+
+    def connect(self) -> None:
+        if self._on_connect is not None:
+            self._on_connect()
+        self.connected = True
+
+
+@pytest.fixture
+def exchange() -> MockExchange:
+    ohlcv = random_walk_ohlcv(10)
+    return MockExchange({(MARKET, 3600): ohlcv_to_candles({column: ohlcv[column].values for column in ohlcv}, 3600,
+                                                          1.6e9)})
+
+
+def _client(exchange: MockExchange, source: FillsSource, load_positions: bool = True) -> MockFtxClient:
+    exchange.listeners.append(lambda channel, data: source.connected and source._on_message(channel, data))
+    tracker = OrderTracker(source, load_positions=exchange.get_positions if load_positions else None)
+    return MockFtxClient(exchange, order_tracker=tracker)
+
+
+def _buy(ftx: MockFtxClient, size: float = 1.) -> None:
+    ftx.place_order(MARKET, side="buy", price=0, size=size, type="market")
+
+
+def test_synced_tracker_answers_without_rest(exchange):
+    ftx = _client(exchange, LocalFillsSource())
+    _buy(ftx)
+    requests = ftx.request_count
+    assert ftx._order_tracker.synced
+    assert ftx.check_open_position(MARKET)["netSize"] == 1.
+    assert ftx.request_count == requests
+
+
+def test_disconnected_tracker_falls_back_to_rest(exchange):
+    ftx = _client(exchange, LocalFillsSource())
+    _buy(ftx)
+    # Fills while the feed is down never reach the tracker
+    ftx._order_tracker.source.stop()
+    _buy(ftx, 2.)
+    assert not ftx._order_tracker.synced
+    assert ftx._order_tracker.position(MARKET)["netSize"] == 1.
+    assert ftx.check_open_position(MARKET)["netSize"] == 3.
+
+
+def test_tracker_is_only_used_once_synced(exchange):
+    _buy(MockFtxClient(exchange))
+    source = UnconnectedSource()
+    ftx = _client(exchange, source)
+    assert not ftx._order_tracker.synced
+    assert ftx.check_open_position(MARKET)["netSize"] == 1.
+
+    source.connect()
+    requests = ftx.request_count
+    assert ftx._order_tracker.synced
+    assert ftx.check_open_position(MARKET)["netSize"] == 1.
+    assert ftx.request_count == requests
+
+
+def test_failed_resync_falls_back_to_rest(exchange):
+    source = UnconnectedSource()
+    ftx = _client(exchange, source)
+    source.connect()
+    _buy(ftx)
+
+    # The reconnect can't seed the positions, whatever the tracker held from before is not trusted
+    source.connected = False
+    ftx._order_tracker._load_positions = lambda: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        source.connect()
+    _buy(MockFtxClient(exchange))
+    assert ftx.check_open_position(MARKET)["netSize"] == 2.
+
+
+def test_tracker_without_load_positions_is_not_synced(exchange):
+    _buy(MockFtxClient(exchange))
+    ftx = _client(exchange, LocalFillsSource(), load_positions=False)
+    assert not ftx._order_tracker.synced
+    assert ftx.check_open_position(MARKET)["netSize"] == 1.
+
+
+def test_unsynced_tracker_closes_through_rest(exchange, monkeypatch):
+    monkeypatch.setattr("ftx_client.time.sleep", lambda seconds: None)
+    _buy(MockFtxClient(exchange), 2.)
+    ftx = _client(exchange, UnconnectedSource())
+    # The tracker doesn't know the position, that alone must not count as closed
+    assert ftx.market_close_and_cancel_orders(MARKET, side="sell", size=1.)[0] is False
+    closed, _ = ftx.market_close(MARKET, side="sell", size=0.5)
+    assert closed.result(timeout=5) is False
+    assert ftx.check_open_position(MARKET)["netSize"] == 0.5
+
+    closed, response = ftx.market_close(MARKET, side="sell", size=0.5)
+    assert closed.result(timeout=5) is True and response["size"] == 0.5
+    assert ftx.check_open_position(MARKET) == {}
+
+
+def test_market_close_without_tracker(exchange):
+    ftx = MockFtxClient(exchange)
+    _buy(ftx)
+    closed, _ = ftx.market_close(MARKET, side="sell", size=1.)
+    assert closed.result(timeout=5) is True
+    assert ftx.market_close_and_cancel_orders(MARKET, side="sell", size=0.)[0] is True
+
+
+def test_close_resolves_on_a_fill_or_a_sync(exchange):
+    source = UnconnectedSource()
+    ftx = _client(exchange, source)
+    tracker = ftx._order_tracker
+    closed = tracker.expect_close(MARKET)
+    assert not closed.done()
+
+    # Synced and flat
+    source.connect()
+    assert closed.result(timeout=0) is True
+
+    _buy(ftx)
+    closed, _ = ftx.market_close(MARKET, side="sell", size=1.)
+    assert closed.result(timeout=0) is True
+    assert tracker.position(MARKET) == {}
+
+
+def _fill(size: float, fill_time: float) -> dict:
+    return {"market": MARKET, "side": "buy", "size": size, "price": 100.,
+            "time": datetime.datetime.fromtimestamp(fill_time, datetime.timezone.utc).isoformat()}
+
+
+def test_fills_pushed_while_the_positions_load_are_counted_once():
+    clock = [1000.]
+    source = UnconnectedSource()
+    loads = []
+
+    def load_positions() -> list:
+        loads.append(clock[0])
+        # Queued on the feed since before the request, and already in the positions
+        source._on_message("fills", _fill(1., 999.))
+        clock[0] += 1
+        # Filled once the positions were taken
+        source._on_message("fills", _fill(2., 1002.))
+        return [{"future": MARKET, "netSize": 1.}]
+
+    tracker = OrderTracker(source, load_positions=load_positions, clock=lambda: clock[0])
+    source.connect()
+    assert tracker.position(MARKET)["netSize"] == 3.
+    # Pushed late but from before the positions too
+    source._on_message("fills", _fill(1., 999.5))
+    source._on_message("fills", _fill(0.5, 1003.))
+    assert tracker.position(MARKET)["netSize"] == 3.5
+    assert loads == [1000.]
+
+
+def test_positions_are_loaded_again_after_a_fill_during_the_request():
+    clock = [1000.]
+    source = UnconnectedSource()
+    loads = []
+
+    def load_positions() -> list:
+        loads.append(clock[0])
+        if len(loads) == 1:
+            # Filled while the request was in flight, the positions may or may not have it
+            source._on_message("fills", _fill(1., clock[0] + 0.5))
+        clock[0] += 1
+        return [{"future": MARKET, "netSize": 1.}]
+
+    tracker = OrderTracker(source, load_positions=load_positions, clock=lambda: clock[0])
+    source.connect()
+    assert loads == [1000., 1001.]
+    assert tracker.synced and tracker.position(MARKET)["netSize"] == 1.
+
+    # Fills in flight every time, the feed doesn't connect and REST stays in use
+    tracker.max_loads = 2
+    source.connected = False
+    loads.clear()
+
+    def changing_positions() -> list:
+        source._on_message("fills", _fill(1., clock[0]))
+        return []
+
+    tracker._load_positions = changing_positions
+    with pytest.raises(RuntimeError):
+        source.connect()
+    assert not tracker.synced
+    # Nothing is left buffered
+    source._on_message("fills", _fill(1., clock[0] + 10))
+    assert tracker.position(MARKET)["netSize"] == 2.
+
+
+def test_rest_client_does_not_need_aiohttp():
+    # order_tracker (and with it aiohttp) is only imported for type checking
+    code = "import sys; sys.modules['aiohttp'] = None; import ftx_client; assert 'order_tracker' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True,
+                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,29 @@
+import numpy as np
+
+import backtesting as bt
+import portfolio
+import supertrend as spt
+from indicator_panel import IndicatorPanel
+from conftest import random_walk_ohlcv
+
+
+def test_driftless_markets_have_no_edge():
+    # Signals only see closed candles, so on random walks the mean trade return is zero within its standard error.
+    # Entries one candle ahead of the live bot's alignment returned about 2.7% per trade on the same data.
+    candles = {f"MOCK{seed}-PERP": random_walk_ohlcv(2000, seed=seed) for seed in range(20)}
+    market_params = {market: {"Multiplier": 3, "Lookback": 10} for market in candles}
+    trades = portfolio.simulate_portfolio(candles, market_params, stop_loss_percent=100).trades
+
+    returns = trades.Pnl / (trades.Size * trades.EntryPrice) * 100
+    assert len(returns) > 500
+    assert abs(returns.mean()) < 3 * returns.std() / np.sqrt(len(returns))
+
+
+def test_signals_match_the_live_scan(ohlcv):
+    close = ohlcv.close.values
+    st, _, _ = spt.supertrend_kernel(ohlcv.high.values, ohlcv.low.values, close, look_back=10, multiplier=3)
+    positions = bt.get_supertrend_positions(st, close)
+
+    # market_scanner.analyse_market reads the panel's st_signal
+    panel = IndicatorPanel(ohlcv, look_back=10, multiplier=3)
+    np.testing.assert_array_equal(positions.idx, np.flatnonzero(panel["st_signal"]))
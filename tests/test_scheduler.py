@@ -0,0 +1,98 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from instrumentation import Metrics
+from scheduler import CandleScheduler
+
+
+class ShiftedClock:
+    """Wall clock moved to `start`, so a candle close comes up within a test."""
+
+    def __init__(self, start: float) -> None:
+        self.offset = start - time.time()
+
+    def __call__(self) -> float:
+        return time.time() + self.offset
+
+
+def test_jobs_start_at_the_next_close_of_their_interval():
+    now = 1000 * 86400 + 3 * 3600 + 123
+    scheduler = CandleScheduler(clock=lambda: now)
+    assert scheduler.add_job("1h", lambda close: None).next_close == now - 123 + 3600
+    assert scheduler.add_job("4h", lambda close: None).next_close == 1000 * 86400 + 4 * 3600
+    assert scheduler.add_job("1d", lambda close: None, name="daily").next_close == 1001 * 86400
+    assert list(scheduler.stats()) == ["1h", "4h", "daily"]
+    # On a boundary the close that just happened is not run again
+    assert CandleScheduler(clock=lambda: 1000 * 86400).add_job("1h", lambda close: None).next_close == \
+        1000 * 86400 + 3600
+
+    with pytest.raises(ValueError):
+        scheduler.add_job("1h", lambda close: None, overrun="queue")
+    with pytest.raises(ValueError):
+        scheduler.add_job("3h", lambda close: None)
+
+
+def test_runs_delay_seconds_after_the_close():
+    close = 1000 * 60
+    clock = ShiftedClock(close - 0.1)
+    scheduler = CandleScheduler(clock=clock)
+    job_metrics = Metrics(enabled=True)
+    runs = []
+
+    def func(candle_close: float) -> None:
+        runs.append((candle_close, clock()))
+        scheduler._stopped.set()
+
+    scheduler.add_job("1m", func, delay=0.1, job_metrics=job_metrics)
+    scheduler.run()
+    (candle_close, started), = runs
+    assert candle_close == close
+    assert 0.1 <= started - close < 0.3
+    stats = scheduler.stats()["1m"]
+    assert stats["runs"] == 1 and stats["last_lateness"] >= 0.1
+    assert job_metrics.summary()["stages"]["lateness:1m"]["calls"] == 1
+
+
+def test_only_the_latest_missed_close_runs():
+    close = 1000 * 60
+    clock = ShiftedClock(close + 0.05)
+    scheduler = CandleScheduler(clock=clock)
+    runs = []
+
+    def func(candle_close: float) -> None:
+        runs.append(candle_close)
+        scheduler._stopped.set()
+
+    job = scheduler.add_job("1m", func)
+    # As if the process was suspended for ten candles
+    job.next_close = close - 10 * 60
+    scheduler.run()
+    assert runs == [close]
+    assert job.next_close == close + 60
+
+
+@pytest.mark.parametrize("overrun, expected_runs, skipped, coalesced", [("skip", [60], 2, 0),
+                                                                        ("coalesce", [60, 180], 1, 2)])
+def test_overrun_policies(overrun, expected_runs, skipped, coalesced):
+    scheduler = CandleScheduler(clock=lambda: 1000.)
+    release = threading.Event()
+    runs = []
+
+    def func(candle_close: float) -> None:
+        runs.append(candle_close)
+        release.wait(5)
+
+    job = scheduler.add_job("1m", func, overrun=overrun)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        scheduler._executor = executor
+        scheduler._dispatch(job, 60)
+        # Still running at the next two closes
+        scheduler._dispatch(job, 120)
+        scheduler._dispatch(job, 180)
+        release.set()
+    assert runs == expected_runs
+    assert (job.skipped, job.coalesced, job.running) == (skipped, coalesced, False)
+
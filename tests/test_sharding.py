@@ -0,0 +1,114 @@
+import queue
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+import pytest
+
+pytest.importorskip("telegram")
+
+import sharding  # noqa: E402
+from mock_exchange import MockExchange, MockFtxClient  # noqa: E402
+
+MARKETS = [f"MARKET{idx}-PERP" for idx in range(2000)]
+
+
+class RecordingTelegram:
+    def __init__(self) -> None:
+        self.messages = []
+
+    def send_message(self, text: str, markdown: bool = False) -> None:
+        self.messages.append(text)
+
+
+def test_ring_assigns_every_market_once():
+    ring = sharding.HashRing(["shard0", "shard1", "shard2", "shard3"])
+    assignment = ring.assign(MARKETS)
+    assert sorted(market for markets in assignment.values() for market in markets) == sorted(MARKETS)
+    # About a quarter each
+    assert all(300 < len(markets) < 700 for markets in assignment.values())
+    # The same in every process, the ring only depends on the shard names
+    assert sharding.HashRing(["shard0", "shard1", "shard2", "shard3"]).assign(MARKETS) == assignment
+
+    with pytest.raises(ValueError):
+        sharding.HashRing([])
+
+
+def test_ring_rebalancing_only_moves_the_markets_of_the_changed_shard():
+    ring = sharding.HashRing(["shard0", "shard1", "shard2", "shard3"])
+    grown = sharding.HashRing(["shard0", "shard1", "shard2", "shard3", "shard4"])
+    moved = [market for market in MARKETS if ring.shard_for(market) != grown.shard_for(market)]
+    assert all(grown.shard_for(market) == "shard4" for market in moved)
+    assert 0.1 < len(moved) / len(MARKETS) < 0.3
+
+    shrunk = sharding.HashRing(["shard0", "shard1", "shard3"])
+    moved = [market for market in MARKETS if ring.shard_for(market) != shrunk.shard_for(market)]
+    assert all(ring.shard_for(market) == "shard2" for market in moved)
+    assert len(moved) == len(ring.assign(MARKETS)["shard2"])
+
+
+@pytest.fixture
+def coordinator(tmp_path, monkeypatch):
+    # Charts of the handled cycles are pruned below the working directory
+    monkeypatch.chdir(tmp_path)
+    coordinator = sharding.Coordinator(None, RecordingTelegram(), sharding.HashRing(["shard0", "shard1"]),
+                                       address=("127.0.0.1", 0), authkey=b"shard secret")
+    handled = queue.Queue()
+    handle = coordinator.handle
+
+    def recording_handle(message: dict) -> None:
+        handle(message)
+        handled.put(message)
+
+    coordinator.handle = recording_handle
+    coordinator.start()
+    thread = threading.Thread(target=coordinator.run, daemon=True)
+    thread.start()
+    yield coordinator, handled
+    coordinator.close()
+    thread.join(timeout=5)
+
+
+def test_worker_round_trip(coordinator):
+    coordinator, handled = coordinator
+    exchange = MockExchange({})
+    worker = sharding.ShardWorker("shard0", coordinator.ring, coordinator.address, intervals=["4h"],
+                                  market_params={}, ftx=MockFtxClient(exchange), authkey=b"shard secret")
+    assert handled.get(timeout=5)["type"] == "hello"
+    assert coordinator.connected == {"shard0"}
+
+    worker.scan("4h", time.time() // 14400 * 14400)
+    cycle = handled.get(timeout=5)
+    assert (cycle["type"], cycle["shard"], cycle["markets"], cycle["signals"]) == ("cycle", "shard0", 0, 0)
+
+    for render_queue in worker._render_queues.values():
+        render_queue.close()
+    worker._connection.close()
+    assert handled.get(timeout=5)["type"] == "disconnect"
+    assert coordinator.connected == set()
+
+
+def test_wrong_key_is_rejected(coordinator):
+    coordinator, handled = coordinator
+    with pytest.raises(AuthenticationError):
+        Client(coordinator.address, authkey=b"wrong secret")
+
+    # Without a key the client skips the handshake, the coordinator takes its first message for a wrong digest
+    unauthenticated = Client(coordinator.address, authkey=None)
+    unauthenticated.send({"type": "position", "shard": "intruder", "interval": "4h", "position": {}})
+
+    # The listener keeps serving workers with the key, and nothing else reached the coordinator
+    worker = sharding.connect(coordinator.address, authkey=b"shard secret")
+    worker.send({"type": "hello", "shard": "shard1", "intervals": ["4h"]})
+    assert handled.get(timeout=5)["shard"] == "shard1"
+    assert handled.empty()
+    assert coordinator.connected == {"shard1"}
+    worker.close()
+
+
+def test_default_key_is_never_none(monkeypatch):
+    monkeypatch.setattr(sharding, "SHARD_AUTHKEY", None)
+    assert sharding._authkey()
+    monkeypatch.setattr(sharding, "SHARD_AUTHKEY", "configured")
+    assert sharding._authkey() == b"configured"
@@ -0,0 +1,62 @@
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip("telegram")
+
+import simulate_cycles as sc  # noqa: E402
+import supertrend_4h as st4h  # noqa: E402
+from conftest import FIXTURE_FOLDER  # noqa: E402
+from ftx_client import candle_resolution  # noqa: E402
+
+
+def test_cycles_signal_on_the_candle_that_closed(tmp_path, monkeypatch):
+    # Right after a close the in-progress candle is flat at its open, the scan has to look at the closed one
+    monkeypatch.setitem(st4h.settings, "instrumentation", dict(
+        st4h.settings["instrumentation"], report_file=str(tmp_path / "cycles.jsonl"), prometheus_file=None,
+        profile_slowest_market=False))
+    resolution = candle_resolution(st4h.settings["analysis"]["interval"])
+    end_time = time.time() // resolution * resolution
+    exchange = sc.synthetic_exchange(20, 115 * 86400 // resolution, resolution, end_time)
+    params = {"Multiplier": 3, "Lookback": 10, "TheDfactor": 0.}
+    replay = sc.CycleReplay(exchange, str(tmp_path), market_params={market: params for market in exchange.markets},
+                            execute_orders=False)
+    try:
+        cycles = replay.run(end_time - 5 * 86400, end_time)
+    finally:
+        replay.close()
+
+    report = replay.report(cycles)
+    assert report["failed_cycles"] == 0
+    assert report["signals"] > 0
+    assert report["signal_mismatches"] == []
+
+
+def test_recorded_fixture_replays_with_its_increments(tmp_path, monkeypatch):
+    monkeypatch.setitem(st4h.settings, "instrumentation", dict(
+        st4h.settings["instrumentation"], report_file=str(tmp_path / "cycles.jsonl"), prometheus_file=None,
+        profile_slowest_market=False))
+    exchange = sc.fixture_exchange(FIXTURE_FOLDER)
+    assert exchange.markets == ["HIGHPRICE-PERP", "LOWPRICE-PERP"]
+    end_time = max(candles[-1]["time"] / 1000 for candles in exchange.candles.values())
+    params = {"Multiplier": 3, "Lookback": 10, "TheDfactor": 0.}
+    replay = sc.CycleReplay(exchange, str(tmp_path), market_params={market: params for market in exchange.markets})
+    try:
+        cycles = replay.run(end_time - 10 * 86400, end_time)
+    finally:
+        replay.close()
+
+    report = replay.report(cycles)
+    assert report["failed_cycles"] == 0
+    assert report["signal_mismatches"] == []
+    assert report["orders"] > 0
+
+    # Orders are rounded to the recorded increments, not the mock's default ones
+    increments = {market["name"]: market for market in exchange.market_info.values()}
+    for fill in exchange.fills:
+        size_steps = fill["size"] / increments[fill["market"]]["sizeIncrement"]
+        assert np.isclose(size_steps, round(size_steps))
+    for order in exchange.conditional_orders:
+        price_steps = order["triggerPrice"] / increments[order["market"]]["priceIncrement"]
+        assert np.isclose(price_steps, round(price_steps))
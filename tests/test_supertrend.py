@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import supertrend as spt
+from conftest import random_walk_ohlcv
+
+
+def _legacy_supertrend_analysis(high: pd.Series, low: pd.Series, close: pd.Series, look_back: int,
+                                multiplier: float):
+    # The original pandas implementation the kernel replaced, positional lookups spelled out with iloc
+    tr1 = pd.DataFrame(high - low)
+    tr2 = pd.DataFrame(abs(high - close.shift(1)))
+    tr3 = pd.DataFrame(abs(low - close.shift(1)))
+    tr = pd.concat([tr1, tr2, tr3], axis=1, join='inner').max(axis=1)
+    atr = tr.ewm(look_back).mean()
+
+    hl_avg = (high + low) / 2
+    upper_band = (hl_avg + multiplier * atr).dropna()
+    lower_band = (hl_avg - multiplier * atr).dropna()
+
+    final_bands = pd.DataFrame(columns=['upper', 'lower'])
+    final_bands.iloc[:, 0] = [x for x in upper_band - upper_band]
+    final_bands.iloc[:, 1] = final_bands.iloc[:, 0]
+
+    for i in range(len(final_bands)):
+        if i == 0:
+            final_bands.iloc[i, 0] = 0
+        elif (upper_band.iloc[i] < final_bands.iloc[i - 1, 0]) | (close.iloc[i - 1] > final_bands.iloc[i - 1, 0]):
+            final_bands.iloc[i, 0] = upper_band.iloc[i]
+        else:
+            final_bands.iloc[i, 0] = final_bands.iloc[i - 1, 0]
+
+    for i in range(len(final_bands)):
+        if i == 0:
+            final_bands.iloc[i, 1] = 0
+        elif (lower_band.iloc[i] > final_bands.iloc[i - 1, 1]) | (close.iloc[i - 1] < final_bands.iloc[i - 1, 1]):
+            final_bands.iloc[i, 1] = lower_band.iloc[i]
+        else:
+            final_bands.iloc[i, 1] = final_bands.iloc[i - 1, 1]
+
+    supertrend = pd.DataFrame(columns=[f'supertrend_{look_back}'])
+    supertrend.iloc[:, 0] = [x for x in final_bands['upper'] - final_bands['upper']]
+
+    for i in range(len(supertrend)):
+        if i == 0:
+            supertrend.iloc[i, 0] = 0
+        elif supertrend.iloc[i - 1, 0] == final_bands.iloc[i - 1, 0] and close.iloc[i] < final_bands.iloc[i, 0]:
+            supertrend.iloc[i, 0] = final_bands.iloc[i, 0]
+        elif supertrend.iloc[i - 1, 0] == final_bands.iloc[i - 1, 0] and close.iloc[i] > final_bands.iloc[i, 0]:
+            supertrend.iloc[i, 0] = final_bands.iloc[i, 1]
+        elif supertrend.iloc[i - 1, 0] == final_bands.iloc[i - 1, 1] and close.iloc[i] > final_bands.iloc[i, 1]:
+            supertrend.iloc[i, 0] = final_bands.iloc[i, 1]
+        elif supertrend.iloc[i - 1, 0] == final_bands.iloc[i - 1, 1] and close.iloc[i] < final_bands.iloc[i, 1]:
+            supertrend.iloc[i, 0] = final_bands.iloc[i, 0]
+
+    supertrend = supertrend.set_index(upper_band.index)
+    supertrend = supertrend.dropna()[1:]
+
+    upt = []
+    dt = []
+    close = close.iloc[len(close) - len(supertrend):]
+    for i in range(len(supertrend)):
+        if close.iloc[i] > supertrend.iloc[i, 0]:
+            upt.append(supertrend.iloc[i, 0])
+            dt.append(np.nan)
+        elif close.iloc[i] < supertrend.iloc[i, 0]:
+            upt.append(np.nan)
+            dt.append(supertrend.iloc[i, 0])
+        else:
+            upt.append(np.nan)
+            dt.append(np.nan)
+
+    st, upt, dt = pd.Series(supertrend.iloc[:, 0]), pd.Series(upt), pd.Series(dt)
+    upt.index, dt.index = supertrend.index, supertrend.index
+    return st, upt, dt
+
+
+def _pure_python(func):
+    # The plain Python function behind a numba dispatcher, the function itself without numba
+    return getattr(func, "py_func", func)
+
+
+@pytest.fixture(scope="module")
+def candles() -> pd.DataFrame:
+    return random_walk_ohlcv(300, seed=7, volatility=0.02)
+
+
+@pytest.fixture(scope="module", params=[(10, 3), (7, 1.5)], ids=["10x3", "7x1.5"])
+def legacy(request, candles) -> tuple:
+    look_back, multiplier = request.param
+    return (look_back, multiplier), _legacy_supertrend_analysis(candles.high, candles.low, candles.close,
+                                                                look_back, multiplier)
+
+
+def _assert_matches_legacy(st: np.ndarray, upt: np.ndarray, dt: np.ndarray, legacy_output: tuple) -> None:
+    # Kernel output is full length, the legacy one starts after the seed candle
+    legacy_st, legacy_upt, legacy_dt = legacy_output
+    assert np.isnan(st[0])
+    np.testing.assert_array_equal(st[1:], legacy_st.values.astype(float))
+    np.testing.assert_array_equal(upt[1:], legacy_upt.values)
+    np.testing.assert_array_equal(dt[1:], legacy_dt.values)
+
+
+def test_kernel_matches_legacy_pandas(candles, legacy):
+    (look_back, multiplier), legacy_output = legacy
+    st, upt, dt = spt.supertrend_kernel(candles.high.values, candles.low.values, candles.close.values,
+                                        look_back, multiplier)
+    _assert_matches_legacy(st, upt, dt, legacy_output)
+
+
+def test_pure_python_fallback_matches_legacy_pandas(candles, legacy, monkeypatch):
+    monkeypatch.setattr(spt, "ewm_mean", _pure_python(spt.ewm_mean))
+    monkeypatch.setattr(spt, "_supertrend_loop", _pure_python(spt._supertrend_loop))
+    (look_back, multiplier), legacy_output = legacy
+    st, upt, dt = spt.supertrend_kernel(candles.high.values, candles.low.values, candles.close.values,
+                                        look_back, multiplier)
+    _assert_matches_legacy(st, upt, dt, legacy_output)
+
+
+def test_analysis_keeps_legacy_index(candles, legacy):
+    (look_back, multiplier), (legacy_st, legacy_upt, _) = legacy
+    st, upt, _ = spt.supertrend_analysis(candles.high, candles.low, candles.close, look_back, multiplier)
+    assert st.index.equals(legacy_st.index) and upt.index.equals(legacy_upt.index)
+    assert st.name == legacy_st.name
+
+
+def test_grid_rows_match_kernel(candles):
+    look_backs, multipliers = [7, 10], [1.5, 3]
+    grid = spt.supertrend_grid(candles.high.values, candles.low.values, candles.close.values, look_backs,
+                               multipliers)
+    row = 0
+    for multiplier in multipliers:
+        for look_back in look_backs:
+            st, _, _ = spt.supertrend_kernel(candles.high.values, candles.low.values, candles.close.values,
+                                             look_back, multiplier)
+            np.testing.assert_array_equal(grid[row], st)
+            row += 1
+
+
+def _batch_indicators(df: pd.DataFrame, look_back: int, multiplier: float) -> pd.DataFrame:
+    st, upt, dt = spt.supertrend_kernel(df.high.values, df.low.values, df.close.values, look_back, multiplier)
+    long_trig, short_trig, st_signal = spt.supertrend_signals(df.close.values, st)
+    slowk, slowd = spt.calculate_stoch_rsi(df)
+    return pd.DataFrame({"st": st, "upt": upt, "dt": dt, "st_signal": st_signal, "long_trig": long_trig,
+                         "short_trig": short_trig, "ema200": spt.calculate_ema(df.close).values,
+                         "slowk": slowk.values, "slowd": slowd.values}, index=df.index)
+
+
+def test_streaming_state_with_save_and_load_matches_batch(tmp_path, ohlcv):
+    look_back, multiplier = 10, 3
+    batch = _batch_indicators(ohlcv, look_back, multiplier)
+    assert (batch.st_signal != 0).sum() > 5
+
+    # Seed from history, stream bar by bar, then save and carry on from the reloaded state
+    split = 600
+    state = spt.SupertrendState.from_history(ohlcv.iloc[:250], look_back, multiplier)
+    streamed = [state.update(high, low, close, time=time) for time, high, low, close in
+                zip(ohlcv.index[250:split], ohlcv.high.values[250:split], ohlcv.low.values[250:split],
+                    ohlcv.close.values[250:split])]
+    state.save(str(tmp_path / "state.json"))
+    state = spt.SupertrendState.load(str(tmp_path / "state.json"))
+    # Candles already applied before the save are skipped
+    streamed += state.update_from_dataframe(ohlcv)
+    assert state.n_candles == len(ohlcv)
+
+    streamed = pd.DataFrame(streamed).set_index("time")
+    expected = batch.iloc[250:]
+    assert streamed.index.equals(expected.index)
+    exact = ["st", "upt", "dt", "st_signal", "long_trig", "short_trig", "ema200"]
+    pd.testing.assert_frame_equal(streamed[exact], expected[exact], check_dtype=False, check_names=False,
+                                  check_freq=False)
+    pd.testing.assert_frame_equal(streamed[["slowk", "slowd"]], expected[["slowk", "slowd"]], check_names=False,
+                                  check_freq=False, rtol=1e-9, atol=1e-9)
+
+
+def _legacy_supertrend_signals(prices, st) -> tuple:
+    # The original per bar loop, st[i - 1] wraps around to the last bar on the first one
+    long_trigger = []
+    short_trigger = []
+    st_signal = []
+    signal = 0
+    for i in range(len(st)):
+        if st[i - 1] > prices[i - 1] and st[i] < prices[i]:
+            if signal != 1:
+                long_trigger.append(prices[i])
+                short_trigger.append(np.nan)
+                signal = 1
+                st_signal.append(signal)
+            else:
+                long_trigger.append(np.nan)
+                short_trigger.append(np.nan)
+                st_signal.append(0)
+        elif st[i - 1] < prices[i - 1] and st[i] > prices[i]:
+            if signal != -1:
+                long_trigger.append(np.nan)
+                short_trigger.append(prices[i])
+                signal = -1
+                st_signal.append(signal)
+            else:
+                long_trigger.append(np.nan)
+                short_trigger.append(np.nan)
+                st_signal.append(0)
+        else:
+            long_trigger.append(np.nan)
+            short_trigger.append(np.nan)
+            st_signal.append(0)
+    return long_trigger, short_trigger, st_signal
+
+
+def _assert_signals_equal(new: tuple, old: tuple) -> None:
+    for new_values, old_values in zip(new, old):
+        np.testing.assert_array_equal(new_values, np.asarray(old_values, dtype=float))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_signals_match_legacy_loop(seed):
+    df = random_walk_ohlcv(500, seed=seed, volatility=0.02)
+    close = df.close.values
+    st, _, _ = spt.supertrend_kernel(df.high.values, df.low.values, close, 10, 3)
+
+    # Full length st as in the live scan, NaN on the seed candle so the old wrap around never crossed either
+    legacy = _legacy_supertrend_signals(close, st)
+    assert any(legacy[2])
+    _assert_signals_equal(spt.supertrend_signals(close, st), legacy)
+    assert spt.get_supertrend_signals(close, st)[2] == legacy[2]
+
+    # Without the seed candle the first close can cross the wrapped around last one, it only differs there
+    legacy = _legacy_supertrend_signals(close[1:], st[1:])
+    if not legacy[2][0]:
+        _assert_signals_equal(spt.supertrend_signals(close[1:], st[1:]), legacy)
+
+
+def test_first_candle_never_signals():
+    # Last close below, first one above the supertrend. The old loop went long on the first candle against the
+    # wrapped around last one, which also swallowed the real long crossing after the touch at index 1
+    prices = np.array([11., 10., 9., 12., 13., 9.])
+    st = np.full(len(prices), 10.)
+    assert _legacy_supertrend_signals(prices, st)[2] == [1, 0, 0, 0, 0, -1]
+
+    long_trigger, short_trigger, st_signal = spt.supertrend_signals(prices, st)
+    np.testing.assert_array_equal(st_signal, [0, 0, 0, 1, 0, -1])
+    np.testing.assert_array_equal(long_trigger, [np.nan, np.nan, np.nan, 12., np.nan, np.nan])
+    np.testing.assert_array_equal(short_trigger, [np.nan, np.nan, np.nan, np.nan, np.nan, 9.])
@@ -0,0 +1,58 @@
+import time
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("telegram")
+
+import optimize_markets as om  # noqa: E402
+import supertrend_4h as st4h  # noqa: E402
+from conftest import random_walk_ohlcv  # noqa: E402
+from mock_exchange import MockExchange, MockFtxClient, ohlcv_to_candles  # noqa: E402
+from supertrend import SupertrendState  # noqa: E402
+
+MARKET = "MOCK-PERP"
+RESOLUTION = 4 * 3600
+
+
+def test_backfill_reaches_back_to_the_last_streamed_candle():
+    ohlcv = random_walk_ohlcv(600)
+    start_time = (time.time() // RESOLUTION - len(ohlcv) + 1) * RESOLUTION
+    ohlcv.index = pd.date_range(pd.Timestamp(start_time, unit="s", tz="UTC"), periods=len(ohlcv), freq="4h",
+                                name="time")
+    exchange = MockExchange({(MARKET, RESOLUTION): ohlcv_to_candles({column: ohlcv[column].values
+                                                                     for column in ohlcv}, RESOLUTION, start_time)})
+    # The stream was down for three days
+    state = SupertrendState.from_history(ohlcv.iloc[:-18], look_back=10, multiplier=3)
+    df = MockFtxClient(exchange).get_historical_market_data(MARKET, interval="4h",
+                                                            start_time=st4h.backfill_start_time(state))
+    assert df.index[0] <= pd.Timestamp(start_time + (len(ohlcv) - 18) * RESOLUTION, unit="s", tz="UTC")
+    assert len(state.update_from_dataframe(df)) == 18
+
+    state = SupertrendState(look_back=10, multiplier=3)
+    assert st4h.backfill_start_time(state) == st4h.settings["analysis"]["start_time"]
+
+
+def test_market_params_come_from_the_optimized_file_alone(tmp_path, monkeypatch):
+    pd.DataFrame({"Name": ["A-PERP", "B-PERP"], "Multiplier": [3., 4.], "Lookback": [10, 12],
+                  "TheDfactor": [0.5, 1.5]}).to_csv(tmp_path / "optimized.csv", index=False)
+    monkeypatch.setattr(om, "OPTIMIZEDML_FILEPATH", str(tmp_path / "optimized.csv"))
+    market_params = st4h.load_market_params(["B-PERP", "C-PERP"])
+    assert market_params == {"B-PERP": {"Multiplier": 4., "Lookback": 12, "TheDfactor": 1.5}}
+
+
+def test_timeframes_use_their_own_parameters(tmp_path, monkeypatch):
+    monkeypatch.setattr(om, "OPTIMIZEDML_FILEPATH", str(tmp_path / "optimized.csv"))
+    monkeypatch.setitem(st4h.settings["schedule"], "intervals", ["4h", "1h", "15m"])
+    pd.DataFrame({"Name": ["A-PERP"], "Multiplier": [3.], "Lookback": [10], "TheDfactor": [0.5]}).to_csv(
+        tmp_path / "optimized.csv", index=False)
+    pd.DataFrame({"Name": ["A-PERP"], "Multiplier": [2.], "Lookback": [20], "TheDfactor": [0.1]}).to_csv(
+        tmp_path / "optimized_1h.csv", index=False)
+
+    # 15m was never optimized
+    assert st4h.scheduled_intervals() == ["4h", "1h"]
+    assert st4h.load_market_params(["A-PERP"])["A-PERP"]["Lookback"] == 10
+    assert st4h.load_market_params(["A-PERP"], "1h")["A-PERP"]["Lookback"] == 20
+
+    assert st4h.timeframe_metrics_path("metrics/supertrend.prom", "4h") == "metrics/supertrend.prom"
+    assert st4h.timeframe_metrics_path("metrics/supertrend.prom", "1h") == "metrics/supertrend_1h.prom"
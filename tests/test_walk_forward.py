@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+import backtesting as bt
+import walk_forward as wf
+from conftest import random_walk_ohlcv
+
+
+def test_folds_follow_each_other():
+    assert bt.walk_forward_folds(1000, 600, 200) == [(0, 600, 800), (200, 800, 1000)]
+    assert bt.walk_forward_folds(1000, 600, 200, step=100) == [(0, 600, 800), (100, 700, 900), (200, 800, 1000)]
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_driftless_out_of_sample_returns():
+    # Test windows only see closed candles, so on random walks the out-of-sample returns average out to zero. Entries
+    # one candle ahead averaged about +3.1% per fold on the same data.
+    returns = np.concatenate([bt.walk_forward(random_walk_ohlcv(3000, seed=seed), 600, 200).AvgReturns.dropna()
+                              for seed in range(10)])
+    assert len(returns) > 100
+    assert abs(returns.mean()) < 3 * returns.std() / np.sqrt(len(returns))
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_parallel_folds_match(ohlcv):
+    serial = bt.walk_forward(ohlcv, 300, 100)
+    parallel = bt.walk_forward(ohlcv, 300, 100, workers=2)
+    assert serial.equals(parallel)
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_summary_of_folds_without_trades():
+    flat = random_walk_ohlcv(1000)
+    flat[["open", "high", "low", "close"]] = 100.
+    results = bt.walk_forward(flat, 600, 200)
+    assert "AvgReturns" not in results
+    assert wf.summarize(results) == "2 folds, none with trades"
+    assert wf.summarize(results.assign(AvgReturns=[np.nan, 2.])) == \
+        "2 folds, 1 with trades, out-of-sample AvgReturns mean=2.00% positive in 100% of folds"
@@ -0,0 +1,94 @@
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import backtesting as bt
+import optimize_markets as om
+from ftx_client import FtxClient
+
+logger = logging.getLogger(__name__)
+
+try:
+    from config import API_KEY, API_SECRET
+except ImportError:
+    # Candles only need the public endpoints
+    API_KEY = API_SECRET = None
+
+settings = om.settings
+WALK_FORWARD_FILEPATH = os.path.join(om.BACKTEST_FOLDER, settings["filepaths"]["walk_forward_file"])
+
+
+def walk_forward_market(market: str, train_size: int, test_size: int, step: int, multipliers: list, lookbacks: list,
+                        fold_workers: int = 1) -> pd.DataFrame:
+    df = om._ftx.get_historical_market_data(market, interval=settings["analysis"]["interval"],
+                                            start_time=settings["walk_forward"]["start_time"])
+    results = bt.walk_forward(df, train_size, test_size, step=step, multipliers=multipliers, lookbacks=lookbacks,
+                              workers=fold_workers)
+    results.insert(0, "Name", market)
+    return results
+
+
+def summarize(results: pd.DataFrame) -> str:
+    # Folds without trades have no AvgReturns, results of markets that never traded have no such column at all
+    if "AvgReturns" not in results or results.AvgReturns.isna().all():
+        return f"{len(results)} folds, none with trades"
+    traded = results.dropna(subset=["AvgReturns"])
+    return f"{len(results)} folds, {len(traded)} with trades, out-of-sample AvgReturns " \
+           f"mean={traded.AvgReturns.mean():.2f}% positive in {(traded.AvgReturns > 0).mean() * 100:.0f}% of folds"
+
+
+def main():
+    wf_settings = settings["walk_forward"]
+    arg_parser = argparse.ArgumentParser(description="Walk-forward optimization of the supertrend parameters")
+    arg_parser.add_argument("--train", type=int, default=wf_settings["train_size"], help="Training window (candles)")
+    arg_parser.add_argument("--test", type=int, default=wf_settings["test_size"], help="Test window (candles)")
+    arg_parser.add_argument("--step", type=int, help="Candles between folds (default: test window)")
+    arg_parser.add_argument("--multipliers", type=float, nargs="+", default=settings["optimization"]["multipliers"])
+    arg_parser.add_argument("--lookbacks", type=int, nargs="+", default=settings["optimization"]["lookbacks"])
+    arg_parser.add_argument("--workers", type=int, default=wf_settings["workers"])
+    arg_parser.add_argument("--markets", nargs="+", help="Only these markets (default: all perpetuals)")
+    arg_parser.add_argument("--output", default=WALK_FORWARD_FILEPATH)
+    args = arg_parser.parse_args()
+
+    multipliers = [int(m) if float(m).is_integer() else m for m in args.multipliers]
+    markets = args.markets
+    if markets is None:
+        markets = om.perpetual_markets(FtxClient(api_key=API_KEY, api_secret=API_SECRET))
+
+    start = time.perf_counter()
+    results = []
+    if len(markets) == 1:
+        # A single market parallelizes over its folds
+        om._init_worker()
+        results.append(walk_forward_market(markets[0], args.train, args.test, args.step, multipliers, args.lookbacks,
+                                           fold_workers=args.workers))
+        logger.info(f"{markets[0]}: {summarize(results[-1])}")
+    else:
+        # Many markets parallelize over markets, each worker runs the folds of one market on a single grid
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=om._init_worker) as pool:
+            futures = {pool.submit(walk_forward_market, market, args.train, args.test, args.step, multipliers,
+                                   args.lookbacks): market for market in markets}
+            for future in as_completed(futures):
+                market = futures[future]
+                try:
+                    results.append(future.result())
+                except Exception as exc:
+                    logger.error(f"{market}: {exc}")
+                    continue
+                logger.info(f"{market}: {summarize(results[-1])}")
+
+    if not results:
+        return
+    results = pd.concat(results, ignore_index=True)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    om.write_csv_atomic(results, args.output)
+    logger.info(f"All markets: {summarize(results)}")
+    logger.info(f"Wrote {len(results)} folds to {args.output} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()